@@ -31,12 +31,14 @@ bl_info = {
 }
 
 import bpy
+import functools
 import os
-import shutil
 import threading
 import bpy.utils.previews
+from collections import deque
 from bpy.app.handlers import persistent
 from . import optix, fmutils, urlutils
+from .dnoise import backends, blend, denoiser, pipeline, proxy, roi, sequence, tiles, timing, worker
 
 # directory of the script files
 SCRIPT_DIR = os.path.dirname(__file__)
@@ -58,7 +60,24 @@ FORMAT_EXTENSIONS = {'BMP': 'bmp',
                      'HDR': 'hdr',
                      'TIFF': 'tif'}
 
-SEQUENCE_TEXT = "D-NOISE Sequence"
+# unblended D-NOISE Export and its source, for blending without denoising again
+BLEND_BUFFER = None
+BLEND_FORMAT = None
+
+# frames rendered but not yet denoised during an animation render
+ANIMATION_QUEUE = None
+ANIMATION_QUEUE_SIZE = 4
+ANIMATION_JOB = None
+ANIMATION_TEXT = None
+
+# frames of the animation denoised in a region of interest, waiting to be pasted back together on a thread that
+# may use bpy, and whether any frame of the animation was
+ANIMATION_PASTES = deque()
+ANIMATION_ROI = False
+
+# the background full resolution denoise of the last progressive Quick D-NOISE, and how often it is checked on
+PREVIEW_JOB = None
+PREVIEW_POLL_SECONDS = 0.1
 
 #
 # Denoiser Functions
@@ -67,93 +86,456 @@ SEQUENCE_TEXT = "D-NOISE Sequence"
 
 def runpostimgdenoiser():
     """Run the OptiX beauty denoiser on the image loaded in the UV/Image editor"""
-    global DENOISE_SOURCE, SCRIPT_DIR, FORMAT_EXTENSIONS
+    global DENOISE_SOURCE
+    # the D-NOISE Export is about to be replaced, so the result of an earlier progressive denoise is no longer wanted
+    cancelpreview()
+    job = timing.Job('image')
+    job.start(1)
+    timer = job.frame(DENOISE_SOURCE.name)
+    scratch_dir = fmutils.makescratch()
+    hdr = optix.gethdr()
+    preferences = fmutils.getpreferences()
+    tile_memory = preferences.tile_memory * 1048576
+    # a progressive denoise keeps its scratch directory until its background denoise is done
+    previewing = False
+    status = 'failed'
+
+    try:
+        source_path, output_path, file_format = saveimagesource(DENOISE_SOURCE, scratch_dir, hdr, timer)
+        with timer.stage('load'):
+            source_pixels, width, height = fmutils.readpixels(source_path)
+
+        # images too large for the denoiser's memory budget are denoised in overlapping tiles
+        if preferences.use_tiling and width * height * tiles.DENOISER_BYTES_PER_PIXEL > tile_memory:
+            with timer.stage('denoise'):
+                denoised = optix.tileddenoise(source_pixels.reshape(height, width, 4), hdr, 0, scratch_dir,
+                                              tiles.gettilesize(tile_memory), bpy.context.scene.DNOISEJobs)
+            with timer.stage('load'):
+                setexport(denoised.ravel(), source_pixels, width, height, file_format)
+        else:
+            previewing = denoiseimage(job, timer, scratch_dir, source_path, output_path, source_pixels, width, height,
+                                      file_format, hdr)
+
+        fmutils.setactiveimage('D-NOISE Export', bpy.context.space_data)
+        status = 'done'
+    finally:
+        if not previewing:
+            finishimage(job, timer, scratch_dir, status)
+
+
+def saveimagesource(image, scratch_dir, hdr, timer):
+    """Returns the path the denoiser reads an image from, the path it writes to and the image's handoff format"""
+    if image.name == 'Render Result':
+        # getextension switches the scene to PNG output if D-NOISE cannot read its format
+        fmutils.getextension(bpy.context.scene.render.image_settings.file_format, FORMAT_EXTENSIONS)
+        file_format = fmutils.gethandoffformat(bpy.context.scene.render.image_settings.file_format, hdr)
+        source_name = 'source.{0}'.format(FORMAT_EXTENSIONS[file_format])
+        with timer.stage('save'):
+            fmutils.saverender(scratch_dir, source_name, image, file_format)
+        source_path = os.path.join(scratch_dir, source_name)
+
+    else:
+        # the denoiser reads the image file straight from where it is stored
+        file_format = fmutils.gethandoffformat(image.file_format, hdr)
+        source_name = 'source.{0}'.format(fmutils.getextension(file_format, FORMAT_EXTENSIONS))
+        source_path = bpy.path.abspath(image.filepath)
+
+    # the image is denoised unblended, and the D-NOISE blend is applied afterwards by setexport
+    return source_path, os.path.join(scratch_dir, 'denoised' + os.path.splitext(source_name)[1]), file_format
+
+
+def denoiseimage(job, timer, scratch_dir, source_path, output_path, source_pixels, width, height, file_format, hdr):
+    """Denoises an image, or its region of interest, and returns true if a proxy preview is shown meanwhile"""
+    # only the part of the image with any alpha, and of a render only the part inside its render border, is
+    # denoised if that is enough smaller than the image
+    scene = bpy.context.scene if DENOISE_SOURCE.name == 'Render Result' else None
+    box = optix.getroi([source_pixels.reshape(height, width, 4)], width, height, scene)
+    memory = denoiser.getmemory(width, height)
+    if box is not None:
+        with timer.stage('save'):
+            source_path, output_path = optix.cropbatch([(source_path, output_path, None, None)], box,
+                                                       scratch_dir)[0][0][:2]
+        memory = denoiser.getmemory(box[2] - box[0], box[3] - box[1])
+
+    backend = optix.getbackend()
+    denoise_cache = fmutils.getcache()
+    key = None
+    if denoise_cache is not None:
+        with timer.stage('denoise'):
+            key = denoise_cache.key([source_path], denoiser.getsettings(hdr=hdr, backend=backend.name))
+    denoise = functools.partial(rundenoiser, source_path, output_path, hdr, memory, backend, denoise_cache, key)
+    export = functools.partial(exportdenoised, output_path, source_pixels, width, height, box, file_format)
+
+    # a large image that is not cached is shown denoised from a proxy at once, and replaced by the full resolution
+    # result once it is denoised in the background
+    factor = proxy.getfactor(width, height)
+    if fmutils.getpreferences().use_progressive and factor > 1 and \
+            (key is None or not denoise_cache.contains(key, output_path)):
+        with timer.stage('preview'):
+            denoiseproxy(source_pixels, width, height, factor, hdr, box, file_format, scratch_dir, backend)
+        startpreview(job, timer, denoise, export, scratch_dir)
+        return True
+
+    with timer.stage('denoise'):
+        denoise()
+    with timer.stage('load'):
+        export()
+    return False
 
-    if DENOISE_SOURCE.name == 'Render Result':
-        file_format = bpy.context.scene.render.image_settings.file_format
-        file_extension = fmutils.getextension(file_format, FORMAT_EXTENSIONS)
-        source_name = 'source.{0}'.format(file_extension)
-        fmutils.save(SCRIPT_DIR, source_name, DENOISE_SOURCE)
 
+def rundenoiser(source_path, output_path, hdr, memory, backend, denoise_cache=None, key=None):
+    """Denoises an image file unblended, through the cache if one is given with the key of the image"""
+    if denoise_cache is None:
+        optix.beautydenoise(source_path, output_path, hdr, 0, backend=backend, memory=memory)
+        return
+
+    denoise_cache.fetch(key, output_path, lambda path: optix.beautydenoise(source_path, path, hdr, 0,
+                                                                           backend=backend, memory=memory))
+    print(">> D-NOISE: cache {0}".format(denoise_cache.stats()))
+
+
+def exportdenoised(output_path, source_pixels, width, height, box, file_format):
+    """Shows a denoised image in the D-NOISE Export, pasted into its source inside the box if it was cropped to one"""
+    if not os.path.isfile(output_path):
+        # a failed denoise leaves the source showing, as when the denoiser overwrote the source in place
+        denoised = source_pixels
+    elif box is None:
+        denoised = fmutils.readpixels(output_path)[0]
     else:
-        file_format = DENOISE_SOURCE.file_format
-        file_extension = fmutils.getextension(file_format, FORMAT_EXTENSIONS)
-        source_name = 'source.{0}'.format(file_extension)
-        fmutils.save(SCRIPT_DIR, source_name, DENOISE_SOURCE)
-
-    optix.beautydenoise(SCRIPT_DIR, source_name, optix.gethdr(), optix.getblend())
-    fmutils.load(SCRIPT_DIR, source_name, 'D-NOISE Export')
-    fmutils.setactiveimage('D-NOISE Export', bpy.context.space_data)
-    fmutils.setcolorspace('D-NOISE Export', file_format)
-    bpy.data.images['D-NOISE Export'].update()
-    fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
+        # the denoised region is pasted into the source pixels without writing the whole image out again
+        denoised = source_pixels.reshape(height, width, 4).copy()
+        region, region_width, region_height = fmutils.readpixels(output_path)
+        roi.pastebox(denoised, region.reshape(region_height, region_width, 4), box)
+    setexport(denoised.ravel(), source_pixels, width, height, file_format)
+
+
+def finishimage(job, timer, scratch_dir, status='done'):
+    """Removes an image denoise's scratch directory and reports the image to its job"""
+    with timer.stage('cleanup'):
+        fmutils.removescratch(scratch_dir)
+    timer.finish(status)
+    job.finish('cancelled' if status == 'cancelled' else 'done')
+
+
+def denoiseproxy(source_pixels, width, height, factor, hdr, box, file_format, scratch_dir, backend):
+    """Shows an image denoised from a proxy scaled down by factor in the D-NOISE Export, scaled back up to its size"""
+    pixels = source_pixels.reshape(height, width, 4)
+    proxy_pixels = proxy.downscale(pixels, factor)
+    proxy_height, proxy_width = proxy_pixels.shape[:2]
+    proxy_path = os.path.join(scratch_dir, 'proxy.exr')
+    proxy_output_path = os.path.join(scratch_dir, 'proxy-denoised.exr')
+    fmutils.writepixels(proxy_path, proxy_pixels.ravel(), proxy_width, proxy_height)
+    optix.beautydenoise(proxy_path, proxy_output_path, hdr, 0, backend=backend,
+                        memory=denoiser.getmemory(proxy_width, proxy_height))
+    if not os.path.isfile(proxy_output_path):
+        # a failed proxy leaves the source showing until the full resolution result replaces it
+        setexport(source_pixels, source_pixels, width, height, file_format)
+        return
+
+    denoised = fmutils.readpixels(proxy_output_path)[0].reshape(proxy_height, proxy_width, 4)
+    denoised = proxy.upscale(denoised, width, height)
+    if box is not None:
+        # like the full resolution result, the preview leaves the source as it is outside the region of interest
+        x0, y0, x1, y1 = box
+        preview = pixels.copy()
+        preview[y0:y1, x0:x1] = denoised[y0:y1, x0:x1]
+        denoised = preview
+    setexport(denoised.ravel(), source_pixels, width, height, file_format)
+
+
+def startpreview(job, timer, denoise, export, scratch_dir):
+    """Runs the full resolution denoise of a progressive denoise in the background and exports it once done"""
+    global PREVIEW_JOB
+    PREVIEW_JOB = job
+    source = DENOISE_SOURCE
+    source_state = getsourcestate(source)
+    errors = []
+
+    def denoiseinbackground():
+        # only the denoiser runs on this thread, the result is loaded into Blender by the timer on the main thread
+        try:
+            if not job.iscancelled():
+                with timer.stage('denoise'):
+                    denoise()
+        except Exception as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=denoiseinbackground, daemon=True)
+    thread.start()
+
+    def finishpreview():
+        global PREVIEW_JOB
+        if not job.iscancelled() and getsourcestate(source) != source_state:
+            print(">> D-NOISE: the image changed, dropping its full resolution denoise")
+            job.cancel()
+
+        # the denoiser cannot be stopped mid image, so a cancelled denoise is waited for before its files are removed
+        if thread.is_alive():
+            return PREVIEW_POLL_SECONDS
+
+        status = 'cancelled' if job.iscancelled() else 'done'
+        if status == 'done':
+            try:
+                if errors:
+                    raise errors[0]
+                with timer.stage('load'):
+                    export()
+                fmutils.forceUIUpdate("IMAGE_EDITOR")
+            except Exception as error:
+                print(">> D-NOISE ERROR: full resolution denoise failed: {0}".format(error))
+                status = 'failed'
+
+        finishimage(job, timer, scratch_dir, status)
+        if PREVIEW_JOB is job:
+            PREVIEW_JOB = None
+        return None
+
+    # the timer outlives loading another .blend file, whose images are then gone, so the denoise is still cleaned up
+    bpy.app.timers.register(finishpreview, first_interval=PREVIEW_POLL_SECONDS, persistent=True)
+
+
+@persistent
+def cancelpreview(placeholder=None):
+    """Cancels the background denoise of a progressive denoise, leaving its proxy preview in the D-NOISE Export"""
+    if PREVIEW_JOB is not None:
+        PREVIEW_JOB.cancel()
+
+
+def getsourcestate(image):
+    """Returns what changes when an image is replaced, reloaded or painted on, None once it is removed"""
+    try:
+        path = bpy.path.abspath(image.filepath)
+        modified = os.path.getmtime(path) if image.source == 'FILE' and os.path.isfile(path) else None
+        return image.name, path, modified, tuple(image.size), image.is_dirty
+    except ReferenceError:
+        return None
 
 
 def runpostanimdenoiser():
     """Run the OptiX beauty denoiser from the movie clip editor"""
+    global DENOISE_SOURCE
+    orig_directory = os.path.dirname(bpy.path.abspath(DENOISE_SOURCE.filepath))
+    hdr = optix.gethdr()
+    blend = optix.getblend()
+    # every GPU gets at least one frame at a time
+    jobs = max(bpy.context.scene.DNOISEJobs, len(optix.getdevices()))
+    backend = optix.getbackend(jobs)
+    denoise_cache = fmutils.getcache()
+
+    job = timing.Job(orig_directory, on_progress=lambda job: fmutils.forceUIUpdate("IMAGE_EDITOR"))
 
     def denoiseanim():
-        global DENOISE_SOURCE, SCRIPT_DIR, FORMAT_EXTENSIONS, SEQUENCE_TEXT
-        orig_directory = fmutils.truncate(DENOISE_SOURCE.filepath)
-        os.chdir(orig_directory)
-        if not os.path.isdir("D-NOISE Export"):
-            os.mkdir(os.path.join(orig_directory, "D-NOISE Export"))
-        files = sorted(os.listdir())
-        imagefiles = []
-
-        for filename in files:
-            if fmutils.truncateext(filename) in FORMAT_EXTENSIONS.values():
-                imagefiles.append(filename)
-
-        sequencelength = len(imagefiles)
-        sequenceprogress = 0
-
-        for filename in imagefiles:
-            shutil.copyfile(os.path.join(orig_directory, filename), os.path.join(SCRIPT_DIR, filename))
-            optix.beautydenoise(SCRIPT_DIR, filename, optix.gethdr(), optix.getblend())
-            shutil.copyfile(os.path.join(SCRIPT_DIR, filename),
-                            os.path.join(os.path.join(orig_directory, "D-NOISE Export"), filename))
-            fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
-            sequenceprogress += 1
-            SEQUENCE_TEXT = "D-NOISE-ing Sequence... ({0}/{1})".format(sequenceprogress, sequencelength)
-            fmutils.forceUIUpdate("IMAGE_EDITOR")
-
-        if sequenceprogress == sequencelength:
-            SEQUENCE_TEXT = "D-NOISE Sequence"
-
-    t = threading.Thread(target=denoiseanim)
-    t.start()
+        sequence.denoisesequence(orig_directory, backend, hdr, blend, jobs, denoise_cache=denoise_cache, job=job)
+
+        if denoise_cache is not None:
+            print(">> D-NOISE: cache {0}".format(denoise_cache.stats()))
+        for stats in backend.stats():
+            print(">> D-NOISE: {0}".format(worker.describedevice(stats)))
+
+    # sequences run one after another in the background, behind any image denoised on demand
+    optix.getjobqueue().submit(job, denoiseanim)
+
+
+def getsequencetext():
+    """Returns the label of the sequence button, with the progress of the running sequence"""
+    # the draw code must not start the job queue just to find it empty
+    queued_jobs = optix.JOB_QUEUE.jobs() if optix.JOB_QUEUE is not None else []
+
+    if not queued_jobs:
+        return "D-NOISE Sequence"
+
+    text = "D-NOISE-ing Sequence... {0}".format(queued_jobs[0].describe())
+    if len(queued_jobs) > 1:
+        text += " +{0} queued".format(len(queued_jobs) - 1)
+    return text
 
 
 def runrenderdenoiser(placeholder=None):
     """Run the OptiX denoiser after a render completes"""
-    global DENOISE_SOURCE, SCRIPT_DIR, FORMAT_EXTENSIONS
+    global DENOISE_SOURCE, FORMAT_EXTENSIONS
+    DENOISE_SOURCE = bpy.data.images['Render Result']
+    job = timing.Job('render')
+    job.start(1)
+    timer = job.frame(bpy.context.scene.frame_current)
+    scratch_dir = fmutils.makescratch()
+    status = 'failed'
+
+    try:
+        # the render is handed to the denoiser losslessly, whatever format the user saves it in, and
+        # getextension switches the scene to PNG output if D-NOISE cannot read its format
+        fmutils.getextension(bpy.context.scene.render.image_settings.file_format, FORMAT_EXTENSIONS)
+        file_format = fmutils.gethandoffformat(bpy.context.scene.render.image_settings.file_format, optix.gethdr())
+        source_name = 'source.{0}'.format(FORMAT_EXTENSIONS[file_format])
+
+        source_path = os.path.join(scratch_dir, source_name)
+
+        with timer.stage('save'):
+            fmutils.saverender(scratch_dir, source_name, DENOISE_SOURCE, file_format)
+        with timer.stage('load'):
+            source_pixels, width, height = fmutils.readpixels(source_path)
+
+        # a render border or transparent film limits the denoise to the part of the frame with anything in it, and
+        # the frame is then pasted together as EXR so the part outside keeps its full precision
+        box = optix.getroi([source_pixels.reshape(height, width, 4)], width, height, bpy.context.scene)
+        output_extension = '.exr' if box is not None else os.path.splitext(source_name)[1]
+        output_path = os.path.join(scratch_dir, 'denoised' + output_extension)
+
+        optix.denoise(source_path, output_path, blend=0, timer=timer, box=box)
+        with timer.stage('load'):
+            # a failed denoise leaves the render showing, as when the denoiser overwrote it in place
+            denoised = fmutils.readpixels(output_path)[0] if os.path.isfile(output_path) else source_pixels
+            setexport(denoised, source_pixels, width, height, file_format)
+        fmutils.setactiveimage('D-NOISE Export')
+        status = 'done'
+    finally:
+        with timer.stage('cleanup'):
+            fmutils.removescratch(scratch_dir)
+        timer.finish(status)
+        job.finish()
+
+
+def runanimdenoiser(scene=None):
+    """Queue the OptiX denoiser for a frame written while rendering an animation"""
+    global DENOISE_SOURCE, ANIMATION_QUEUE, ANIMATION_JOB, ANIMATION_ROI
     DENOISE_SOURCE = bpy.data.images['Render Result']
 
-    file_format = bpy.context.scene.render.image_settings.file_format
-    file_extension = fmutils.getextension(file_format, FORMAT_EXTENSIONS)
-    source_name = 'source.{0}'.format(file_extension)
+    # the render_write handler receives the scene whose frame was just written
+    if scene is None:
+        scene = bpy.context.scene
+
+    # earlier frames denoised in a region of interest are pasted together here, where bpy may be used
+    pasteframes()
+
+    frame_paths = fmutils.getframepaths(scene)
+    hdr = optix.gethdr()
+    blend = optix.getblend()
+    backend = optix.getbackend()
+    memory = optix.getrendermemory(scene)
+
+    # the animation is logged next to its frames
+    if ANIMATION_JOB is None:
+        ANIMATION_JOB = timing.Job('animation', os.path.join(os.path.dirname(frame_paths[0][1]), timing.LOG_NAME),
+                                   updateanimprogress)
+        ANIMATION_JOB.start(len(range(scene.frame_start, scene.frame_end + 1, scene.frame_step)))
+
+    timer = ANIMATION_JOB.frame(os.path.basename(frame_paths[0][1]))
+    box = optix.getframeroi(scene, frame_paths)
+    scratch_dir = fmutils.makescratch() if scene.EnableExtraPasses or box is not None else None
+
+    # a queued frame removes its own scratch directory, which a failure before then must remove here
+    try:
+        # every view of the frame, and with extra passes every view layer, is denoised in place as one batch
+        if scene.EnableExtraPasses:
+            # the passes are collected now, before the next frame's passes overwrite them
+            with timer.stage('passes'):
+                layer_passes = optix.takepasses(scratch_dir, scene)
+            batch = optix.getbatch(scene, [(view, path, path) for view, path in frame_paths], layer_passes)
+        else:
+            batch = [(path, path, None, None) for view, path in frame_paths]
+
+        # with a region of interest only its crops are denoised in the background, and the frame is pasted
+        # together when the next frame is written or the render completes
+        pastes = None
+        if box is not None:
+            ANIMATION_ROI = True
+            with timer.stage('save'):
+                batch, pastes = optix.cropbatch(batch, box, scratch_dir)
+            memory = denoiser.getmemory(box[2] - box[0], box[3] - box[1])
+
+        def finishframe(cancelled=False):
+            if pastes is not None and not cancelled:
+                with timer.stage('load'):
+                    optix.pastebatch(pastes, box)
+            if scratch_dir is not None:
+                with timer.stage('cleanup'):
+                    fmutils.removescratch(scratch_dir)
+            timer.finish('cancelled' if cancelled else 'done')
+
+        def denoiseframe():
+            with timer.stage('denoise'):
+                optix.batchdenoise(batch, hdr, blend, worker.RENDER, backend, memory)
+            if pastes is None:
+                finishframe()
+            else:
+                ANIMATION_PASTES.append(finishframe)
+
+        if ANIMATION_QUEUE is None:
+            ANIMATION_QUEUE = pipeline.DenoiseQueue(ANIMATION_QUEUE_SIZE)
+
+        # the rendered frame is denoised in place while the next frame renders, and a frame dropped by a cancelled
+        # render still has its scratch directory removed and is reported as cancelled
+        ANIMATION_QUEUE.put(denoiseframe, functools.partial(finishframe, cancelled=True))
+    except Exception:
+        if scratch_dir is not None:
+            fmutils.removescratch(scratch_dir)
+        raise
+
+
+def finishanimdenoiser(placeholder=None):
+    """Let the frames still queued after an animation render finish denoising"""
+    global ANIMATION_QUEUE, ANIMATION_JOB, ANIMATION_ROI
+
+    # frames that must be pasted together here are waited for, the others finish in the background
+    if ANIMATION_QUEUE is not None and ANIMATION_ROI:
+        ANIMATION_QUEUE.finish()
+        ANIMATION_QUEUE.wait()
+        pasteframes()
+        ANIMATION_JOB.finish()
+        ANIMATION_QUEUE = None
+    elif ANIMATION_QUEUE is not None:
+        ANIMATION_QUEUE.put(ANIMATION_JOB.finish)
+        ANIMATION_QUEUE.finish()
+        ANIMATION_QUEUE = None
+    ANIMATION_JOB = None
+    ANIMATION_ROI = False
+
+
+def pasteframes(cancelled=False):
+    """Pastes together the animation frames denoised in a region of interest, or drops them if cancelled"""
+    while ANIMATION_PASTES:
+        ANIMATION_PASTES.popleft()(cancelled)
+
+
+def cancelanimdenoiser(placeholder=None):
+    """Drop the frames still queued when an animation render is cancelled"""
+    global ANIMATION_QUEUE, ANIMATION_JOB, ANIMATION_TEXT, ANIMATION_ROI
+
+    if ANIMATION_QUEUE is not None:
+        ANIMATION_QUEUE.cancel()
+        ANIMATION_QUEUE = None
+    pasteframes(cancelled=True)
+    ANIMATION_ROI = False
+    if ANIMATION_JOB is not None:
+        ANIMATION_JOB.on_progress = None
+        ANIMATION_JOB.finish('cancelled')
+        ANIMATION_JOB = None
+    ANIMATION_TEXT = None
+
+
+def updateanimprogress(job):
+    """Shows how many of the animation's frames have been denoised, how fast and how long the rest will take"""
+    global ANIMATION_TEXT
+
+    if job.finished:
+        ANIMATION_TEXT = None
+    else:
+        ANIMATION_TEXT = "D-NOISE-ing Animation... {0}".format(job.describe())
+    fmutils.forceUIUpdate("IMAGE_EDITOR")
 
-    fmutils.save(SCRIPT_DIR, source_name, DENOISE_SOURCE)
-    optix.denoise(SCRIPT_DIR, source_name)
-    fmutils.load(SCRIPT_DIR, source_name, 'D-NOISE Export')
-    fmutils.setactiveimage('D-NOISE Export')
-    fmutils.setcolorspace('D-NOISE Export', file_format)
-    bpy.data.images['D-NOISE Export'].update()
-    fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
 
+def setexport(denoised, source, width, height, file_format):
+    """Shows an unblended denoised image in the D-NOISE Export, blended with its source by the D-NOISE blend"""
+    global BLEND_BUFFER, BLEND_FORMAT
+    BLEND_BUFFER = blend.BlendBuffer(denoised, source, width, height)
+    BLEND_FORMAT = file_format
+    fmutils.storepixels('D-NOISE Export', BLEND_BUFFER.blend(optix.getblend()), width, height, file_format)
 
-def runanimdenoiser(placeholder=None):
-    """Run the OptiX denoiser while rendering an animation"""
-    global DENOISE_SOURCE, SCRIPT_DIR, FORMAT_EXTENSIONS
-    DENOISE_SOURCE = bpy.data.images['Render Result']
 
-    output_dir = fmutils.fixfilepath(bpy.context.scene.render.filepath)
-    source_name = fmutils.getmostrecent(output_dir)
-    shutil.copyfile(os.path.join(output_dir, source_name), os.path.join(SCRIPT_DIR, source_name))
-    optix.denoise(SCRIPT_DIR, source_name)
-    shutil.copyfile(os.path.join(SCRIPT_DIR, source_name), os.path.join(output_dir, source_name))
-    fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
+def updateblend(self=None, context=None):
+    """Reblends the D-NOISE Export with its source while the D-NOISE blend is changed"""
+    if BLEND_BUFFER is not None and 'D-NOISE Export' in bpy.data.images:
+        fmutils.storepixels('D-NOISE Export', BLEND_BUFFER.blend(optix.getblend()),
+                            BLEND_BUFFER.width, BLEND_BUFFER.height, BLEND_FORMAT)
 
 
 def swaptorender(placeholder=None):
@@ -168,9 +550,13 @@ def togglednoise(self=None, context=None):
     """Toggles the D-NOISE denosier for rendering single frames and animations"""
     if not bpy.context.scene.EnableDNOISE:
         bpy.app.handlers.render_complete.remove(runrenderdenoiser)
+        bpy.app.handlers.render_complete.remove(finishanimdenoiser)
+        bpy.app.handlers.render_cancel.remove(cancelanimdenoiser)
         bpy.app.handlers.render_write.remove(runanimdenoiser)
     else:
         bpy.app.handlers.render_complete.append(runrenderdenoiser)
+        bpy.app.handlers.render_complete.append(finishanimdenoiser)
+        bpy.app.handlers.render_cancel.append(cancelanimdenoiser)
         bpy.app.handlers.render_write.append(runanimdenoiser)
 
 
@@ -181,7 +567,7 @@ def togglenodes(self=None, context=None):
     if bpy.context.scene.EnableExtraPasses:
         fmutils.enablepasses()
         optix.cleannodes()
-        optix.addnodes(SCRIPT_DIR)
+        optix.addnodes(optix.PASSES_DIR)
     else:
         fmutils.disablepasses()
         optix.cleannodes()
@@ -195,12 +581,14 @@ def loaddnoisesettings(placeholder = None):
     if bpy.context.scene.EnableDNOISE:
         bpy.app.handlers.render_init.append(swaptorender)
         bpy.app.handlers.render_complete.append(runrenderdenoiser)
+        bpy.app.handlers.render_complete.append(finishanimdenoiser)
+        bpy.app.handlers.render_cancel.append(cancelanimdenoiser)
         bpy.app.handlers.render_write.append(runanimdenoiser)
 
     if bpy.context.scene.EnableExtraPasses:
         fmutils.enablepasses()
         optix.cleannodes()
-        optix.addnodes(SCRIPT_DIR)
+        optix.addnodes(optix.PASSES_DIR)
 
     else:
         fmutils.disablepasses()
@@ -229,6 +617,23 @@ class QuickDenoise(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class CancelSequence(bpy.types.Operator):
+    bl_idname = "dnoise.cancel_sequence"
+    bl_label = "Cancel D-NOISE Sequence"
+    bl_description = "Stop denoising the running image sequence once the frames being denoised are finished"
+
+    @classmethod
+    def poll(cls, context):
+        return optix.JOB_QUEUE is not None and bool(optix.JOB_QUEUE.jobs())
+
+    def execute(self, context):
+        # the sequence may have finished since the button was drawn
+        queued_jobs = optix.JOB_QUEUE.jobs()
+        if queued_jobs:
+            optix.JOB_QUEUE.cancel(queued_jobs[0])
+        return {'FINISHED'}
+
+
 class ToggleDnoiseExport(bpy.types.Operator):
     bl_idname = "dnoise.toggle_export"
     bl_label = "Toggle D-NOISE Export in 3D Viewport"
@@ -248,6 +653,44 @@ class ToggleDnoiseExport(bpy.types.Operator):
         return {'FINISHED'}
 
 
+class SaveBlendLevels(bpy.types.Operator):
+    bl_idname = "dnoise.save_blend_levels"
+    bl_label = "Save D-NOISE Blend Levels"
+    bl_description = "Save the D-NOISE Export at several blend levels without denoising again"
+
+    levels: bpy.props.StringProperty(
+        name="Blend Levels",
+        description="Comma separated blend levels to save, from 0 to 1.",
+        default="0, 0.25, 0.5, 0.75")
+
+    directory: bpy.props.StringProperty(subtype='DIR_PATH')
+
+    @classmethod
+    def poll(cls, context):
+        return BLEND_BUFFER is not None
+
+    def execute(self, context):
+        global BLEND_FORMAT, FORMAT_EXTENSIONS
+
+        try:
+            levels = [float(level) for level in self.levels.split(',')]
+        except ValueError:
+            self.report({'ERROR'}, "Blend levels must be numbers separated by commas")
+            return {'CANCELLED'}
+
+        for level in levels:
+            filename = 'D-NOISE Blend {0:.2f}.{1}'.format(level, FORMAT_EXTENSIONS[BLEND_FORMAT])
+            fmutils.writepixels(os.path.join(self.directory, filename),
+                                BLEND_BUFFER.blend(min(max(level, 0), 1)),
+                                BLEND_BUFFER.width, BLEND_BUFFER.height, BLEND_FORMAT)
+
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
 class InstallOptiXBinaries(bpy.types.Operator):
     bl_idname = "dnoise.install_binaries"
     bl_label = "This will download a 243MB file. Continue?"
@@ -275,7 +718,9 @@ class RemoveOptiXBinaries(bpy.types.Operator):
 
     def execute(self, context):
         global SCRIPT_DIR
+        urlutils.cancelbin()
         fmutils.removeoptixbin(SCRIPT_DIR)
+        urlutils.probeinstalled()
         return {'FINISHED'}
 
     def invoke(self,context,event):
@@ -300,20 +745,97 @@ class DNOISEPanel(bpy.types.Panel):
         row.prop(bpy.context.scene, "EnableExtraPasses", text="Use Extra Passes")
         row = layout.row()
         row.prop(bpy.context.scene, "DNOISEBlend", text="D-NOISE Blend", slider=True)
+        row = layout.row()
+        row.prop(bpy.context.scene, "DNOISEJobs", text="Sequence Jobs")
+        drawbackendwarning(layout)
 
 
 class DNOISEPreferences(bpy.types.AddonPreferences):
     bl_idname = __package__
 
+    scratch_dir: bpy.props.StringProperty(
+        name="Scratch Directory",
+        description="The folder where denoise jobs keep their temporary files. Leave empty to use the system temporary folder.",
+        subtype='DIR_PATH')
+
+    use_cache: bpy.props.BoolProperty(
+        name="Cache Denoised Images",
+        description="Reuse earlier results for images that are denoised again with the same inputs and settings.",
+        default=True)
+
+    cache_dir: bpy.props.StringProperty(
+        name="Cache Directory",
+        description="The folder where denoised images are cached. Leave empty to use the system temporary folder.",
+        subtype='DIR_PATH')
+
+    cache_size: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="The most disk space the cache may use before the least recently used images are removed.",
+        default=4096,
+        min=1)
+
+    use_tiling: bpy.props.BoolProperty(
+        name="Tile Large Images",
+        description="Denoise images too large for the tile memory budget in overlapping tiles.",
+        default=False)
+
+    tile_memory: bpy.props.IntProperty(
+        name="Tile Memory (MB)",
+        description="The most memory the denoiser should use at once when denoising an image in tiles.",
+        default=2048,
+        min=64)
+
+    use_roi: bpy.props.BoolProperty(
+        name="Denoise Regions of Interest",
+        description="Only denoise the part of a render inside its render border, and of an image with a transparent background the part with anything in it, when that part is enough smaller than the whole image.",
+        default=True)
+
+    use_progressive: bpy.props.BoolProperty(
+        name="Progressive Quick D-NOISE",
+        description="Show large images denoised from a smaller copy at once, while the full resolution image is denoised in the background.",
+        default=True)
+
+    backend: bpy.props.EnumProperty(
+        name="Denoiser",
+        description="The denoiser that D-NOISE runs.",
+        items=[('OPTIX', "NVIDIA OptiX", "NVIDIA's AI denoiser, which needs an NVIDIA GPU and the OptiX binaries"),
+               ('CPU', "CPU", "An edge-avoiding filter that runs on any CPU, which needs the imageio Python package with OpenEXR support")],
+        default='OPTIX')
+
+    devices: bpy.props.StringProperty(
+        name="GPUs",
+        description="CUDA device numbers of the GPUs to run an OptiX denoiser on each, e.g. 0, 1. Each may be followed by a colon and the megabytes the denoiser may use on it, e.g. 0:8192, 1:4096. Leave empty to use the default GPU.",
+        default="")
+
     def draw(self,context):
         global CUSTOM_ICONS
         
         layout = self.layout
+        layout.prop(self, "scratch_dir")
+        layout.prop(self, "use_cache")
+        if self.use_cache:
+            layout.prop(self, "cache_dir")
+            layout.prop(self, "cache_size")
+            if fmutils.CACHE is not None:
+                layout.label(text="Cache: {0}".format(fmutils.CACHE.stats()))
+        layout.prop(self, "use_tiling")
+        if self.use_tiling:
+            layout.prop(self, "tile_memory")
+        layout.prop(self, "use_roi")
+        layout.prop(self, "use_progressive")
+        layout.prop(self, "backend")
+        drawbackendwarning(layout)
+        if self.backend == 'OPTIX':
+            layout.prop(self, "devices")
+            # the draw code must not start the workers just to show that they have done nothing
+            if self.devices and optix.WORKERS is not None:
+                for stats in optix.WORKERS.stats():
+                    layout.label(text=worker.describedevice(stats))
         row = layout.row()
         row.scale_y = 1.5
 
         # IN THE PROCESS OF INSTALLATION
-        if os.path.exists("DNOISE_OptiXBinaries.zip"):
+        if urlutils.PROGRESS.isactive():
             row.operator("dnoise.remove_binaries",
                          text="Remove OptiX Binaries",
                          icon="X")
@@ -321,8 +843,12 @@ class DNOISEPreferences(bpy.types.AddonPreferences):
             row.label(icon='SETTINGS',
                       text="Installing OptiX binaries... {:.1f}%".format(urlutils.getprogress()))
 
+        # NOT CHECKED YET, the install state is checked in the background after registering
+        elif urlutils.isinstalled() is None:
+            row.label(icon='SETTINGS', text="Checking for OptiX binaries...")
+
         # BINARIES ARE NOT INSTALLED
-        elif not (os.path.exists("OptixDenoiser//Denoiser.exe")):
+        elif not urlutils.isinstalled():
             row.operator("dnoise.install_binaries",
                          text="Install OptiX Binaries",
                          icon_value=CUSTOM_ICONS['dnoise_icon'].icon_id)
@@ -350,6 +876,14 @@ class DNOISEPreferences(bpy.types.AddonPreferences):
 #
 
 
+def drawbackendwarning(layout):
+    """UI code that shows what the chosen CPU denoiser is missing, while OptiX denoises in its place"""
+    # OpenEXR support is probed in the background after registering, and only a failed probe is shown
+    if fmutils.getpreferences().backend == 'CPU' and backends.EXR_SUPPORT is False:
+        layout.label(icon='ERROR', text="The CPU denoiser needs {0} installed in Blender, OptiX denoises "
+                                        "instead".format(backends.CPU_REQUIREMENTS))
+
+
 def appendto_image_ht_header(self, context):
     """UI code to append to the IMAGE_HT_HEADER space"""
     global CUSTOM_ICONS
@@ -357,21 +891,21 @@ def appendto_image_ht_header(self, context):
     layout.separator()
     row = layout.row(align=True)
 
+    if ANIMATION_TEXT is not None:
+        row.label(text=ANIMATION_TEXT, icon_value=CUSTOM_ICONS['dnoise_icon'].icon_id)
+
     if bpy.context.space_data.image is not None:
         if bpy.context.space_data.image.source == 'SEQUENCE':
             row.operator(
                 "dnoise.quick_denoise",
-                text=SEQUENCE_TEXT,
+                text=getsequencetext(),
                 icon_value=CUSTOM_ICONS['dnoise_icon'].icon_id)
 
-            # for implementing a cancel operation while denoising image sequences
-            """
-            if SEQUENCE_TEXT != 'D-NOISE Sequence':
+            if optix.JOB_QUEUE is not None and optix.JOB_QUEUE.jobs():
                 row.operator(
-                    "dnoise.quick_denoise",
+                    "dnoise.cancel_sequence",
                     text="",
                     icon='CANCEL')
-            """
 
         else:
             row.operator(
@@ -381,6 +915,7 @@ def appendto_image_ht_header(self, context):
 
         if bpy.context.space_data.image.name == 'D-NOISE Export':
             row.operator("dnoise.toggle_export", text="", icon="RESTRICT_VIEW_OFF")
+            row.operator("dnoise.save_blend_levels", text="", icon="EXPORT")
         else:
             row.operator("dnoise.toggle_export", text="", icon="RESTRICT_VIEW_ON")
 
@@ -389,7 +924,9 @@ def appendto_image_ht_header(self, context):
 #
 
 classes = (QuickDenoise,
+           CancelSequence,
            ToggleDnoiseExport,
+           SaveBlendLevels,
            InstallOptiXBinaries,
            RemoveOptiXBinaries,
            DNOISEPanel,
@@ -402,8 +939,9 @@ def register():
     for cls in classes:
         register_class(cls)
 
-    # append app handlers
+    # append app handlers, a render replaces the Render Result any progressive denoise may have been started for
     bpy.app.handlers.load_post.append(loaddnoisesettings)
+    bpy.app.handlers.render_init.append(cancelpreview)
 
     # register properties
     bpy.types.Scene.EnableDNOISE = bpy.props.BoolProperty(
@@ -418,11 +956,18 @@ def register():
         description="Enabling extra passes will help maintain fine detail in texures, but may cause artifacts.")
 
     bpy.types.Scene.DNOISEBlend = bpy.props.FloatProperty(
+        update=updateblend,
         description='Blend the denoised image with the undenoised image. A value of 1 will show the undenoised image.',
         default=0,
         min=0,
         max=1)
 
+    bpy.types.Scene.DNOISEJobs = bpy.props.IntProperty(
+        description='The number of frames of an image sequence to denoise at the same time.',
+        default=1,
+        min=1,
+        max=16)
+
     #for implementing a custom filepath for optix binaries
     """
     bpy.types.Scene.OptiXBinaryFilepath = bpy.props.StringProperty(
@@ -440,8 +985,16 @@ def register():
     # register UI implementations
     bpy.types.IMAGE_HT_header.append(appendto_image_ht_header)
 
-    # clean out any past files from the script directory
+    # registering touches no files, the install check and the cleanup run in the background
+    threading.Thread(target=startupchores, daemon=True).start()
+
+
+def startupchores():
+    """Checks the OptiX binaries and OpenEXR support and cleans out any past files from the script directory"""
+    urlutils.probeinstalled()
+    backends.isavailable('cpu')
     fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
+    fmutils.removescratch(optix.PASSES_DIR)
 
 
 def unregister():
@@ -452,10 +1005,17 @@ def unregister():
     # remove app handlers
     if loaddnoisesettings in bpy.app.handlers.load_post:
         bpy.app.handlers.load_post.remove(loaddnoisesettings)
+    if cancelpreview in bpy.app.handlers.render_init:
+        bpy.app.handlers.render_init.remove(cancelpreview)
+    cancelpreview()
 
     # clean out any past files from the script directory
     global SCRIPT_DIR, FORMAT_EXTENSIONS
     fmutils.deepclean(SCRIPT_DIR, FORMAT_EXTENSIONS)
+    fmutils.removescratch(optix.PASSES_DIR)
+
+    # stop the denoiser workers
+    optix.stopworkers()
 
     # remove nodes
     if bpy.context.scene.EnableExtraPasses:
@@ -479,3 +1039,9 @@ def unregister():
     if runanimdenoiser in bpy.app.handlers.render_complete:
         bpy.app.handlers.render_complete.remove(runanimdenoiser)
 
+    if finishanimdenoiser in bpy.app.handlers.render_complete:
+        bpy.app.handlers.render_complete.remove(finishanimdenoiser)
+
+    if cancelanimdenoiser in bpy.app.handlers.render_cancel:
+        bpy.app.handlers.render_cancel.remove(cancelanimdenoiser)
+
@@ -0,0 +1,22 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# The D-NOISE core. Nothing in this package may import bpy: it is shared by the Blender add-on
+# and the command line interface, python -m dnoise, that runs on machines without Blender.
@@ -0,0 +1,131 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import argparse
+import os
+import sys
+from . import backends, cache, denoiser, farm, sequence, worker
+
+
+def printprogress(job):
+    """Prints how many frames of the sequence have been denoised, how fast and how long the rest will take"""
+    print("D-NOISE-ing Sequence... {0}".format(job.describe()), file=sys.stderr)
+
+
+def parsedevices(text):
+    """Returns the devices listed in a --devices argument"""
+    try:
+        return denoiser.parsedevices(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def getextensions(*directories):
+    """Returns the extensions of the images in the given directories, skipping those that are None or missing"""
+    return {os.path.splitext(filename)[1].lower() for directory in directories
+            if directory is not None and os.path.isdir(directory)
+            for filename in sequence.findframes(directory)}
+
+
+def main(argv=None):
+    """Denoises an image sequence from the command line and returns the exit status"""
+    parser = argparse.ArgumentParser(prog="python -m dnoise",
+                                     description="Denoise an image sequence into its D-NOISE Export folder.")
+    parser.add_argument('directory',
+                        help="folder containing the image sequence")
+    parser.add_argument('--hdr', action='store_true',
+                        help="use the HDR training data")
+    parser.add_argument('--blend', type=float, default=0,
+                        help="blend the denoised images with the originals, 1 keeps the originals")
+    parser.add_argument('--jobs', type=int,
+                        help="number of frames to denoise at the same time, by default 1 or one per device")
+    parser.add_argument('--passes', metavar='DIR',
+                        help="folder of screen space Normal and Albedo passes, matched to frames by frame number")
+    parser.add_argument('--backend', choices=('optix', 'cpu'), default='optix',
+                        help="denoise with NVIDIA OptiX, or with a filter on the CPU that needs the imageio package")
+    parser.add_argument('--denoiser', default=denoiser.DENOISER_PATH,
+                        help="path to the OptiX denoiser executable")
+    parser.add_argument('--devices', type=parsedevices, default=[], metavar='LIST',
+                        help="CUDA devices to run an OptiX denoiser on each, each optionally followed by the megabytes "
+                             "it may use on that device, e.g. 0,1:8192")
+    parser.add_argument('--farm', action='store_true',
+                        help="share the sequence with every other node run with --farm on it, e.g. from a shared drive")
+    parser.add_argument('--node', metavar='NAME',
+                        help="name of this node in a farm, unique among the nodes, by default the host name and process id")
+    parser.add_argument('--lease-seconds', type=float, default=farm.LEASE_SECONDS, metavar='SECONDS',
+                        help="seconds after which the frames of a farm node that stopped are denoised by another")
+    parser.add_argument('--cache', metavar='DIR',
+                        help="folder to cache denoised frames in")
+    parser.add_argument('--cache-size', type=int, default=4096, metavar='MB',
+                        help="most disk space the cache may use")
+    args = parser.parse_args(argv)
+    # the denoiser runs in the add-on's directory, so relative paths would not find the frames
+    args.directory = os.path.abspath(args.directory)
+    if args.passes is not None:
+        args.passes = os.path.abspath(args.passes)
+
+    if not 0 <= args.blend <= 1:
+        parser.error("--blend must be between 0 and 1")
+    if args.jobs is None:
+        args.jobs = max(1, len(args.devices))
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.devices and args.backend != 'optix':
+        parser.error("--devices only applies to the optix backend")
+    if args.lease_seconds <= 0:
+        parser.error("--lease-seconds must be above 0")
+
+    denoise_cache = cache.DenoiseCache(args.cache, args.cache_size * 1048576) if args.cache else None
+    # OpenEXR support is only needed, and only checked for, if the sequence or its passes are OpenEXR images
+    extensions = getextensions(args.directory, args.passes)
+    if not backends.isavailable(args.backend, extensions):
+        parser.error("the {0} backend needs {1}".format(args.backend, backends.getrequirements(extensions)))
+
+    backend = backends.makebackend(args.backend, args.denoiser, args.jobs, devices=args.devices, extensions=extensions)
+    leases = None
+    if args.farm:
+        leases = farm.Leases(os.path.join(args.directory, sequence.EXPORT_DIR_NAME), args.node, args.lease_seconds)
+
+    try:
+        failed = sequence.denoisesequence(args.directory, backend,
+                                          hdr=1 if args.hdr else 0,
+                                          blend=args.blend,
+                                          jobs=args.jobs,
+                                          passes_dir=args.passes,
+                                          denoise_cache=denoise_cache,
+                                          on_progress=printprogress,
+                                          leases=leases)
+        if args.devices:
+            for stats in backend.stats():
+                print("D-NOISE {0}".format(worker.describedevice(stats)), file=sys.stderr)
+    finally:
+        backend.stop()
+
+    if denoise_cache is not None:
+        print("D-NOISE cache: {0}".format(denoise_cache.stats()), file=sys.stderr)
+
+    for filename in failed:
+        print(">> D-NOISE ERROR: failed to denoise {0}".format(filename), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
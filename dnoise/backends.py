@@ -0,0 +1,210 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# A backend denoises batches of (source, output, normal, albedo) image files, where the normal and albedo
+# guides are each optional, and returns one exit code per image, 0 for success, like the denoiser
+# executable does. OptiX runs NVIDIA's denoiser through the worker processes; the CPU backend runs
+# dnoise.cpu in this process and needs the optional imageio package to read and write image files, with a
+# plugin that handles OpenEXR for EXR images, which the add-on saves its passes, tiles and crops as.
+# memory is the most bytes one image of a batch needs on the device, or 0 if it is not known, see
+# denoiser.getmemory.
+
+import os
+import sys
+import warnings
+import numpy as np
+from . import cpu, denoiser, worker
+
+try:
+    import imageio.v3 as imageio
+except ImportError:
+    imageio = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# image formats the CPU backend writes as floating point, all others are written as 8 or 16 bit integers
+FLOAT_EXTENSIONS = {'.exr', '.hdr'}
+
+# whether imageio can write an OpenEXR image and read it back, None until hasexr has checked
+EXR_SUPPORT = None
+
+# extension of the OpenEXR images the add-on saves its passes, tiles and crops as
+EXR_EXTENSION = '.exr'
+
+# what the CPU backend needs installed for OpenEXR images and for all others, as shown to the user when it is missing
+CPU_REQUIREMENTS = ("the imageio package with a plugin that reads and writes OpenEXR, such as OpenCV 4 with "
+                    "OPENCV_IO_ENABLE_OPENEXR=1 set")
+IMAGEIO_REQUIREMENTS = "the imageio package"
+
+
+class Backend:
+    """A way of denoising image files"""
+
+    name = None
+
+    def denoisebatch(self, batch, hdr=0, blend=0, priority=worker.BACKGROUND, memory=0):
+        """Denoises a batch of (source, output, normal, albedo) images and returns their exit codes"""
+        raise NotImplementedError
+
+    def denoise(self, source_path, output_path, normal_path=None, albedo_path=None, hdr=0, blend=0,
+                priority=worker.BACKGROUND, memory=0):
+        """Denoises one image and returns its exit code"""
+        return self.denoisebatch([(source_path, output_path, normal_path, albedo_path)], hdr, blend, priority,
+                                 memory)[0]
+
+    def stats(self):
+        """Returns the throughput of each device the backend runs on, as worker.Device.stats does"""
+        return []
+
+    def stop(self):
+        """Releases whatever the backend keeps running between batches"""
+
+
+class OptixBackend(Backend):
+    """NVIDIA's OptiX denoiser, run by a pool of worker processes"""
+
+    name = 'optix'
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def denoisebatch(self, batch, hdr=0, blend=0, priority=worker.BACKGROUND, memory=0):
+        return denoiser.denoisebatch(self.pool, batch, hdr, blend, priority, memory)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def stop(self):
+        self.pool.stop()
+
+
+class CPUBackend(Backend):
+    """The edge-avoiding filter of dnoise.cpu, run on this machine's CPU cores"""
+
+    name = 'cpu'
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def denoisebatch(self, batch, hdr=0, blend=0, priority=worker.BACKGROUND, memory=0):
+        # the filter has no HDR mode of its own, it always measures color differences on tonemapped color
+        returncodes = []
+        for source_path, output_path, normal_path, albedo_path in batch:
+            try:
+                beauty, dtype = readimage(source_path)
+                albedo = readimage(albedo_path)[0] if albedo_path is not None else None
+                normal = readimage(normal_path)[0] if normal_path is not None else None
+                writeimage(output_path, cpu.filterimage(beauty, albedo, normal, blend, self.threads), dtype)
+                returncodes.append(0)
+            except Exception as error:
+                print(">> D-NOISE ERROR: CPU denoiser failed on {0}: {1}".format(source_path, error))
+                returncodes.append(1)
+        return returncodes
+
+
+def isavailable(name, extensions=(EXR_EXTENSION,)):
+    """Returns true if the named backend can run on this machine on images with the given extensions"""
+    if name == 'cpu':
+        # imageio's default plugin reads and writes PNG, JPEG and TIFF, only OpenEXR needs a plugin of its own
+        if imageio is None:
+            return False
+        return not hasexrextension(extensions) or hasexr()
+    return name == 'optix'
+
+
+def hasexrextension(extensions):
+    """Returns true if any of the given extensions is that of an OpenEXR image"""
+    return any(extension.lower() == EXR_EXTENSION for extension in extensions)
+
+
+def getrequirements(extensions=(EXR_EXTENSION,)):
+    """Returns what the CPU backend needs installed for images with the given extensions"""
+    return CPU_REQUIREMENTS if hasexrextension(extensions) else IMAGEIO_REQUIREMENTS
+
+
+def hasexr():
+    """Returns true if imageio can write an OpenEXR image and read it back unchanged"""
+    global EXR_SUPPORT
+
+    # imageio's default Pillow plugin has no OpenEXR support, and others may read it back as 8 bit color, which
+    # only shows once an image is written and read, and without imageio at all the probe fails as well
+    if EXR_SUPPORT is None:
+        pixels = np.array([[[2.5, 0.25, 0, 0.5]]], np.float32)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                encoded = writeimage('<bytes>', pixels, np.float32, '.exr')
+                EXR_SUPPORT = bool(np.allclose(readimage(encoded, '.exr')[0], pixels, atol=1e-3))
+        except Exception:
+            EXR_SUPPORT = False
+    return EXR_SUPPORT
+
+
+def makebackend(name, denoiser_path=denoiser.DENOISER_PATH, jobs=1, python=sys.executable, devices=None,
+                extensions=(EXR_EXTENSION,)):
+    """Returns the named backend, 'optix' or 'cpu', with room for the given number of images at a time"""
+    if name == 'cpu':
+        if not isavailable('cpu', extensions):
+            raise RuntimeError("the CPU denoiser needs {0}".format(getrequirements(extensions)))
+        # the cores are shared between the images denoised at the same time
+        return CPUBackend(max(1, (os.cpu_count() or 1) // jobs))
+    if name == 'optix':
+        return OptixBackend(denoiser.makepool(denoiser_path, jobs, python, devices))
+    raise ValueError("unknown denoiser backend {0}".format(name))
+
+
+def getreadoptions(extension):
+    """Returns the imageio options that read an image file with the given extension at its full precision"""
+    # imageio's OpenCV plugin reads OpenEXR as 8 bit color without alpha unless told to leave it unchanged
+    if extension.lower() in FLOAT_EXTENSIONS and cv2 is not None:
+        return {'plugin': 'opencv', 'flags': cv2.IMREAD_UNCHANGED}
+    return {}
+
+
+def readimage(path, extension=None):
+    """Returns the (h, w, 4) float32 pixels of an image file or its bytes, and the data type they were stored in"""
+    extension = extension or os.path.splitext(path)[1]
+    pixels = imageio.imread(path, extension=extension, **getreadoptions(extension))
+    dtype = pixels.dtype
+
+    if np.issubdtype(dtype, np.integer):
+        pixels = pixels.astype(np.float32) / np.iinfo(dtype).max
+    else:
+        pixels = pixels.astype(np.float32)
+
+    if pixels.ndim == 2:
+        pixels = pixels[..., np.newaxis]
+    if pixels.shape[2] < 3:
+        pixels = np.repeat(pixels[..., :1], 3, axis=2)
+    if pixels.shape[2] == 3:
+        pixels = np.concatenate([pixels, np.ones(pixels.shape[:2] + (1,), dtype=np.float32)], axis=2)
+    return pixels, dtype
+
+
+def writeimage(path, pixels, dtype, extension=None):
+    """Writes (h, w, 4) float32 pixels to an image file in the given data type, or returns its bytes"""
+    extension = extension or os.path.splitext(path)[1]
+    if extension.lower() not in FLOAT_EXTENSIONS and np.issubdtype(dtype, np.integer):
+        pixels = np.round(np.clip(pixels, 0, 1) * np.iinfo(dtype).max).astype(dtype)
+
+    return imageio.imwrite(path, pixels, extension=extension)
@@ -0,0 +1,642 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Measures the time D-NOISE spends on its own plumbing around the denoiser: worker round trips, frame
+# scheduling, manifest and cache bookkeeping, normal conversion, tile stitching, proxy scaling and
+# blending. The real denoiser is replaced by a stub that copies its input to its output, so whatever
+# time remains is overhead. The devices stage instead gives the stub a different speed on each simulated GPU, to show
+# how the worker pool shares a sequence between devices, and the farm stage runs several command line
+# processes on the sequence at once, like the nodes of a render farm. The render, animrender, postanim and
+# outputdir stages run the add-on's own handlers in the stand-in Blender of tests/fakebpy.py, so the saving, loading,
+# cropping, pasting and pass handling they do around the denoiser is measured too, though with imageio's image
+# encoding in place of Blender's. Their stages that need OpenEXR are left out where imageio cannot write it. The
+# outputdir stage renders into folders already holding more and more frames, where the animation handler's own
+# time per frame must stay flat. Run it from the add-on folder on Linux, e.g.
+#   python -m dnoise.bench --frames 10 100 1000 --resolutions 1280x720 1920x1080 --output bench.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from . import (backends, blend, cache, cpu, denoiser, layers, normals, pipeline, proxy, roi, sequence, tiles, timing,
+               worker)
+
+try:
+    import mathutils
+except ImportError:
+    mathutils = None
+
+# stages run when none are asked for
+STAGES = ('spawn', 'sequence', 'resume', 'cache', 'animation', 'devices', 'farm', 'render', 'animrender', 'postanim',
+          'outputdir', 'normals', 'normalsloop', 'tiles', 'roi', 'proxy', 'blend', 'cpu')
+
+# stages that only work on pixels in memory
+MEMORY_STAGES = {'normals', 'normalsloop', 'tiles', 'roi', 'proxy', 'blend', 'cpu'}
+
+# stages that run the add-on's handlers
+ADDON_STAGES = {'render', 'animrender', 'postanim', 'outputdir'}
+
+# most frames the in-memory stages are repeated for, since their cost does not depend on the sequence length
+MEMORY_FRAMES = 10
+
+# seconds the stub takes per image on the fastest simulated device of the devices stage, each further device
+# taking twice as long as the one before
+DEVICE_DELAY = 0.02
+
+# simulated devices of the devices stage
+DEVICE_COUNT = 3
+
+# command line processes of the farm stage
+FARM_NODES = 3
+
+# side of the square of random pixels the frames are tiled with, which keeps them quick to encode
+PATCH_SIZE = 64
+
+# render border of the stages that denoise a region of interest, as (min x, min y, max x, max y)
+ROI_BORDER = (0.25, 0.25, 0.75, 0.75)
+
+# files already in the output folder of each run of the outputdir stage
+OUTPUT_DIR_FILES = (100, 1000, 10000)
+
+# the add-on, registered in a stand-in Blender on first use
+ADDON = None
+
+# folder of the tests, which holds the stand-in Blender the add-on stages run in
+TESTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests')
+
+# denoiser stand-in that copies the image given by -i to the path given by -o
+STUB_DENOISER = '''#!{python}
+import json
+import os
+import shutil
+import sys
+import time
+args = sys.argv[1:]
+delays = os.environ.get('DNOISE_STUB_DELAYS')
+if delays:
+    time.sleep(json.loads(delays).get(os.environ.get('CUDA_VISIBLE_DEVICES'), 0))
+source_path, output_path = args[args.index('-i') + 1], args[args.index('-o') + 1]
+if source_path != output_path:
+    shutil.copyfile(source_path, output_path)
+'''
+
+
+def readio(pid='self'):
+    """Returns the I/O counters of a process from /proc, or an empty dict where they are not available"""
+    try:
+        with open('/proc/{0}/io'.format(pid)) as io_file:
+            return {name: int(value) for name, value in (line.split(':') for line in io_file)}
+    except (OSError, ValueError):
+        return {}
+
+
+def workerpids(pool):
+    """Returns the process ids of the running workers of a pool"""
+    return [pool_worker.process.pid for pool_worker in pool.workers if pool_worker.isalive()]
+
+
+def resetpeak():
+    """Resets the peak memory of this process, returning false where the kernel cannot"""
+    # writing 5 to clear_refs resets VmHWM on Linux 4.0 and newer
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_file:
+            clear_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def readmemory(field):
+    """Returns a memory field of this process from /proc in kB, VmRSS now or VmHWM at its peak, or None"""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Measurement:
+    """Wall time, I/O volume and peak memory of one benchmark stage, covering this process and the given workers"""
+
+    def __init__(self, pool=None, events=timing):
+        self.pool = pool
+        # the timing module whose frame events are summed, since the add-on imports its own copy of this package
+        self.events = events
+        # seconds each frame spent in each of its timed stages, summed over the frames
+        self.stages = {}
+
+    def snapshot(self):
+        counters = readio()
+        if self.pool is not None:
+            for pid in workerpids(self.pool):
+                for name, value in readio(pid).items():
+                    counters['worker_' + name] = counters.get('worker_' + name, 0) + value
+        return counters
+
+    def onevent(self, event):
+        if event['event'] == 'frame':
+            for stage, seconds in event['stages'].items():
+                self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def __enter__(self):
+        # the peak is only the stage's own where it can be reset, the process' peak so far would hide it
+        self.resettable = resetpeak()
+        self.start_rss_kb = readmemory('VmRSS')
+        self.events.addhook(self.onevent)
+        self.io = self.snapshot()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        # workers started during the stage count from zero
+        self.io = {name: value - self.io.get(name, 0) for name, value in self.snapshot().items()}
+        self.peak_rss_kb = readmemory('VmHWM') if self.resettable else None
+        self.events.removehook(self.onevent)
+
+    def result(self, stage, frames, width, height, jobs):
+        return {'stage': stage,
+                'frames': frames,
+                'width': width,
+                'height': height,
+                'jobs': jobs,
+                'seconds': round(self.seconds, 6),
+                'ms_per_frame': round(1000 * self.seconds / max(frames, 1), 4),
+                'io': self.io,
+                'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+                'start_rss_kb': self.start_rss_kb,
+                'peak_rss_kb': self.peak_rss_kb}
+
+
+def makestub(directory):
+    """Writes the stub denoiser to a directory and returns its path"""
+    stub_path = os.path.join(directory, 'stub_denoiser.py')
+    with open(stub_path, 'w') as stub_file:
+        stub_file.write(STUB_DENOISER.format(python=sys.executable))
+    os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IXUSR)
+    return stub_path
+
+
+def makepixels(width, height):
+    """Returns (height, width, 4) float32 pixels of random colors, tiled from a small square so they compress well"""
+    patch = np.random.default_rng(0).random((PATCH_SIZE, PATCH_SIZE, 4), dtype=np.float32)
+    return np.tile(patch, (height // PATCH_SIZE + 1, width // PATCH_SIZE + 1, 1))[:height, :width]
+
+
+def makesequence(directory, frames, width, height):
+    """Writes a synthetic sequence of 8 bit RGBA PNG frames, each with different contents so none share a cache entry"""
+    os.makedirs(directory)
+    pixels = makepixels(width, height)
+    for frame in range(1, frames + 1):
+        # the frame number is written into the first row, one bit a pixel
+        pixels[0, :32, 0] = [(frame >> bit) & 1 for bit in range(32)]
+        backends.writeimage(os.path.join(directory, 'frame_{0:05d}.png'.format(frame)), pixels, np.uint8)
+
+
+def clearexport(directory):
+    """Removes the export directory of a sequence, so the next run denoises every frame again"""
+    shutil.rmtree(os.path.join(directory, sequence.EXPORT_DIR_NAME), ignore_errors=True)
+
+
+def benchfiles(stages, root, stub_path, frames, width, height, jobs):
+    """Runs the stages that move files through the denoiser workers and returns their results"""
+    results = []
+    sequence_dir = os.path.join(root, 'sequence')
+    makesequence(sequence_dir, frames, width, height)
+    frame_paths = [os.path.join(sequence_dir, filename) for filename in sequence.findframes(sequence_dir)]
+    pool = denoiser.makepool(stub_path, jobs)
+    backend = backends.OptixBackend(pool)
+
+    def measure(stage, run):
+        with Measurement(pool) as measurement:
+            run()
+        results.append(measurement.result(stage, frames, width, height, jobs))
+
+    try:
+        if 'spawn' in stages:
+            # includes starting the workers, which the add-on pays for once per session
+            output_path = os.path.join(root, 'spawn.png')
+            measure('spawn', lambda: [denoiser.denoise(pool, path, output_path) for path in frame_paths])
+
+        if 'sequence' in stages or 'resume' in stages:
+            measure('sequence', lambda: sequence.denoisesequence(sequence_dir, backend, jobs=jobs))
+        if 'resume' in stages:
+            measure('resume', lambda: sequence.denoisesequence(sequence_dir, backend, jobs=jobs))
+
+        if 'cache' in stages:
+            denoise_cache = cache.DenoiseCache(os.path.join(root, 'cache'), 2 * frames * width * height * 4)
+            for stage in ('cache_cold', 'cache_warm'):
+                clearexport(sequence_dir)
+                measure(stage, lambda: sequence.denoisesequence(sequence_dir, backend, jobs=jobs,
+                                                                denoise_cache=denoise_cache))
+
+        if 'animation' in stages:
+            # frames are denoised in place as they are rendered, like the animation handlers do
+            animation_dir = os.path.join(root, 'animation')
+            shutil.copytree(sequence_dir, animation_dir, ignore=shutil.ignore_patterns(sequence.EXPORT_DIR_NAME))
+
+            def animate():
+                denoise_queue = pipeline.DenoiseQueue(2 * jobs)
+                for filename in sequence.findframes(animation_dir):
+                    path = os.path.join(animation_dir, filename)
+                    denoise_queue.put(lambda path=path: denoiser.denoise(pool, path, path))
+                denoise_queue.finish()
+                denoise_queue.wait()
+
+            measure('animation', animate)
+
+        if ADDON_STAGES.intersection(stages):
+            results += benchaddon(stages, root, pool, sequence_dir, frames, width, height, jobs)
+    finally:
+        pool.stop()
+
+    if 'devices' in stages:
+        results.append(benchdevices(root, stub_path, sequence_dir, frames, width, height))
+    if 'farm' in stages:
+        results.append(benchfarm(stub_path, sequence_dir, frames, width, height))
+
+    return results
+
+
+def getfakebpy():
+    """Returns the stand-in Blender of the tests, importing it the first time an add-on stage runs"""
+    # it lives with the tests, out of reach of everything the add-on and the command line import
+    if TESTS_DIR not in sys.path:
+        sys.path.insert(0, TESTS_DIR)
+    import fakebpy
+    return fakebpy
+
+
+def getaddon():
+    """Returns the add-on, registering it in a stand-in Blender the first time"""
+    global ADDON
+
+    if ADDON is None:
+        ADDON = getfakebpy().importaddon()
+        # the add-on's startup chores clean up its own folder, which the benchmark leaves alone
+        ADDON.startupchores = lambda: None
+        ADDON.register()
+    return ADDON
+
+
+def benchaddon(stages, root, pool, sequence_dir, frames, width, height, jobs):
+    """Runs the add-on's render and sequence handlers on the stub's workers and returns their results"""
+    results = []
+    addon = getaddon()
+    bpy = sys.modules['bpy']
+    # renders need OpenEXR to be denoised in a region of interest or with extra passes
+    exr = backends.hasexr()
+    if not exr:
+        print("D-NOISE bench: imageio cannot write OpenEXR, leaving out the region of interest and extra pass stages",
+              file=sys.stderr)
+
+    preferences = addon.fmutils.getpreferences()
+    preferences.use_cache = False
+    preferences.scratch_dir = os.path.join(root, 'scratch')
+    addon.optix.WORKERS, addon.optix.WORKERS_DEVICES = pool, preferences.devices
+    addon.optix.PASSES_DIR = os.path.join(root, 'passes')
+
+    scene = bpy.context.scene = bpy.types.Scene()
+    scene.render.resolution_x, scene.render.resolution_y = width, height
+    scene.DNOISEJobs = jobs
+    render_result = bpy.data.images.get('Render Result') or bpy.data.images.new('Render Result', width, height)
+    render_result.source = 'VIEWER'
+    render_result.scale(width, height)
+    pixels = makepixels(width, height)
+    render_result.pixels.foreach_set(pixels.ravel())
+
+    def measure(stage, run, count):
+        with Measurement(pool, addon.timing) as measurement:
+            run()
+        results.append(measurement.result(stage, count, width, height, jobs))
+
+    def setborder(use_border):
+        scene.render.use_border = use_border
+        (scene.render.border_min_x, scene.render.border_min_y,
+         scene.render.border_max_x, scene.render.border_max_y) = ROI_BORDER
+
+    def animate(directory):
+        # the frames, and the passes the compositor writes with them, are rendered before they are measured
+        scene.render.filepath = os.path.join(root, directory, 'frame_')
+        scene.frame_start, scene.frame_end = 1, frames
+        os.makedirs(os.path.join(root, directory))
+        for frame in range(1, frames + 1):
+            render_result.save_render(scene.render.frame_path(frame))
+            if scene.EnableExtraPasses:
+                for view_layer in scene.view_layers:
+                    for pass_name in ('Normal', 'Albedo'):
+                        pass_path = layers.getpasspath(addon.optix.PASSES_DIR, bpy.path.clean_name(view_layer.name),
+                                                       pass_name, frame)
+                        os.makedirs(os.path.dirname(pass_path), exist_ok=True)
+                        backends.writeimage(pass_path, pixels, np.float32)
+
+        def render():
+            for frame in range(1, frames + 1):
+                scene.frame_current = frame
+                addon.runanimdenoiser(scene)
+            # frames still denoising when the render completes are waited for
+            denoise_queue = addon.ANIMATION_QUEUE
+            addon.finishanimdenoiser()
+            if denoise_queue is not None:
+                denoise_queue.wait()
+
+        return render
+
+    try:
+        if 'render' in stages:
+            repeats = min(frames, MEMORY_FRAMES)
+            for stage, use_border in (('render', False), ('render_roi', True)):
+                if use_border and not exr:
+                    continue
+                setborder(use_border)
+                measure(stage, lambda: [addon.runrenderdenoiser() for repeat in range(repeats)], repeats)
+            setborder(False)
+
+        if 'animrender' in stages:
+            for stage, use_border, use_passes in (('animrender', False, False), ('animrender_roi', True, False),
+                                                  ('animrender_passes', False, True)):
+                if (use_border or use_passes) and not exr:
+                    continue
+                setborder(use_border)
+                scene.EnableExtraPasses = use_passes
+                measure(stage, animate(stage), frames)
+            setborder(False)
+            scene.EnableExtraPasses = False
+
+        if 'postanim' in stages:
+            # the sequence is denoised on the add-on's job queue, and is done once its job ends
+            clearexport(sequence_dir)
+            addon.DENOISE_SOURCE = getfakebpy().Image('frame_00001.png', width, height, source='SEQUENCE',
+                                                 filepath=os.path.join(sequence_dir, 'frame_00001.png'))
+            finished = threading.Event()
+
+            def onevent(event):
+                if event['event'] == 'job_end' and event['job'].startswith(sequence_dir + '@'):
+                    finished.set()
+
+            addon.timing.addhook(onevent)
+            try:
+                measure('postanim', lambda: (addon.runpostanimdenoiser(), finished.wait()), frames)
+            finally:
+                addon.timing.removehook(onevent)
+
+        if 'outputdir' in stages:
+            # every frame is queued without waiting on the denoiser, so the handler's own time is all that is timed
+            repeats = min(frames, MEMORY_FRAMES)
+            queue_size = addon.ANIMATION_QUEUE_SIZE
+            addon.ANIMATION_QUEUE_SIZE = repeats
+            try:
+                for files in OUTPUT_DIR_FILES:
+                    results.append(benchoutputdir(addon, scene, render_result, pool, os.path.join(root, 'outputdir'),
+                                                  files, repeats, width, height, jobs))
+            finally:
+                addon.ANIMATION_QUEUE_SIZE = queue_size
+    finally:
+        # the workers belong to the caller, which stops them
+        addon.optix.WORKERS = None
+
+    return results
+
+
+def benchoutputdir(addon, scene, render_result, pool, directory, files, frames, width, height, jobs):
+    """Renders frames into an output folder already holding the given number of files and returns the result"""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    scene.render.filepath = os.path.join(directory, 'frame_')
+    scene.frame_start, scene.frame_end = 1, frames
+
+    # the other files are frames of an earlier, longer render, linked to one file as their contents are never read
+    render_result.save_render(scene.render.frame_path(0))
+    for frame in range(frames + 1, frames + files + 1):
+        os.link(scene.render.frame_path(0), scene.render.frame_path(frame))
+    for frame in range(1, frames + 1):
+        render_result.save_render(scene.render.frame_path(frame))
+
+    handler_seconds = 0
+    with Measurement(pool, addon.timing) as measurement:
+        for frame in range(1, frames + 1):
+            scene.frame_current = frame
+            start = time.perf_counter()
+            addon.runanimdenoiser(scene)
+            handler_seconds += time.perf_counter() - start
+        denoise_queue = addon.ANIMATION_QUEUE
+        addon.finishanimdenoiser()
+        denoise_queue.wait()
+
+    result = measurement.result('outputdir', frames, width, height, jobs)
+    result['files'] = files
+    result['handler_ms_per_frame'] = round(1000 * handler_seconds / frames, 4)
+    return result
+
+
+def benchdevices(root, stub_path, sequence_dir, frames, width, height):
+    """Denoises the sequence on simulated devices of uneven speed and returns the result with each device's share"""
+    delays = {str(index): DEVICE_DELAY * 2 ** index for index in range(DEVICE_COUNT)}
+    env = dict(os.environ, DNOISE_STUB_DELAYS=json.dumps(delays))
+    devices = [worker.Device(name) for name in delays]
+    pool = worker.WorkerPool([sys.executable, worker.__file__, stub_path], len(devices), env, devices)
+
+    clearexport(sequence_dir)
+    try:
+        with Measurement(pool) as measurement:
+            sequence.denoisesequence(sequence_dir, backends.OptixBackend(pool), jobs=len(devices))
+    finally:
+        pool.stop()
+
+    result = measurement.result('devices', frames, width, height, len(devices))
+    result['devices'] = pool.stats()
+    return result
+
+
+def benchfarm(stub_path, sequence_dir, frames, width, height):
+    """Denoises the sequence with several command line processes at once and returns each one's share"""
+    clearexport(sequence_dir)
+    command = [sys.executable, '-m', 'dnoise', sequence_dir, '--farm', '--denoiser', stub_path]
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    with Measurement() as measurement:
+        nodes = [subprocess.Popen(command + ['--node', 'node{0}'.format(index)], cwd=package_dir,
+                                  stderr=subprocess.DEVNULL)
+                 for index in range(FARM_NODES)]
+        for node in nodes:
+            node.wait()
+
+    # each node logs the frames it denoised itself as done
+    shares = {}
+    export_dir = os.path.join(sequence_dir, sequence.EXPORT_DIR_NAME)
+    for index in range(FARM_NODES):
+        owner = 'node{0}'.format(index)
+        with open(os.path.join(export_dir, timing.getlogname(owner))) as log_file:
+            events = [json.loads(line) for line in log_file]
+        shares[owner] = sum(1 for event in events if event['event'] == 'frame' and event['status'] == 'done')
+
+    result = measurement.result('farm', frames, width, height, FARM_NODES)
+    result['nodes'] = shares
+    result['exported'] = len(sequence.findframes(export_dir))
+    return result
+
+
+def benchmemory(stages, frames, width, height, tile_size):
+    """Runs the stages that only work on pixels in memory and returns their results"""
+    results = []
+    repeats = min(frames, MEMORY_FRAMES)
+    pixels = np.random.default_rng(0).random((height, width, 4), dtype=np.float32)
+
+    def measure(stage, run):
+        with Measurement() as measurement:
+            for repeat in range(repeats):
+                run()
+        results.append(measurement.result(stage, repeats, width, height, 1))
+
+    # toscreenspace reads the normal pass into a new buffer and rotates it there, and before it was vectorized it
+    # read it into a Python float list and rotated one mathutils Vector at a time, which only runs where mathutils
+    # can be imported, such as in Blender's Python
+    rotation = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float32)
+    if 'normals' in stages:
+        measure('normals', lambda: normals.rotatenormals(pixels.copy().reshape(-1, 4), rotation))
+
+    if 'normalsloop' in stages and mathutils is None:
+        print("D-NOISE bench: mathutils is not installed, leaving out the normalsloop stage", file=sys.stderr)
+    elif 'normalsloop' in stages:
+        quaternion = mathutils.Matrix(rotation.tolist()).to_quaternion()
+        measure('normalsloop', lambda: rotatenormalsloop(pixels, quaternion))
+        # both ways of rotating must give the same normals
+        rotated = pixels.copy()
+        normals.rotatenormals(rotated.reshape(-1, 4), rotation)
+        results[-1]['max_difference'] = float(np.abs(np.array(rotatenormalsloop(pixels, quaternion),
+                                                               dtype=np.float32) - rotated.ravel()).max())
+
+    if 'tiles' in stages:
+        def stitch():
+            stitched = np.zeros_like(pixels)
+            for box in tiles.splittiles(width, height, tile_size):
+                tiles.addtile(stitched, tiles.croptile(pixels, box), box, tiles.TILE_OVERLAP)
+
+        measure('tiles', stitch)
+
+    if 'roi' in stages:
+        # searching the alpha of a frame is the cost a region of interest adds, and with alpha everywhere it
+        # finds nothing to crop to
+        measure('roi', lambda: roi.getroi(width, height, images=[pixels]))
+
+    if 'proxy' in stages:
+        # scaling the proxy of a progressive denoise down and back up is the time it adds before the preview shows
+        factor = proxy.getfactor(width, height)
+        measure('proxy', lambda: proxy.upscale(proxy.downscale(pixels, factor), width, height))
+
+    if 'blend' in stages:
+        blend_buffer = blend.BlendBuffer(pixels.ravel(), pixels.ravel() * 0.5, width, height)
+        measure('blend', lambda: blend_buffer.blend(0.3))
+
+    if 'cpu' in stages:
+        # the CPU backend's filter is real work rather than overhead, timed here with both guides
+        guide = pixels[..., :3]
+        measure('cpu', lambda: cpu.filterimage(pixels, guide, guide))
+
+    return results
+
+
+def rotatenormalsloop(pixels, rotation):
+    """Rotates the normals of (h, w, 4) pixels as toscreenspace did before it was vectorized, returning a float list"""
+    values = pixels.ravel().tolist()
+    for i in range(0, len(values), 4):
+        normal = mathutils.Vector((values[i + 0], values[i + 1], values[i + 2]))
+        screen_space_normal = rotation @ normal
+        values[i + 0] = screen_space_normal[0]
+        values[i + 1] = screen_space_normal[1]
+        values[i + 2] = screen_space_normal[2]
+    return values
+
+
+def parseresolution(resolution):
+    """Returns the width and height of a resolution written as WIDTHxHEIGHT"""
+    try:
+        width, height = (int(size) for size in resolution.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("resolutions are written as WIDTHxHEIGHT, e.g. 1920x1080")
+    return width, height
+
+
+def main(argv=None):
+    """Runs the benchmark and writes its results as JSON"""
+    parser = argparse.ArgumentParser(prog="python -m dnoise.bench",
+                                     description="Measure D-NOISE's overhead around a stub denoiser.")
+    parser.add_argument('--frames', type=int, nargs='+', default=[10, 100],
+                        help="sequence lengths to run every stage at")
+    parser.add_argument('--resolutions', type=parseresolution, nargs='+', default=[(1280, 720)], metavar='WxH',
+                        help="frame resolutions to run every stage at")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of frames to denoise at the same time")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES,
+                        help="stages to run")
+    parser.add_argument('--tile-size', type=int, default=512,
+                        help="tile core size of the tiles stage")
+    parser.add_argument('--label', default='',
+                        help="name of the version being measured, stored with the results")
+    parser.add_argument('--output', metavar='FILE',
+                        help="file to write the JSON results to instead of stdout")
+    args = parser.parse_args(argv)
+
+    # the frames are written as PNG images
+    if backends.imageio is None:
+        parser.error("the benchmark needs the imageio package")
+
+    results = []
+    for width, height in args.resolutions:
+        for frames in args.frames:
+            print("D-NOISE bench: {0} frames at {1}x{2}".format(frames, width, height), file=sys.stderr)
+            root = tempfile.mkdtemp(prefix='dnoise-bench-')
+            try:
+                # a sequence is only written for stages that use it, which at 8K takes a while
+                if not MEMORY_STAGES.issuperset(args.stages):
+                    results += benchfiles(args.stages, root, makestub(root), frames, width, height, args.jobs)
+                results += benchmemory(args.stages, frames, width, height, args.tile_size)
+            finally:
+                shutil.rmtree(root)
+
+    report = {'label': args.label,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
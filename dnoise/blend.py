@@ -0,0 +1,38 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import numpy as np
+
+
+class BlendBuffer:
+    """An unblended denoised image and its source, kept so blends between the two never need another denoise"""
+
+    def __init__(self, denoised, source, width, height):
+        self.width = width
+        self.height = height
+        self.denoised = denoised
+        self.difference = source - denoised
+        self.blended = np.empty_like(denoised)
+
+    def blend(self, factor):
+        """Returns the denoised image blended with its source, where a factor of 1 gives back the source"""
+        np.multiply(self.difference, factor, out=self.blended)
+        self.blended += self.denoised
+        return self.blended
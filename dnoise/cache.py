@@ -0,0 +1,263 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+# bytes read at a time when hashing denoiser inputs
+HASH_CHUNK_SIZE = 1048576
+
+# Blender stamps renders with metadata such as the frame number, date and render time, so identical
+# frames held over several frames of an animation differ in their files. The metadata of the formats
+# Blender stamps is left out of the hash: PNG text and time chunks, JPEG comments and application
+# segments other than JFIF and Adobe's, and OpenEXR string attributes, along with the OpenEXR chunk
+# offset table, whose offsets move with the length of the header.
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+JPEG_SIGNATURE = b'\xff\xd8'
+JPEG_METADATA_MARKERS = set(range(0xe1, 0xee)) | {0xef, 0xfe}
+EXR_SIGNATURE = b'\x76\x2f\x31\x01'
+
+# OpenEXR version flags of tiled, deep and multi-part files, which are hashed whole
+EXR_WHOLE_FLAGS = 0x200 | 0x800 | 0x1000
+
+
+class DenoiseCache:
+    """An on-disk cache of denoised images keyed by their inputs and settings that evicts the least recently used"""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # entries from least to most recently used, mapped to their size in bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        files = [entry for entry in os.scandir(directory) if entry.is_file() and not entry.name.startswith('.')]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self.entries[entry.name] = entry.stat().st_size
+            self.size += entry.stat().st_size
+
+    def key(self, paths, settings):
+        """Returns the cache key for a set of denoiser input files and the settings they are denoised with"""
+        digest = hashlib.sha256()
+
+        for path in paths:
+            digest.update(b'\0' if path is None else b'\1')
+            if path is not None:
+                digest.update(hashimage(path))
+
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def contains(self, key, output_path):
+        """Returns true if the result for key is cached in the format of output_path"""
+        with self.lock:
+            return key + os.path.splitext(output_path)[1] in self.entries
+
+    def fetch(self, key, output_path, denoise):
+        """Writes the result for key to output_path, calling denoise(output_path) and storing its result on a miss"""
+        name = key + os.path.splitext(output_path)[1]
+
+        # identical inputs already being denoised are waited for instead of denoised twice
+        while True:
+            with self.lock:
+                if name in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(name)
+                    cache_path = os.path.join(self.directory, name)
+                    os.utime(cache_path)
+                    shutil.copyfile(cache_path, output_path)
+                    return True
+
+                event = self.pending.get(name)
+                if event is None:
+                    event = self.pending[name] = threading.Event()
+                    self.misses += 1
+                    break
+
+            event.wait()
+
+        try:
+            denoise(output_path)
+            if os.path.exists(output_path):
+                self.store(name, output_path)
+        finally:
+            with self.lock:
+                del self.pending[name]
+            event.set()
+
+        return False
+
+    def store(self, name, output_path):
+        """Copies a denoised image into the cache, evicting the least recently used entries to stay under max_size"""
+        temp_path = os.path.join(self.directory, '.' + name)
+        shutil.copyfile(output_path, temp_path)
+        os.replace(temp_path, os.path.join(self.directory, name))
+
+        with self.lock:
+            self.size += os.path.getsize(output_path) - self.entries.pop(name, 0)
+            self.entries[name] = os.path.getsize(output_path)
+
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted, evicted_size = self.entries.popitem(last=False)
+                os.remove(os.path.join(self.directory, evicted))
+                self.size -= evicted_size
+
+    def stats(self):
+        """Returns a short description of the cache's hits, misses and size"""
+        return "{0} hits, {1} misses, {2:.1f} MB".format(self.hits, self.misses, self.size / 1048576)
+
+
+def hashimage(path):
+    """Returns the SHA-256 digest of an image file without the metadata Blender stamps it with"""
+    with open(path, 'rb') as f:
+        try:
+            digest = hashlib.sha256()
+            for block in readcontent(f):
+                digest.update(block)
+        except ValueError:
+            # a file that cannot be parsed is hashed whole
+            f.seek(0)
+            digest = hashlib.sha256()
+            for block in readblocks(f):
+                digest.update(block)
+    return digest.digest()
+
+
+def readcontent(f):
+    """Yields the bytes of an image file that make up its pixels, raising ValueError if it is malformed"""
+    signature = f.read(8)
+    f.seek(0)
+    if signature.startswith(PNG_SIGNATURE):
+        return readpng(f)
+    if signature.startswith(JPEG_SIGNATURE):
+        return readjpeg(f)
+    if signature.startswith(EXR_SIGNATURE):
+        return readexr(f)
+    return readblocks(f)
+
+
+def readblocks(f, size=None):
+    """Yields the bytes of a file from its position in blocks, up to size bytes or to its end"""
+    while size is None or size > 0:
+        block = f.read(HASH_CHUNK_SIZE if size is None else min(size, HASH_CHUNK_SIZE))
+        if not block:
+            if size is not None:
+                raise ValueError("the file ends early")
+            return
+        if size is not None:
+            size -= len(block)
+        yield block
+
+
+def readpng(f):
+    """Yields the chunks of a PNG file other than its text and time chunks"""
+    yield f.read(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if not header:
+            return
+        if len(header) < 8:
+            raise ValueError("truncated PNG chunk")
+        length = int.from_bytes(header[:4], 'big')
+        if header[4:] in PNG_METADATA_CHUNKS:
+            # the chunk's data and CRC
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        yield header
+        yield from readblocks(f, length + 4)
+
+
+def readjpeg(f):
+    """Yields the segments of a JPEG file other than its comments and metadata, then its image data"""
+    yield f.read(len(JPEG_SIGNATURE))
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            raise ValueError("malformed JPEG marker")
+        # everything from the start of the scan on is image data
+        if marker[1] == 0xda:
+            yield marker
+            yield from readblocks(f)
+            return
+        if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+            yield marker
+            continue
+        length = int.from_bytes(f.read(2), 'big')
+        if length < 2:
+            raise ValueError("malformed JPEG segment")
+        if marker[1] in JPEG_METADATA_MARKERS:
+            f.seek(length - 2, os.SEEK_CUR)
+            continue
+        yield marker + length.to_bytes(2, 'big')
+        yield from readblocks(f, length - 2)
+
+
+def readexr(f):
+    """Yields the header of a scanline OpenEXR file without its string attributes, then its pixel chunks"""
+    start = f.read(8)
+    if int.from_bytes(start[4:], 'little') & EXR_WHOLE_FLAGS:
+        yield start
+        yield from readblocks(f)
+        return
+
+    yield start
+    while True:
+        name = readexrstring(f)
+        if not name:
+            break
+        attribute_type = readexrstring(f)
+        size = int.from_bytes(f.read(4), 'little')
+        if attribute_type == b'string':
+            f.seek(size, os.SEEK_CUR)
+            continue
+        yield name + b'\0' + attribute_type + b'\0' + size.to_bytes(4, 'little')
+        yield from readblocks(f, size)
+
+    # the offset table ends where the first chunk starts, which the table's first offset points to
+    first_chunk = int.from_bytes(f.read(8), 'little')
+    if first_chunk <= f.tell() - 8:
+        raise ValueError("malformed OpenEXR offset table")
+    f.seek(first_chunk)
+    yield from readblocks(f)
+
+
+def readexrstring(f):
+    """Returns a null-terminated name from an OpenEXR header"""
+    name = b''
+    while True:
+        character = f.read(1)
+        if not character:
+            raise ValueError("truncated OpenEXR header")
+        if character == b'\0':
+            return name
+        name += character
+        if len(name) > 255:
+            raise ValueError("malformed OpenEXR header")
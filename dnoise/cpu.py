@@ -0,0 +1,124 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# A CPU denoiser for machines without an NVIDIA GPU: an edge-avoiding a-trous wavelet filter (Dammertz
+# et al., 2010). Each pass blurs with a 5x5 B-spline kernel whose taps are spread twice as far apart as
+# in the pass before, and every tap is weighted down by how much its color, and its albedo and normal
+# when those guides are given, differ from the pixel being filtered, so the blur stops at edges. The
+# passes are vectorized over whole rows of pixels with numpy and split into bands run on several threads.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# number of filter passes, covering a radius of 2 * (2 ** PASSES - 1) pixels
+PASSES = 5
+
+# 1D B-spline kernel of each pass
+KERNEL = np.array([1 / 16, 1 / 4, 3 / 8, 1 / 4, 1 / 16], dtype=np.float32)
+
+# how much tap colors may differ before the blur stops at them, halved every pass
+COLOR_SIGMA = 0.6
+
+# how much tap albedos may differ before the blur stops at them
+ALBEDO_SIGMA = 0.1
+
+# how fast tap weights fall off with the angle between normals, like a power of the angle's cosine
+NORMAL_SHARPNESS = 32
+
+# pixels of padding around the image, enough for the widest pass
+PADDING = 2 * 2 ** (PASSES - 1)
+
+
+def tonemap(color):
+    """Maps HDR color into [0, 1) so that bright pixels do not stop the blur everywhere around them"""
+    return color / (1 + np.abs(color))
+
+
+def pad(pixels):
+    """Returns an image padded on every side by repeating its edge pixels"""
+    return np.pad(pixels, ((PADDING, PADDING), (PADDING, PADDING), (0, 0)), mode='edge')
+
+
+def squareddistance(a, b):
+    """Returns the squared distance between the pixels of two images, keeping a channel axis"""
+    difference = a - b
+    return np.einsum('ijk,ijk->ij', difference, difference)[..., np.newaxis]
+
+
+def filterband(color, edges, albedo, normal, output, step, color_sigma, y0, y1):
+    """Runs one filter pass over rows y0 to y1 of padded color into output, guided by the padded guides"""
+    # the edges of the tonemapped color stop the filter, and so do those of the albedo and normals if given
+    width = output.shape[1]
+    center = np.s_[PADDING + y0:PADDING + y1, PADDING:PADDING + width]
+    total = np.zeros((y1 - y0, width, 3), dtype=np.float32)
+    total_weight = np.zeros((y1 - y0, width, 1), dtype=np.float32)
+
+    for y_index, y_weight in enumerate(KERNEL):
+        for x_index, x_weight in enumerate(KERNEL):
+            dy, dx = (y_index - 2) * step, (x_index - 2) * step
+            tap = np.s_[PADDING + y0 + dy:PADDING + y1 + dy, PADDING + dx:PADDING + dx + width]
+
+            # every edge-stopping term is summed into one exponent, so each tap needs a single exp
+            exponent = squareddistance(edges[tap], edges[center]) * (-1 / color_sigma ** 2)
+            if albedo is not None:
+                exponent -= squareddistance(albedo[tap], albedo[center]) * (1 / ALBEDO_SIGMA ** 2)
+            if normal is not None:
+                cosine = np.einsum('ijk,ijk->ij', normal[tap], normal[center])[..., np.newaxis]
+                exponent -= (1 - cosine) * NORMAL_SHARPNESS
+
+            weight = np.exp(exponent)
+            weight *= y_weight * x_weight
+            total += weight * color[tap]
+            total_weight += weight
+
+    output[y0:y1] = total / np.maximum(total_weight, 1e-8)
+
+
+def filterimage(beauty, albedo=None, normal=None, blend=0, threads=None):
+    """Denoises an (h, w, 4) float32 image guided by optional albedo and normal images, then blends it"""
+    # a blend of 1 gives back the original image, as for the OptiX denoiser
+    height, width = beauty.shape[:2]
+    threads = threads or os.cpu_count() or 1
+    bands = [(height * index // (2 * threads), height * (index + 1) // (2 * threads)) for index in range(2 * threads)]
+    bands = [(y0, y1) for y0, y1 in bands if y1 > y0]
+
+    if albedo is not None:
+        albedo = pad(albedo[..., :3].astype(np.float32))
+    if normal is not None:
+        normal = normal[..., :3].astype(np.float32)
+        normal /= np.maximum(np.linalg.norm(normal, axis=2, keepdims=True), 1e-8)
+        normal = pad(normal)
+
+    color = beauty[..., :3].astype(np.float32)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for index in range(PASSES):
+            padded = pad(color)
+            edges = tonemap(padded)
+            color = np.empty_like(color)
+            futures = [executor.submit(filterband, padded, edges, albedo, normal, color,
+                                       2 ** index, COLOR_SIGMA / 2 ** index, y0, y1)
+                       for y0, y1 in bands]
+            for future in futures:
+                future.result()
+
+    denoised = beauty.astype(np.float32, copy=True)
+    denoised[..., :3] = color * (1 - blend) + beauty[..., :3] * blend
+    return denoised
@@ -0,0 +1,97 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+from . import tiles, worker
+
+# directory of the add-on that contains this package
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# path to the OptiX standalone denoiser
+DENOISER_PATH = os.path.join(ADDON_DIR, 'OptiXDenoiser', 'Denoiser.exe')
+
+
+def makepool(denoiser_path=DENOISER_PATH, size=1, python=sys.executable, devices=None):
+    """Returns a pool of workers that run the given denoiser executable, with at least one worker per device"""
+    devices = devices or []
+    return worker.WorkerPool([python, worker.__file__, denoiser_path], max(size, len(devices)), devices=devices)
+
+
+def parsedevices(text):
+    """Returns the worker.Devices listed in text such as "0, 1:8192", raising ValueError if it is malformed"""
+    devices = []
+    for entry in text.replace(' ', '').split(','):
+        if not entry:
+            continue
+        name, separator, memory = entry.partition(':')
+        if not name.isdigit() or (separator and not memory.isdigit()):
+            raise ValueError("devices are written as CUDA device numbers, each optionally followed by :MB, "
+                             "not {0}".format(entry))
+        devices.append(worker.Device(name, int(memory) * 1048576 if separator else 0))
+    return devices
+
+
+def getmemory(width, height):
+    """Returns the estimated bytes the denoiser needs on its device for an image of the given size"""
+    return width * height * tiles.DENOISER_BYTES_PER_PIXEL
+
+
+def getsettings(normal_path=None, albedo_path=None, hdr=0, blend=0, backend='optix'):
+    """Returns the settings that decide the denoised result of an image, as stored in caches and manifests"""
+    if albedo_path is None:
+        mode = 'beauty'
+    elif normal_path is None:
+        mode = 'albedo'
+    else:
+        mode = 'full'
+    return {'mode': mode, 'hdr': hdr, 'blend': blend, 'backend': backend}
+
+
+def denoiseargs(source_path, output_path, normal_path=None, albedo_path=None, hdr=0, blend=0):
+    """Returns the denoiser arguments for a beauty pass, guided by the albedo pass and the normal pass if given"""
+    args = ['-i', source_path, '-o', output_path]
+    if albedo_path is not None:
+        args += ['-a', albedo_path]
+        # OptiX only uses normals alongside albedo
+        if normal_path is not None:
+            args += ['-n', normal_path]
+    return args + ['-hdr', str(hdr), '-b', str(blend)]
+
+
+def denoise(pool, source_path, output_path, normal_path=None, albedo_path=None, hdr=0, blend=0,
+            priority=worker.BACKGROUND, memory=0):
+    """Denoises an image through a worker pool and returns the denoiser's exit code, the normals must be in screen space"""
+    args = denoiseargs(source_path, output_path, normal_path, albedo_path, hdr, blend)
+    returncode = pool.request(args, ADDON_DIR, priority, memory)
+    if returncode != 0:
+        print(">> D-NOISE ERROR: denoiser exited with code {0} on {1}".format(returncode, source_path))
+    return returncode
+
+
+def denoisebatch(pool, items, hdr=0, blend=0, priority=worker.BACKGROUND, memory=0):
+    """Denoises a batch of (source, output, normal, albedo) images in one round trip and returns the exit codes"""
+    batch = [denoiseargs(source_path, output_path, normal_path, albedo_path, hdr, blend)
+             for source_path, output_path, normal_path, albedo_path in items]
+    returncodes = pool.requestbatch(batch, ADDON_DIR, priority, memory)
+
+    for (source_path, output_path, normal_path, albedo_path), returncode in zip(items, returncodes):
+        if returncode != 0:
+            print(">> D-NOISE ERROR: denoiser exited with code {0} on {1}".format(returncode, source_path))
+    return returncodes
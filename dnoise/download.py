@@ -0,0 +1,254 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Downloads large files over several HTTP range requests at once. Each range is streamed into its own
+# part file named after the bytes it holds, so an interrupted download resumes from whatever the part
+# files already contain, even in a later session. The finished file is checked against a SHA-256
+# checksum, when one is given, before it replaces anything.
+
+import hashlib
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+# bytes read from a connection at a time
+CHUNK_SIZE = 1048576
+
+# number of ranges downloaded at the same time
+CONNECTIONS = 4
+
+# times a range is retried, from where it stopped, after its connection fails
+RETRIES = 3
+
+# seconds a connection may stall before it is retried
+TIMEOUT = 30
+
+
+class Progress:
+    """Thread-safe progress of a download, read by the UI while the download runs on other threads"""
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.state = 'idle'
+        self.done = 0
+        self.total = 0
+        self.error = None
+
+    def reset(self):
+        """Clears the progress of an earlier download before a new one starts"""
+        self.cancelled.clear()
+        with self.lock:
+            self.state = 'downloading'
+            self.done = 0
+            self.total = 0
+            self.error = None
+
+    def start(self, total, done=0):
+        with self.lock:
+            self.state = 'downloading'
+            self.total = total
+            self.done = done
+            self.error = None
+        self.changed()
+
+    def add(self, size):
+        with self.lock:
+            self.done += size
+        self.changed()
+
+    def setstate(self, state, error=None):
+        with self.lock:
+            self.state = state
+            self.error = error
+        self.changed()
+
+    def cancel(self):
+        """Asks the download to stop, keeping what has been downloaded so far"""
+        self.cancelled.set()
+
+    def iscancelled(self):
+        return self.cancelled.is_set()
+
+    def isactive(self):
+        """Returns true while the file is being downloaded, verified or extracted"""
+        with self.lock:
+            return self.state in ('downloading', 'verifying', 'extracting')
+
+    def percent(self):
+        """Returns how much of the file has been downloaded, from 0 to 100"""
+        with self.lock:
+            return min(100.0, 100.0 * self.done / self.total) if self.total else 0.0
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+
+def getsize(url):
+    """Returns the size of the file at a URL and whether the server answers range requests, from one request"""
+    with urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=TIMEOUT) as response:
+        content_range = response.headers.get('Content-Range')
+        if response.status == 206 and content_range is not None:
+            return int(content_range.rsplit('/', 1)[1]), True
+        return int(response.headers['Content-Length']), False
+
+
+def splitranges(size, count):
+    """Returns the (start, end) inclusive byte ranges that split a file into at most count parts"""
+    count = max(1, min(count, size // CHUNK_SIZE + 1))
+    bounds = [index * size // count for index in range(count + 1)]
+    return [(start, end - 1) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def getpartpath(path, start, end):
+    """Returns the path of the part file holding a byte range of a download"""
+    return "{0}.part-{1}-{2}".format(path, start, end)
+
+
+def removeparts(path):
+    """Deletes every part file left by downloads to a path"""
+    directory, filename = os.path.split(os.path.abspath(path))
+    for file in os.listdir(directory):
+        if file.startswith(filename + '.part-'):
+            os.remove(os.path.join(directory, file))
+
+
+def fetchrange(url, part_path, start, end, progress):
+    """Downloads a byte range into its part file, resuming from the part file's size and retrying failed connections"""
+    # a connection that ends early is retried like one that fails, from wherever it stopped
+    for attempt in range(RETRIES + 1):
+        have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if have > end - start:
+            return
+        if progress.iscancelled():
+            raise InterruptedError("download cancelled")
+
+        try:
+            request = Request(url, headers={'Range': 'bytes={0}-{1}'.format(start + have, end)})
+            with urlopen(request, timeout=TIMEOUT) as response, open(part_path, 'ab') as part_file:
+                if response.status != 206:
+                    raise OSError("server ignored the range request")
+                while not progress.iscancelled():
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    part_file.write(chunk)
+                    progress.add(len(chunk))
+        except (OSError, http.client.HTTPException):
+            if attempt == RETRIES:
+                raise
+
+    if os.path.getsize(part_path) != end - start + 1:
+        raise OSError("range {0}-{1} of {2} is incomplete".format(start, end, url))
+
+
+def download(url, path, progress, sha256=None, connections=CONNECTIONS):
+    """Downloads a URL over resumable range requests, raising ValueError if it fails the SHA-256 checksum"""
+    path = os.path.abspath(path)
+    size, ranged = getsize(url)
+    ranges = splitranges(size, connections if ranged else 1)
+    part_paths = [getpartpath(path, start, end) for start, end in ranges]
+
+    # parts of an earlier download can only be resumed if they hold the same ranges, and nothing can be
+    # resumed from a server that ignores range requests
+    directory, filename = os.path.split(path)
+    for file in os.listdir(directory):
+        part_path = os.path.join(directory, file)
+        if file.startswith(filename + '.part-') and (part_path not in part_paths or not ranged):
+            os.remove(part_path)
+
+    progress.start(size, sum(os.path.getsize(part_path) for part_path in part_paths if os.path.exists(part_path)))
+
+    if ranged:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetchrange, url, part_path, start, end, progress)
+                       for part_path, (start, end) in zip(part_paths, ranges)]
+            for future in futures:
+                future.result()
+    else:
+        with urlopen(url, timeout=TIMEOUT) as response, open(part_paths[0], 'wb') as part_file:
+            while not progress.iscancelled():
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                part_file.write(chunk)
+                progress.add(len(chunk))
+
+    if progress.iscancelled():
+        raise InterruptedError("download cancelled")
+
+    # the parts are joined and hashed in one pass
+    progress.setstate('verifying')
+    digest = hashlib.sha256()
+    with open(path + '.tmp', 'wb') as output_file:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    output_file.write(chunk)
+
+    if sha256 is not None and digest.hexdigest() != sha256.lower():
+        os.remove(path + '.tmp')
+        removeparts(path)
+        raise ValueError("checksum of {0} is {1}, expected {2}".format(url, digest.hexdigest(), sha256))
+
+    os.replace(path + '.tmp', path)
+    removeparts(path)
+    return path
+
+
+def extract(zip_path, directory, progress=None):
+    """Extracts a zip archive into a directory once every file in it has passed its CRC check"""
+    if progress is not None:
+        progress.setstate('extracting')
+
+    staging_dir = tempfile.mkdtemp(prefix='.dnoise-extract-', dir=directory)
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                target = os.path.realpath(os.path.join(staging_dir, member.filename))
+                if not target.startswith(os.path.realpath(staging_dir) + os.sep):
+                    raise ValueError("{0} has a file outside its folder: {1}".format(zip_path, member.filename))
+
+                if member.is_dir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+
+                # reading a member to its end checks its CRC, raising zipfile.BadZipFile if it is damaged
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with archive.open(member) as source, open(target, 'wb') as output:
+                    shutil.copyfileobj(source, output, CHUNK_SIZE)
+
+        for name in os.listdir(staging_dir):
+            destination = os.path.join(directory, name)
+            if os.path.isdir(destination):
+                shutil.rmtree(destination)
+            elif os.path.exists(destination):
+                os.remove(destination)
+            os.replace(os.path.join(staging_dir, name), destination)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
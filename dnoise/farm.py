@@ -0,0 +1,181 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Several machines can denoise one sequence on a shared filesystem by passing the same Leases directory to
+# sequence.denoisesequence. A node claims a frame by creating the frame's next lease file, named
+#   <frame file name>.<generation>
+# by hard-linking a finished file to that name, which fails if another node got there first and is atomic
+# on local filesystems and NFS alike. The node holding a lease touches it while the frame is denoised, and
+# once the frame is published it replaces the lease's contents with the frame's manifest record. A lease
+# that has not been touched for lease_seconds belonged to a node that stopped, so the frame is claimed
+# again under the next generation, and the stopped node, should it come back, sees the newer generation
+# and does not publish. Lease ages are measured with the shared filesystem's clock as seen by each node,
+# so lease_seconds should be well above the clock difference between the nodes.
+
+import json
+import os
+import socket
+import threading
+import time
+
+# name of the directory inside a sequence's export directory that the frames' leases are kept in
+LEASES_DIR_NAME = ".dnoise_leases"
+
+# seconds after which a lease that has not been renewed is taken to belong to a stopped node
+LEASE_SECONDS = 120
+
+# times a lease is renewed in each lease_seconds, so a slow filesystem cannot make a live lease expire
+RENEWALS_PER_LEASE = 4
+
+# most seconds between checks on frames other nodes are working on, once a node has nothing else left to do
+POLL_SECONDS = 2
+
+# results of claiming a frame: this node now holds it, another node has finished it, or another node is
+# working on it and it may need claiming again should that node stop
+CLAIMED = 'claimed'
+FINISHED = 'finished'
+BUSY = 'busy'
+
+
+def getowner():
+    """Returns a name for this process that is unique among the nodes sharing a sequence"""
+    return "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+
+class Leases:
+    """The leases that the frames of one sequence are claimed with, as held by one node"""
+
+    def __init__(self, export_dir, owner=None, lease_seconds=LEASE_SECONDS):
+        self.directory = os.path.join(export_dir, LEASES_DIR_NAME)
+        self.owner = owner if owner is not None else getowner()
+        self.lease_seconds = lease_seconds
+        # generations of the leases this node holds, by frame file name
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def getpath(self, filename, generation):
+        return os.path.join(self.directory, "{0}.{1}".format(filename, generation))
+
+    def writefile(self, path, state):
+        """Writes a lease's contents to a file of this node's own, returning its path"""
+        temp_path = os.path.join(self.directory, ".{0}.{1}".format(self.owner, threading.get_ident()))
+        with open(temp_path, 'w') as lease_file:
+            json.dump(dict(state, owner=self.owner), lease_file)
+        return temp_path
+
+    def readfile(self, path):
+        """Returns the contents of a lease, or None if it cannot be read"""
+        try:
+            with open(path) as lease_file:
+                return json.load(lease_file)
+        except (OSError, ValueError):
+            return None
+
+    def getpollseconds(self):
+        """Returns the seconds between checks on frames other nodes are working on"""
+        return min(self.lease_seconds / RENEWALS_PER_LEASE, POLL_SECONDS)
+
+    def claim(self, filename, isdone):
+        """Claims a frame and returns CLAIMED, FINISHED if isdone accepts its done record, or BUSY while leased"""
+        generation = 0
+        while os.path.exists(self.getpath(filename, generation)):
+            generation += 1
+
+        if generation > 0:
+            newest_path = self.getpath(filename, generation - 1)
+            state = self.readfile(newest_path)
+            if state is not None and state.get('state') == 'done':
+                # a frame finished from an older source or with other settings is denoised again
+                if isdone(state['record']):
+                    return FINISHED
+            else:
+                try:
+                    if time.time() - os.path.getmtime(newest_path) < self.lease_seconds:
+                        return BUSY
+                except OSError:
+                    return BUSY
+
+        temp_path = self.writefile(self.getpath(filename, generation), {'state': 'leased'})
+        try:
+            os.link(temp_path, self.getpath(filename, generation))
+        except FileExistsError:
+            return BUSY
+        finally:
+            os.remove(temp_path)
+
+        with self.lock:
+            self.held[filename] = generation
+        return CLAIMED
+
+    def isheld(self, filename):
+        """Returns true if this node still holds the lease on a frame, no other node having claimed it since"""
+        with self.lock:
+            generation = self.held.get(filename)
+        return (generation is not None and
+                os.path.exists(self.getpath(filename, generation)) and
+                not os.path.exists(self.getpath(filename, generation + 1)))
+
+    def finish(self, filename, record):
+        """Marks a frame this node published as done, with its manifest record"""
+        with self.lock:
+            generation = self.held.pop(filename)
+        temp_path = self.writefile(self.getpath(filename, generation), {'state': 'done', 'record': record})
+        os.replace(temp_path, self.getpath(filename, generation))
+
+    def release(self, filename):
+        """Gives up the lease on a frame this node did not publish, so another node may claim it"""
+        with self.lock:
+            generation = self.held.pop(filename, None)
+        # the lease is expired at once rather than removed, since removing it would hand its generation to the
+        # next claimant while other nodes may still be looking at it, and one another node has moved past is left be
+        if generation is not None and not os.path.exists(self.getpath(filename, generation + 1)):
+            try:
+                os.utime(self.getpath(filename, generation), (0, 0))
+            except OSError:
+                pass
+
+    def renew(self):
+        """Touches every lease this node holds so other nodes see it is still working on the frames"""
+        with self.lock:
+            paths = [self.getpath(filename, generation) for filename, generation in self.held.items()]
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError as error:
+                print(">> D-NOISE ERROR: could not renew lease {0}: {1}".format(path, error))
+
+    def start(self):
+        """Starts renewing the held leases in the background"""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops renewing the held leases"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / RENEWALS_PER_LEASE):
+            self.renew()
@@ -0,0 +1,82 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# With extra passes enabled, D-NOISE's compositor nodes write the guide passes of every rendered view
+# layer, and the beauty of every view layer when there are several, into one folder per layer:
+#   <layer>/Normal_0001.exr, <layer>/Albedo_0001.exr, <layer>/Image_0001.exr
+# With multiview, every view gets its own files, whose names end in the view's suffix: Normal_0001_L.exr
+# Since every file name is known from the layer, pass, frame and view, a frame's passes are found
+# without listing the folders, and passes left over from other frames are never mistaken for its own.
+
+import os
+
+# name of the folder next to rendered frames that denoised view layers are exported to
+LAYERS_DIR_NAME = "D-NOISE Layers"
+
+# passes written for each view layer, the beauty only when there are several layers
+LAYER_PASS_NAMES = ('Image', 'Normal', 'Albedo')
+
+# digits the frame number in a pass file name is padded to
+FRAME_PADDING = 4
+
+
+def getslotpath(layer, pass_name):
+    """Returns the File Output node slot path that a view layer's pass is written to"""
+    return "{0}/{1}_{2}".format(layer, pass_name, '#' * FRAME_PADDING)
+
+
+def getpasspath(directory, layer, pass_name, frame, view=''):
+    """Returns the path the File Output node writes a view layer's pass to for a frame and view"""
+    return os.path.join(directory, layer, "{0}_{1:0{2}d}{3}.exr".format(pass_name, frame, FRAME_PADDING, view))
+
+
+def takelayerpasses(passes_dir, directory, layer_names, frame, views):
+    """Moves a frame's pass files into a directory and returns them by (layer, frame, view) and pass"""
+    layer_passes = {}
+    for layer in layer_names:
+        for view in views:
+            for pass_name in LAYER_PASS_NAMES:
+                pass_path = getpasspath(passes_dir, layer, pass_name, frame, view)
+                if not os.path.exists(pass_path):
+                    continue
+
+                taken_path = getpasspath(directory, layer, pass_name, frame, view)
+                os.makedirs(os.path.dirname(taken_path), exist_ok=True)
+                os.replace(pass_path, taken_path)
+                layer_passes.setdefault((layer, frame, view), {})[pass_name] = taken_path
+    return layer_passes
+
+
+def getbatch(frame_paths, layer_passes, layer_names, frame, layers_dir):
+    """Returns the (source, output, normal, albedo) images to denoise for a frame and its view layers"""
+    # each view of the composite is guided by the first layer's passes, and with several layers every
+    # layer's own beauty is denoised with its passes into the layers folder as well
+    batch = []
+    for view, source_path, output_path in frame_paths:
+        guides = layer_passes.get((layer_names[0], frame, view), {}) if layer_names else {}
+        batch.append((source_path, output_path, guides.get('Normal'), guides.get('Albedo')))
+
+    if len(layer_names) > 1:
+        for (layer, pass_frame, view), passes in sorted(layer_passes.items()):
+            if pass_frame == frame and 'Image' in passes:
+                output_path = os.path.join(layers_dir, layer, os.path.basename(passes['Image']))
+                batch.append((passes['Image'], output_path, passes.get('Normal'), passes.get('Albedo')))
+
+    return batch
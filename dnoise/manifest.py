@@ -0,0 +1,105 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# The manifest is a JSON lines file with one record per finished frame. Records are only ever
+# appended, so a crash can at worst cut off the last line, and the newest record for a frame wins.
+# Nodes denoising a sequence together each append to a manifest of their own, named after the node,
+# since appends to one shared file are not atomic on network filesystems.
+
+import json
+import os
+
+# file name of the manifest inside a sequence's export directory
+MANIFEST_NAME = ".dnoise_manifest.jsonl"
+
+
+def getmanifestname(owner=None):
+    """Returns the file name of the manifest of one node, or of the sequence's own manifest if owner is None"""
+    if owner is None:
+        return MANIFEST_NAME
+    return ".dnoise_manifest.{0}.jsonl".format(owner)
+
+
+def loadmanifest(path, repair=False):
+    """Returns the newest record for every frame in a manifest file, keyed by source file name"""
+    records = {}
+
+    if not os.path.exists(path):
+        return records
+
+    line = '\n'
+    with open(path, 'r') as f:
+        for line in f:
+            # a last line without an end is still being written by another node, or was cut off when the last
+            # job was interrupted
+            if not line.endswith('\n'):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a cut off line that has been ended since
+                continue
+            records[record['source']] = record
+
+    # end a cut off line so the next record starts on a line of its own, which only the node that appends to
+    # the manifest may do, since in another node's manifest the line may still be being written
+    if repair and not line.endswith('\n'):
+        with open(path, 'a') as f:
+            f.write('\n')
+
+    return records
+
+
+def loadmanifests(directory, own_path=None):
+    """Returns the newest record of every frame in all of the manifests in a directory, repairing only own_path"""
+    paths = [os.path.join(directory, filename) for filename in os.listdir(directory)
+             if filename.startswith('.dnoise_manifest.') and filename.endswith('.jsonl')]
+    records = {}
+    for path in sorted(paths, key=os.path.getmtime):
+        records.update(loadmanifest(path, path == own_path))
+    return records
+
+
+def isdone(records, source_path, output_path, settings):
+    """Returns true if a frame was denoised from the current source file with the same settings and still exists"""
+    record = records.get(os.path.basename(source_path))
+    if record is None:
+        return False
+
+    source_stat = os.stat(source_path)
+    return (record['size'] == source_stat.st_size and
+            record['mtime'] == source_stat.st_mtime_ns and
+            record['settings'] == settings and
+            record['output'] == os.path.basename(output_path) and
+            os.path.exists(output_path))
+
+
+def recordframe(path, source_path, output_path, settings):
+    """Appends a record of a finished frame to a manifest file and returns the record"""
+    source_stat = os.stat(source_path)
+    record = {'source': os.path.basename(source_path),
+              'size': source_stat.st_size,
+              'mtime': source_stat.st_mtime_ns,
+              'settings': settings,
+              'output': os.path.basename(output_path)}
+
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    return record
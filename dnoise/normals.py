@@ -0,0 +1,31 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# number of pixels rotated at a time when converting normals to screen space
+NORMAL_CHUNK_SIZE = 1048576
+
+
+def rotatenormals(pixels, rotation, chunk_size=NORMAL_CHUNK_SIZE):
+    """Rotates the xyz channels of an (n, 4) pixel array in place, a chunk at a time to bound temporary memory"""
+    rotation = rotation.T
+
+    for start in range(0, len(pixels), chunk_size):
+        normals = pixels[start:start + chunk_size, :3]
+        normals[...] = normals @ rotation
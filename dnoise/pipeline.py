@@ -0,0 +1,86 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import queue
+import threading
+
+
+class DenoiseQueue:
+    """Runs queued denoise jobs on a background thread, blocking new jobs while the queue is full"""
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, job, on_cancel=None):
+        """Queues a job, a callable taking no arguments, waiting for room if the queue is full"""
+        # a job dropped by cancel has on_cancel called instead, so it can still clean up after itself
+        if self.cancelled.is_set():
+            if on_cancel is not None:
+                on_cancel()
+            return
+
+        self.queue.put((job, on_cancel))
+
+    def finish(self):
+        """Marks the end of the jobs, letting the queued ones run to completion in the background"""
+        self.queue.put(None)
+
+    def cancel(self):
+        """Drops every job that has not started yet and stops the queue once the running job is done"""
+        self.cancelled.set()
+        try:
+            while True:
+                self.drop(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        self.queue.put(None)
+
+    def wait(self, timeout=None):
+        """Waits for the queue to stop and returns true if it has"""
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def run(self):
+        """Runs jobs in the order they were queued until the queue is finished or cancelled"""
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            if self.cancelled.is_set():
+                self.drop(entry)
+                continue
+
+            try:
+                entry[0]()
+            except Exception as error:
+                print(">> D-NOISE ERROR: queued denoise failed: {0}".format(error))
+
+    def drop(self, entry):
+        """Calls the cancel callback of a queued job that will not run"""
+        # the end of the queue, put by finish, has nothing to cancel
+        if entry is None or entry[1] is None:
+            return
+
+        try:
+            entry[1]()
+        except Exception as error:
+            print(">> D-NOISE ERROR: cancelling a queued denoise failed: {0}".format(error))
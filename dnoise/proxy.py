@@ -0,0 +1,83 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# A progressive denoise first denoises a proxy, the image box filtered down to a few hundred thousand
+# pixels, which the denoiser finishes in a fraction of a second, and shows it scaled back up while the
+# full resolution image is denoised in the background. The proxy is only a preview: it is replaced by
+# the full resolution result, so it is scaled down and up with cheap filters rather than accurate ones.
+
+import math
+import numpy as np
+
+# most pixels a proxy may have, about a 512 x 512 image
+PROXY_PIXELS = 262144
+
+
+def getfactor(width, height, max_pixels=PROXY_PIXELS):
+    """Returns the whole factor an image is scaled down by for its proxy to fit in max_pixels"""
+    return max(1, math.ceil(math.sqrt(width * height / max_pixels)))
+
+
+def downscale(pixels, factor):
+    """Returns a (height, width, channels) image box filtered down by a whole factor"""
+    height, width, channels = pixels.shape
+    proxy_height, proxy_width = -(-height // factor), -(-width // factor)
+    sums = np.zeros((proxy_height, proxy_width, channels), np.float32)
+
+    # the blocks are summed a pixel offset at a time, factor squared strided adds on the proxy's size, which is
+    # several times faster than reducing the full size image block by block
+    for row in range(factor):
+        for column in range(factor):
+            offset = pixels[row::factor, column::factor]
+            sums[:offset.shape[0], :offset.shape[1]] += offset
+
+    row_counts = np.minimum(factor, height - np.arange(0, height, factor)).astype(np.float32)
+    column_counts = np.minimum(factor, width - np.arange(0, width, factor)).astype(np.float32)
+    sums /= row_counts[:, None, None] * column_counts[None, :, None]
+    return sums
+
+
+def upscale(pixels, width, height):
+    """Returns a (height, width, channels) image bilinearly scaled up from a smaller proxy image"""
+    proxy_height, proxy_width = pixels.shape[:2]
+    row_index, row_weight = getsamples(proxy_height, height)
+    column_index, column_weight = getsamples(proxy_width, width)
+
+    # rows are interpolated first, on the proxy's width, and the full size image is then built in place
+    rows = pixels[row_index]
+    below = pixels[np.minimum(row_index + 1, proxy_height - 1)]
+    below -= rows
+    below *= row_weight[:, None, None]
+    rows += below
+
+    upscaled = np.take(rows, column_index, axis=1)
+    right = np.take(rows, np.minimum(column_index + 1, proxy_width - 1), axis=1)
+    right -= upscaled
+    right *= column_weight[None, :, None]
+    upscaled += right
+    return upscaled
+
+
+def getsamples(proxy_length, length):
+    """Returns the index of the proxy pixel before each pixel's centre along one axis and the weight of the one after"""
+    centres = (np.arange(length, dtype=np.float32) + 0.5) * (proxy_length / length) - 0.5
+    centres = np.clip(centres, 0, proxy_length - 1)
+    index = np.minimum(centres.astype(np.int64), proxy_length - 1)
+    return index, (centres - index).astype(np.float32)
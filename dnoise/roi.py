@@ -0,0 +1,97 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# When a render uses a render border or a transparent film, most of the frame can be empty. Only the
+# region of interest, the render border or the bounding box of the pixels with any alpha, is then
+# denoised, padded by a margin so the denoiser sees the surroundings of the region's edges, and the
+# denoised region is pasted back into the frame. Boxes are (x0, y0, x1, y1) pixel boxes like the tiles
+# of dnoise.tiles, counted from the first row of the pixel array, which is the bottom row in Blender.
+
+import numpy as np
+from . import tiles
+
+# pixels a region of interest is padded by on every side that does not reach the edge of the frame
+ROI_MARGIN = tiles.TILE_OVERLAP
+
+# largest share of a frame's area a region may cover for denoising it on its own to be worth it
+ROI_MAX_AREA = 0.8
+
+
+def getborderbox(border, width, height, margin=ROI_MARGIN):
+    """Returns the padded box of a render border given as (min x, min y, max x, max y) fractions of the frame"""
+    min_x, min_y, max_x, max_y = border
+    return padbox((int(np.floor(min_x * width)), int(np.floor(min_y * height)),
+                   int(np.ceil(max_x * width)), int(np.ceil(max_y * height))), width, height, margin)
+
+
+def getalphabox(pixels, margin=ROI_MARGIN):
+    """Returns the padded bounding box of the pixels with any alpha, or None if there are none"""
+    height, width = pixels.shape[:2]
+    alpha = pixels[:, :, 3] > 0
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.size == 0:
+        return None
+    columns = np.flatnonzero(alpha[rows[0]:rows[-1] + 1].any(axis=0))
+    return padbox((int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1), width, height, margin)
+
+
+def padbox(box, width, height, margin=ROI_MARGIN):
+    """Returns a box grown by a margin on every side and clipped to the frame"""
+    x0, y0, x1, y1 = box
+    return max(x0 - margin, 0), max(y0 - margin, 0), min(x1 + margin, width), min(y1 + margin, height)
+
+
+def intersect(box, other):
+    """Returns the overlap of two boxes"""
+    x0, y0 = max(box[0], other[0]), max(box[1], other[1])
+    return x0, y0, max(min(box[2], other[2]), x0), max(min(box[3], other[3]), y0)
+
+
+def union(box, other):
+    """Returns the smallest box covering two boxes"""
+    return min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+
+
+def getroi(width, height, border=None, images=(), margin=ROI_MARGIN, max_area=ROI_MAX_AREA):
+    """Returns the box of a frame worth denoising on its own, or None to denoise the whole frame"""
+    # the box lies within the render border, if any, and around the pixels with alpha in any of the
+    # (height, width, 4) images, such as the views of the frame
+    box = (0, 0, width, height)
+    if border is not None:
+        box = intersect(box, getborderbox(border, width, height, margin))
+
+    # fully transparent frames have nothing to crop to, and are denoised as they are
+    alpha_boxes = [alpha_box for alpha_box in map(lambda pixels: getalphabox(pixels, margin), images)
+                   if alpha_box is not None]
+    if alpha_boxes:
+        alpha_box = alpha_boxes[0]
+        for other in alpha_boxes[1:]:
+            alpha_box = union(alpha_box, other)
+        box = intersect(box, alpha_box)
+
+    x0, y0, x1, y1 = box
+    if (x1 - x0) * (y1 - y0) == 0 or (x1 - x0) * (y1 - y0) > max_area * width * height:
+        return None
+    return box
+
+
+def pastebox(pixels, region, box):
+    """Pastes the pixels of a region back into the box of a (height, width, channels) image it was cropped from"""
+    x0, y0, x1, y1 = box
+    pixels[y0:y1, x0:x1] = region
@@ -0,0 +1,100 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Background jobs, such as sequence denoises, run one at a time from a queue ordered by priority, so a
+# second sequence waits for the first instead of competing with it for the denoiser. Preemption happens
+# a frame at a time: the workers serve denoise requests by priority, so an image denoised on demand
+# takes the next worker to come free instead of waiting behind every queued frame of a sequence.
+
+import heapq
+import itertools
+import threading
+
+
+class JobQueue:
+    """Runs queued jobs on a background thread one at a time, highest priority first"""
+
+    def __init__(self):
+        self.pending = []
+        self.order = itertools.count()
+        self.current = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, run):
+        """Queues a timing.Job and the callable that runs it, which takes no arguments"""
+        with self.condition:
+            heapq.heappush(self.pending, (job.priority, next(self.order), job, run))
+            self.condition.notify()
+
+    def cancel(self, job):
+        """Cancels a job, dropping it if it has not started yet"""
+        job.cancel()
+        with self.condition:
+            for entry in self.pending:
+                if entry[2] is job:
+                    self.pending.remove(entry)
+                    heapq.heapify(self.pending)
+                    break
+            else:
+                return
+
+        job.finish('cancelled')
+
+    def cancelall(self):
+        """Cancels the running job and every queued one"""
+        for job in self.jobs():
+            self.cancel(job)
+
+    def jobs(self):
+        """Returns the running job, if any, followed by the queued jobs in the order they will run"""
+        with self.condition:
+            queued = [entry[2] for entry in sorted(self.pending)]
+            return ([self.current] if self.current is not None else []) + queued
+
+    def stop(self, timeout=None):
+        """Cancels every job and waits for the queue's thread to exit"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.cancelall()
+        self.thread.join(timeout)
+
+    def run(self):
+        """Runs jobs as they are queued until the queue is stopped"""
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                priority, order, job, run = heapq.heappop(self.pending)
+                self.current = job
+
+            try:
+                run()
+            except Exception as error:
+                print(">> D-NOISE ERROR: {0} failed: {1}".format(job.name, error))
+            finally:
+                job.finish('cancelled' if job.iscancelled() else 'done')
+                with self.condition:
+                    self.current = None
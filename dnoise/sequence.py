@@ -0,0 +1,206 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import denoiser, farm, manifest, timing
+
+# file extensions of the image formats the denoiser can read
+IMAGE_EXTENSIONS = {'bmp', 'png', 'jpg', 'tga', 'exr', 'hdr', 'tif'}
+
+# name of the directory inside a sequence's directory that denoised frames are exported to
+EXPORT_DIR_NAME = "D-NOISE Export"
+
+# names of the guide passes, as written by the D-NOISE compositor nodes
+PASS_NAMES = ('Normal', 'Albedo')
+
+# digits at the end of a file name, not counting its extension
+FRAME_NUMBER = re.compile(r'(\d+)$')
+
+
+def findframes(directory):
+    """Returns the sorted file names of the images in a directory"""
+    return sorted(filename for filename in os.listdir(directory)
+                  if os.path.splitext(filename)[1][1:].lower() in IMAGE_EXTENSIONS)
+
+
+def getframenumber(filename):
+    """Returns the frame number at the end of a file name, or None if it does not end in one"""
+    match = FRAME_NUMBER.search(os.path.splitext(filename)[0])
+    return int(match.group(1)) if match else None
+
+
+def findpasses(directory):
+    """Returns the paths of the guide passes in a directory, keyed by frame number and then by pass name"""
+    passes = {}
+    for filename in findframes(directory):
+        for pass_name in PASS_NAMES:
+            if pass_name in filename:
+                passes.setdefault(getframenumber(filename), {})[pass_name] = os.path.join(directory, filename)
+    return passes
+
+
+def denoisesequence(directory, backend, hdr=0, blend=0, jobs=1, passes_dir=None, denoise_cache=None, on_progress=None,
+                    job=None, leases=None):
+    """Denoises every frame of an image sequence with a backend and returns the frames that failed"""
+    # on_progress is called with the timing.Job whenever a frame is finished, a Job passed in lets the caller
+    # cancel the sequence, and farm.Leases share the frames with the other nodes of a farm
+    export_dir = os.path.join(directory, EXPORT_DIR_NAME)
+    # the nodes of a farm may all be making the directory at once
+    os.makedirs(export_dir, exist_ok=True)
+    owner = leases.owner if leases is not None else None
+
+    # guide passes are indexed once so every frame finds its own in constant time
+    passes = findpasses(passes_dir) if passes_dir is not None else {}
+    pass_paths = set(path for frame_passes in passes.values() for path in frame_passes.values())
+    frames = [filename for filename in findframes(directory) if os.path.join(directory, filename) not in pass_paths]
+
+    def getframepasses(filename):
+        frame_passes = passes.get(getframenumber(filename), {})
+        return frame_passes.get('Normal'), frame_passes.get('Albedo')
+
+    def getframesettings(filename):
+        return denoiser.getsettings(*getframepasses(filename), hdr=hdr, blend=blend, backend=backend.name)
+
+    def isrecorded(records, filename):
+        return manifest.isdone(records, os.path.join(directory, filename), os.path.join(export_dir, filename),
+                               getframesettings(filename))
+
+    def getoutputpath(filename):
+        # each node of a farm denoises into hidden files of its own until the frame is published
+        if owner is None:
+            return os.path.join(export_dir, "." + filename)
+        return os.path.join(export_dir, ".{0}.{1}".format(owner, filename))
+
+    # frames finished by an earlier, interrupted run, or by any node of a farm, are skipped if neither they nor
+    # the settings changed
+    manifest_path = os.path.join(export_dir, manifest.getmanifestname(owner))
+    records = manifest.loadmanifests(export_dir, manifest_path)
+    remaining = [filename for filename in frames if not isrecorded(records, filename)]
+
+    failed = []
+    if job is None:
+        job = timing.Job(directory, on_progress=on_progress)
+    if job.log_path is None:
+        job.log_path = os.path.join(export_dir, timing.getlogname(owner))
+
+    def denoiseframe(filename, timer):
+        # frames are denoised straight from the sequence into a hidden file next to their final export path
+        source_path = os.path.join(directory, filename)
+        output_path = getoutputpath(filename)
+        normal_path, albedo_path = getframepasses(filename)
+        returncodes = []
+
+        # frames that have not started when the job is cancelled are dropped
+        if job.iscancelled():
+            return None
+
+        def run(path):
+            returncodes.append(backend.denoise(source_path, path, normal_path, albedo_path, hdr, blend, job.priority))
+
+        with timer.stage('denoise'):
+            if denoise_cache is not None:
+                key = denoise_cache.key([source_path, normal_path, albedo_path], getframesettings(filename))
+                denoise_cache.fetch(key, output_path, run)
+            else:
+                run(output_path)
+
+        return returncodes[0] if returncodes else 0
+
+    def publishframe(filename, timer, future):
+        output_path = getoutputpath(filename)
+        export_path = os.path.join(export_dir, filename)
+
+        if future.result() is None:
+            if leases is not None:
+                leases.release(filename)
+            timer.finish('cancelled')
+            return
+
+        if future.result() != 0 or not os.path.exists(output_path):
+            if leases is not None:
+                leases.release(filename)
+            failed.append(filename)
+            timer.finish('failed')
+            return
+
+        # a node that stalled for longer than its lease leaves the frame to the node that claimed it since
+        if leases is not None and not leases.isheld(filename):
+            os.remove(output_path)
+            timer.finish('skipped')
+            return
+
+        with timer.stage('save'):
+            os.replace(output_path, export_path)
+            record = manifest.recordframe(manifest_path, os.path.join(directory, filename), export_path,
+                                          getframesettings(filename))
+            if leases is not None:
+                leases.finish(filename, record)
+        timer.finish()
+
+    job.start(len(frames), len(frames) - len(remaining))
+    pending = deque()
+    if leases is not None:
+        leases.start()
+
+    def claimframe(filename):
+        if leases is None:
+            return farm.CLAIMED
+        return leases.claim(filename, lambda record: isrecorded({filename: record}, filename))
+
+    # frames are published in order, and at most two frames per job wait to be published
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while remaining and not job.iscancelled():
+                busy = []
+                for filename in remaining:
+                    if job.iscancelled():
+                        break
+
+                    # frames another node of a farm is working on are checked on again after this pass, in case
+                    # that node stops, and those it has finished since this run started are left to it
+                    claim = claimframe(filename)
+                    if claim == farm.BUSY:
+                        busy.append(filename)
+                        continue
+
+                    timer = job.frame(filename)
+                    if claim == farm.FINISHED:
+                        timer.finish('skipped')
+                        continue
+
+                    pending.append((filename, timer, executor.submit(denoiseframe, filename, timer)))
+                    if len(pending) >= 2 * jobs:
+                        publishframe(*pending.popleft())
+
+                while pending:
+                    publishframe(*pending.popleft())
+
+                remaining = busy
+                if remaining:
+                    job.cancelled.wait(leases.getpollseconds())
+    finally:
+        if leases is not None:
+            leases.stop()
+
+    job.finish('cancelled' if job.iscancelled() else 'done')
+    return failed
@@ -0,0 +1,86 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Images are split into tiles whose cores cover the image without overlapping. Each tile is padded by
+# the overlap on every side that borders another tile, and across the padding the weights of two
+# neighbouring tiles ramp linearly in opposite directions, so the weights of all tiles add up to one
+# everywhere and the stitched tiles blend into each other without visible seams.
+
+import math
+import numpy as np
+
+# estimated peak memory the denoiser needs for each pixel it denoises at once
+DENOISER_BYTES_PER_PIXEL = 96
+
+# pixels each tile is padded by on the sides it shares with other tiles
+TILE_OVERLAP = 32
+
+
+def gettilesize(memory_budget, overlap=TILE_OVERLAP, bytes_per_pixel=DENOISER_BYTES_PER_PIXEL):
+    """Returns the width of the largest square tile core whose padded tile fits in a memory budget in bytes"""
+    padded_size = int(math.sqrt(memory_budget / bytes_per_pixel))
+    return max(padded_size - 2 * overlap, 4 * overlap)
+
+
+def splitaxis(length, tile_size, overlap):
+    """Returns the (start, end, padded start, padded end) spans of evenly sized tiles along one image axis"""
+    count = max(1, math.ceil(length / tile_size))
+    bounds = [round(index * length / count) for index in range(count + 1)]
+    return [(start, end, max(start - overlap, 0), min(end + overlap, length))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def splittiles(width, height, tile_size, overlap=TILE_OVERLAP):
+    """Returns the padded (x0, y0, x1, y1) boxes of the tiles that cover an image, row by row"""
+    return [(padded_x0, padded_y0, padded_x1, padded_y1)
+            for y0, y1, padded_y0, padded_y1 in splitaxis(height, tile_size, overlap)
+            for x0, x1, padded_x0, padded_x1 in splitaxis(width, tile_size, overlap)]
+
+
+def ramp(start, end, length, overlap):
+    """Returns the weights along one axis of a padded tile, ramping across the padding shared with other tiles"""
+    weights = np.ones(end - start, dtype=np.float32)
+    positions = np.arange(start, end, dtype=np.float32) + 0.5
+
+    if start > 0:
+        weights = np.minimum(weights, (positions - start) / (2 * overlap))
+    if end < length:
+        weights = np.minimum(weights, (end - positions) / (2 * overlap))
+
+    return np.clip(weights, 0, 1)
+
+
+def featherweights(box, width, height, overlap=TILE_OVERLAP):
+    """Returns the (height, width, 1) blending weights of a padded tile box"""
+    x0, y0, x1, y1 = box
+    return np.outer(ramp(y0, y1, height, overlap), ramp(x0, x1, width, overlap))[:, :, np.newaxis]
+
+
+def croptile(pixels, box):
+    """Returns a copy of the pixels of a (height, width, channels) image inside a tile box"""
+    x0, y0, x1, y1 = box
+    return np.ascontiguousarray(pixels[y0:y1, x0:x1])
+
+
+def addtile(stitched, tile, box, overlap=TILE_OVERLAP):
+    """Adds a denoised tile to a (height, width, channels) image that starts out as zeros, weighted for blending"""
+    height, width = stitched.shape[:2]
+    x0, y0, x1, y1 = box
+    stitched[y0:y1, x0:x1] += tile * featherweights(box, width, height, overlap)
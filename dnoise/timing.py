@@ -0,0 +1,204 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Every denoise job reports events to the hooks registered with addhook and, if it has a log, appends
+# them to it as JSON lines. Events are dicts with an "event" key:
+#   {"event": "job_start", "job": ..., "time": ..., "total": 240, "completed": 0}
+#   {"event": "frame", "job": ..., "time": ..., "frame": "0001.png", "status": "done",
+#    "seconds": 1.52, "stages": {"passes": 0.08, "denoise": 1.41, "save": 0.03}}
+#   {"event": "job_end", "job": ..., "time": ..., "status": "done", "completed": 240, "failed": 0,
+#    "seconds": 371.2, "fps": 0.65}
+# Frame statuses are "done", "failed", "cancelled" or "skipped", for frames another node of a farm denoised,
+# and job statuses "done" or "cancelled". Stages are any of "save", "passes", "preview", for the proxy
+# of a progressive denoise, "denoise", "load" and "cleanup", and only the stages a frame went through
+# are listed. A frame's seconds count from when it was queued, so any time beyond its stages was spent
+# waiting.
+
+import contextlib
+import json
+import threading
+import time
+from collections import deque
+from . import worker
+
+# hidden file in a sequence's export directory that its denoise jobs are logged to
+LOG_NAME = ".dnoise_log.jsonl"
+
+# number of recent frames that the frame rate is measured over
+RATE_WINDOW = 20
+
+# callables that receive every event of every job
+HOOKS = []
+HOOK_LOCK = threading.Lock()
+
+
+def addhook(callback):
+    """Registers a callable that receives every job's events, called one event at a time from the denoising threads"""
+    with HOOK_LOCK:
+        if callback not in HOOKS:
+            HOOKS.append(callback)
+
+
+def removehook(callback):
+    """Unregisters a callable registered with addhook"""
+    with HOOK_LOCK:
+        if callback in HOOKS:
+            HOOKS.remove(callback)
+
+
+def emit(event, log_path=None):
+    """Appends an event to a log and sends it to every hook, printing hooks' errors rather than raising them"""
+    if log_path is not None:
+        with open(log_path, 'a') as log_file:
+            log_file.write(json.dumps(event) + '\n')
+
+    with HOOK_LOCK:
+        for callback in HOOKS:
+            try:
+                callback(event)
+            except Exception as error:
+                print(">> D-NOISE ERROR: timing hook failed: {0}".format(error))
+
+
+def getlogname(owner=None):
+    """Returns the file name of the log of one node of a farm, or of the sequence's own log if owner is None"""
+    if owner is None:
+        return LOG_NAME
+    return ".dnoise_log.{0}.jsonl".format(owner)
+
+
+def formatduration(seconds):
+    """Returns a duration as H:MM:SS"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return "{0}:{1:02d}:{2:02d}".format(minutes // 60, minutes % 60, seconds)
+
+
+class Job:
+    """The progress, timing and cancellation of one denoise job, such as a sequence or an animation render"""
+
+    def __init__(self, name, log_path=None, on_progress=None, priority=worker.BACKGROUND):
+        self.name = "{0}@{1:.3f}".format(name, time.time())
+        self.log_path = log_path
+        self.on_progress = on_progress
+        self.priority = priority
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self.finished = False
+        self.times = deque([self.started], RATE_WINDOW + 1)
+
+    def event(self, name, **fields):
+        return dict(event=name, job=self.name, time=round(time.time(), 3), **fields)
+
+    def start(self, total, completed=0):
+        """Starts the job, counting frames already completed by an earlier run as done"""
+        with self.lock:
+            self.total = total
+            self.completed = completed
+            emit(self.event('job_start', total=total, completed=completed), self.log_path)
+        self.progress()
+
+    def frame(self, frame):
+        """Returns a timer for one frame of the job"""
+        return FrameTimer(self, frame)
+
+    def record(self, frame, status, stages, seconds):
+        """Counts a finished frame and reports its timing"""
+        # cancelled frames are not counted, and skipped ones do not count towards the frame rate
+        with self.lock:
+            if status != 'cancelled':
+                self.completed += 1
+                self.total = max(self.total, self.completed)
+            if status not in ('cancelled', 'skipped'):
+                self.times.append(time.monotonic())
+            if status == 'failed':
+                self.failed += 1
+            emit(self.event('frame', frame=frame, status=status, seconds=round(seconds, 4),
+                            stages={stage: round(duration, 4) for stage, duration in stages.items()}),
+                 self.log_path)
+        self.progress()
+
+    def finish(self, status='done'):
+        """Ends the job and reports its totals, only the first call has any effect"""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            emit(self.event('job_end', status=status, completed=self.completed, failed=self.failed,
+                            seconds=round(time.monotonic() - self.started, 3), fps=round(self.fps(), 4)),
+                 self.log_path)
+        self.progress()
+
+    def cancel(self):
+        """Asks the job to stop, frames already being denoised are finished but no new ones are started"""
+        self.cancelled.set()
+
+    def iscancelled(self):
+        """Returns true if the job has been asked to stop"""
+        return self.cancelled.is_set()
+
+    def fps(self):
+        """Returns the frames denoised per second over the last few frames"""
+        if len(self.times) < 2 or self.times[-1] == self.times[0]:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+    def eta(self):
+        """Returns the estimated seconds until every frame is denoised, or None before any frame is"""
+        rate = self.fps()
+        return (self.total - self.completed) / rate if rate else None
+
+    def describe(self):
+        """Returns the progress, frame rate and remaining time as shown to the user"""
+        text = "({0}/{1}".format(self.completed, self.total)
+        eta = self.eta()
+        if eta is not None:
+            text += ", {0:.2f} fps, {1} left".format(self.fps(), formatduration(eta))
+        return text + ")"
+
+    def progress(self):
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+
+class FrameTimer:
+    """Times the stages one frame goes through, reporting them to its job once the frame is finished"""
+
+    def __init__(self, job, frame):
+        self.job = job
+        self.frame = frame
+        self.stages = {}
+        self.started = time.monotonic()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times the code run inside the with block as a stage, adding to the stage's earlier time if any"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.monotonic() - start
+
+    def finish(self, status='done'):
+        """Reports the frame to its job"""
+        self.job.record(self.frame, status, self.stages, time.monotonic() - self.started)
@@ -0,0 +1,272 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# This module must not import bpy: it is also run on its own as the worker process.
+#
+# Protocol: the add-on writes one JSON request per line to the worker's stdin, each a batch of one or
+# more denoiser runs, such as every view layer of a frame,
+#   {"batch": [["-i", "source.png", ...], ...], "cwd": "/path/to/job"}
+# and the worker runs them in order and answers each request with one JSON line on its stdout,
+#   {"returncodes": [0, ...]}
+#
+# A pool can spread its workers over several GPUs, each worker seeing only its own device through
+# CUDA_VISIBLE_DEVICES, and sends each request to a free device with room for it in the memory budget
+# given for that device.
+
+import heapq
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# seconds to wait for a worker to exit after its stdin is closed
+STOP_TIMEOUT = 5
+
+# priorities of denoise requests, lower goes first: images denoised on demand jump ahead of the frames
+# of an animation being rendered, and those jump ahead of background sequences
+INTERACTIVE = 0
+RENDER = 1
+BACKGROUND = 2
+
+# environment variable that limits the devices a worker's denoiser can see
+DEVICE_VARIABLE = 'CUDA_VISIBLE_DEVICES'
+
+# exit code reported for a denoiser that cannot be run, such as before the OptiX binaries are installed,
+# the same code a shell reports for a missing command
+NOT_RUNNABLE = 127
+
+
+class Device:
+    """A GPU shared by some of a pool's workers, with the memory requests may use on it and how fast it has been"""
+
+    def __init__(self, name=None, memory=0):
+        # the CUDA device number as a string, or None for whichever device the denoiser picks itself
+        self.name = name
+        # bytes the requests running on the device may use together, 0 for no limit
+        self.memory = memory
+        self.used = 0
+        self.busy = 0
+        self.images = 0
+        self.seconds = 0.0
+
+    def fits(self, memory):
+        """Returns true if a request needing the given bytes can start on the device now"""
+        # a request larger than the whole budget still runs once it has the device to itself
+        return self.memory == 0 or self.busy == 0 or self.used + memory <= self.memory
+
+    def rate(self):
+        """Returns the images per second a worker on the device has denoised so far"""
+        return self.images / self.seconds if self.seconds > 0 else 0
+
+    def getenv(self, env=None):
+        """Returns the environment for a worker on the device, based on the given one or this process's"""
+        if self.name is None:
+            return env
+        device_env = dict(os.environ if env is None else env)
+        device_env[DEVICE_VARIABLE] = self.name
+        return device_env
+
+    def stats(self):
+        """Returns how many images the device has denoised, in how many seconds of worker time"""
+        return {'device': self.name, 'images': self.images, 'seconds': round(self.seconds, 3),
+                'rate': round(self.rate(), 3)}
+
+
+def describedevice(stats):
+    """Returns a line describing the throughput of a device from its stats"""
+    name = "Default GPU" if stats['device'] is None else "GPU {0}".format(stats['device'])
+    return "{0}: {1} images, {2:.2f} images/s".format(name, stats['images'], stats['rate'])
+
+
+class DenoiserWorker:
+    """A long-lived worker process that runs denoiser jobs sent to it over stdin/stdout"""
+
+    def __init__(self, command, env=None, device=None):
+        self.command = command
+        self.env = env
+        self.device = device if device is not None else Device()
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts the worker process if it is not already running"""
+        if not self.isalive():
+            self.process = subprocess.Popen(self.command,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            env=self.env,
+                                            universal_newlines=True)
+
+    def stop(self):
+        """Stops the worker process, killing it if it does not exit on its own"""
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait(STOP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process.stdout.close()
+        self.process = None
+
+    def isalive(self):
+        """Returns true if the worker process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, batch, cwd=None):
+        """Sends a batch of denoiser arguments to the worker and returns the exit codes, restarting it once if needed"""
+        with self.lock:
+            for attempt in range(2):
+                self.start()
+                try:
+                    self.process.stdin.write(json.dumps({'batch': batch, 'cwd': cwd}) + '\n')
+                    self.process.stdin.flush()
+                    reply = self.process.stdout.readline()
+                except OSError:
+                    reply = ''
+
+                if reply:
+                    return json.loads(reply)['returncodes']
+
+                self.stop()
+
+        raise RuntimeError("D-NOISE worker {0} exited without replying".format(self.command))
+
+
+class WorkerPool:
+    """Denoiser workers spread over one or more devices, serving one request per worker at a time by priority"""
+
+    def __init__(self, command, size=1, env=None, devices=None):
+        self.command = command
+        self.env = env
+        self.devices = devices if devices else [Device()]
+        self.workers = []
+        self.idle = []
+        self.waiting = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.grow(size)
+
+    def grow(self, size):
+        """Adds workers until the pool holds at least the given number of them"""
+        with self.condition:
+            while len(self.workers) < size:
+                # workers are dealt out to the devices in turn
+                device = self.devices[len(self.workers) % len(self.devices)]
+                new_worker = DenoiserWorker(self.command, device.getenv(self.env), device)
+                self.workers.append(new_worker)
+                self.idle.append(new_worker)
+            self.condition.notify_all()
+
+    def pick(self, memory):
+        """Returns the idle worker on the least busy, then fastest, device with room for a request, or None"""
+        fitting = [idle_worker for idle_worker in self.idle if idle_worker.device.fits(memory)]
+        return min(fitting, key=lambda idle_worker: (idle_worker.device.busy, -idle_worker.device.rate()),
+                   default=None)
+
+    def acquire(self, priority, memory=0):
+        """Waits for an idle worker with room for the given bytes once no request ahead of this one waits"""
+        with self.condition:
+            ticket = (priority, next(self.order))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                idle_worker = self.pick(memory) if self.waiting[0] == ticket else None
+                if idle_worker is not None:
+                    break
+                self.condition.wait()
+
+            heapq.heappop(self.waiting)
+            self.idle.remove(idle_worker)
+            idle_worker.device.used += memory
+            idle_worker.device.busy += 1
+            # the next request in line may be able to take another idle worker
+            self.condition.notify_all()
+            return idle_worker
+
+    def release(self, idle_worker, memory=0, images=0, seconds=0):
+        """Returns a worker taken by acquire to the pool, with the images it denoised and how long it took"""
+        with self.condition:
+            idle_worker.device.used -= memory
+            idle_worker.device.busy -= 1
+            idle_worker.device.images += images
+            idle_worker.device.seconds += seconds
+            self.idle.append(idle_worker)
+            self.condition.notify_all()
+
+    def request(self, args, cwd=None, priority=BACKGROUND, memory=0):
+        """Sends a job to the next idle worker, waiting behind requests of higher priority if they are all busy"""
+        return self.requestbatch([args], cwd, priority, memory)[0]
+
+    def requestbatch(self, batch, cwd=None, priority=BACKGROUND, memory=0):
+        """Sends a batch of jobs to one worker in a single round trip and returns their exit codes"""
+        idle_worker = self.acquire(priority, memory)
+        start = time.perf_counter()
+        images = 0
+        try:
+            returncodes = idle_worker.request(batch, cwd)
+            images = len(batch)
+            return returncodes
+        finally:
+            self.release(idle_worker, memory, images, time.perf_counter() - start)
+
+    def isidle(self):
+        """Returns true if no worker is running a request"""
+        with self.condition:
+            return len(self.idle) == len(self.workers)
+
+    def stats(self):
+        """Returns the throughput of each device as Device.stats does"""
+        with self.condition:
+            return [device.stats() for device in self.devices]
+
+    def stop(self):
+        """Stops every worker in the pool"""
+        with self.condition:
+            for pool_worker in self.workers:
+                pool_worker.stop()
+
+
+def serve(executable):
+    """Runs the denoiser executable for every request read from stdin until stdin is closed"""
+    for line in sys.stdin:
+        job = json.loads(line)
+        # the denoiser's own output goes to stderr so it cannot corrupt the replies on stdout
+        returncodes = [run(executable, args, job['cwd']) for args in job['batch']]
+        sys.stdout.write(json.dumps({'returncodes': returncodes}) + '\n')
+        sys.stdout.flush()
+
+
+def run(executable, args, cwd):
+    """Runs the denoiser executable once and returns its exit code, NOT_RUNNABLE if it cannot be started"""
+    # the worker must outlive a missing or broken denoiser so the failure is reported like any other exit code
+    try:
+        return subprocess.call([executable] + args, cwd=cwd, stdout=sys.stderr)
+    except OSError as error:
+        sys.stderr.write(">> D-NOISE ERROR: cannot run {0}: {1}\n".format(executable, error))
+        return NOT_RUNNABLE
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
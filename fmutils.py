@@ -20,26 +20,58 @@ with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses
 
 import bpy
 import os
-import zipfile
 import shutil
+import tempfile
+import numpy as np
+from .dnoise import cache, download
+
+# on-disk cache of denoised images
+CACHE = None
+
+# image formats that store linear, floating point data
+LINEAR_FORMATS = ['OPEN_EXR', 'OPEN_EXR_MULTILAYER', 'HDR']
 
 #
 # EXTERNAL FILE MANAGEMENT
 #
 
 
-def save(directory, filename, image):
-    """Saves a Blender image file to an external directory"""
-    if image.name == 'Render Result':
-        image.save_render(filepath=os.path.join(directory, filename))
+def saverender(directory, filename, image, file_format):
+    """Saves the Render Result to an external directory in a given format, using the fastest lossless encoding"""
+    image_settings = bpy.context.scene.render.image_settings
+    saved_settings = (image_settings.file_format, image_settings.color_depth,
+                      image_settings.compression, image_settings.exr_codec)
+
+    image_settings.file_format = file_format
+    if file_format == 'OPEN_EXR':
+        image_settings.color_depth = '32'
+        image_settings.exr_codec = 'NONE'
     else:
-        shutil.copyfile(image.filepath, os.path.join(directory, filename))
+        image_settings.compression = 0
+
+    try:
+        image.save_render(filepath=os.path.join(directory, filename))
+    finally:
+        # the format goes back first, so the color depth is valid for it again
+        image_settings.file_format = saved_settings[0]
+        image_settings.color_depth = saved_settings[1]
+        image_settings.compression = saved_settings[2]
+        image_settings.exr_codec = saved_settings[3]
+
+
+def gethandoffformat(file_format, hdr):
+    """Returns the format to hand an image to the denoiser in: float EXR for HDR data, and never a lossy format"""
+    if hdr or file_format in LINEAR_FORMATS:
+        return 'OPEN_EXR'
+    if file_format == 'JPEG':
+        return 'PNG'
+    return file_format
 
 
 def load(directory, filename, imagekey):
-    """Loads an external image into a Blender image file called 'D-NOISE Export'"""
-    if 'D-NOISE Export' in bpy.data.images:
-        bpy.data.images.remove(bpy.data.images['D-NOISE Export'])
+    """Loads an external image into a Blender image file with the given key, replacing any image with that key"""
+    if imagekey in bpy.data.images:
+        bpy.data.images.remove(bpy.data.images[imagekey])
 
     bpy.data.images.load(filepath=os.path.join(directory, filename))
     bpy.data.images[filename].name = imagekey
@@ -47,46 +79,142 @@ def load(directory, filename, imagekey):
     setcolorspace(imagekey, fileformat)
 
 
+def readpixels(filepath):
+    """Returns the flat float32 pixels, width and height of an external image"""
+    image = bpy.data.images.load(filepath=filepath)
+    width, height = image.size
+    pixels = getpixels(image)
+    bpy.data.images.remove(image)
+    return pixels, width, height
+
+
+def writepixels(filepath, pixels, width, height, fileformat='OPEN_EXR'):
+    """Saves flat float32 pixels to an external image, OpenEXR by default"""
+    image = bpy.data.images.new('D-NOISE Tile', width, height, alpha=True, float_buffer=fileformat in LINEAR_FORMATS)
+    setpixels(image, pixels)
+    image.filepath_raw = filepath
+    image.file_format = fileformat
+    image.save()
+    bpy.data.images.remove(image)
+
+
+def storepixels(imagekey, pixels, width, height, fileformat):
+    """Sets the pixels of a Blender image, reusing the image if it already exists"""
+    # images stay in their editors as long as they only need to be resized
+    float_buffer = fileformat in LINEAR_FORMATS
+    image = bpy.data.images.get(imagekey)
+    if image is not None and (image.source != 'GENERATED' or image.is_float != float_buffer):
+        bpy.data.images.remove(image)
+        image = None
+
+    if image is None:
+        image = bpy.data.images.new(imagekey, width, height, alpha=True, float_buffer=float_buffer)
+    elif tuple(image.size) != (width, height):
+        image.scale(width, height)
+
+    setpixels(image, pixels)
+    setcolorspace(imagekey, fileformat)
+    image.update()
+
+
 def clean(directory, fileformat):
     """Deletes all files of a given format from a directory"""
-    os.chdir(directory)
-    for file in os.listdir(directory):
-        if fileformat in file:
-            os.remove(file)
+    deepclean(directory, {fileformat: fileformat})
 
 
 def deepclean(directory, format_dict):
     """Deletes all files of a given set of formats from a directory"""
-    for key in format_dict:
-        clean(directory, format_dict[key])
+    extensions = set(format_dict.values())
+    for file in os.listdir(directory):
+        if truncateext(file) in extensions:
+            os.remove(os.path.join(directory, file))
+
+
+def makescratch():
+    """Creates an empty scratch directory for a single denoise job and returns its path"""
+    scratch_root = getscratchroot()
+    if scratch_root is not None and not os.path.isdir(scratch_root):
+        os.makedirs(scratch_root)
+    return tempfile.mkdtemp(prefix='dnoise-', dir=scratch_root)
 
 
-def getmostrecent(directory):
-    """Returns the file name of the most recently edited file"""
-    os.chdir(directory)
-    render_files = sorted(os.listdir(os.getcwd()), key=os.path.getmtime)
-    return render_files[-1]
+def removescratch(directory):
+    """Deletes a denoise job's scratch directory and everything in it"""
+    shutil.rmtree(directory, ignore_errors=True)
 
 
-def unzip(directory, filename):
-    """Unzips a .zip file to a local directory and deletes it when its extracted"""
-    file_dir = os.path.join(directory, filename)
-    with zipfile.ZipFile(file_dir, 'r') as zip_ref:
-        zip_ref.extractall("")
+def getpreferences():
+    """Returns the D-NOISE add-on preferences"""
+    return bpy.context.preferences.addons[__package__].preferences
 
-    os.chdir(directory)
-    os.remove(filename)
+
+def getscratchroot():
+    """Returns the directory set in the add-on preferences to hold scratch directories, or None for the system default"""
+    scratch_root = getpreferences().scratch_dir
+    return bpy.path.abspath(scratch_root) if scratch_root else None
+
+
+def getframepaths(scene, frame=None):
+    """Returns the (view suffix, path) of each file an animation render writes for a frame, the current frame by default"""
+    if frame is None:
+        frame = scene.frame_current
+
+    # stereo 3D output packs every view into one file
+    if scene.render.image_settings.views_format == 'INDIVIDUAL':
+        views = getviews(scene)
+    else:
+        views = ['']
+
+    return [(view, scene.render.frame_path(frame=frame, view=view)) for view in views]
+
+
+def getviews(scene=None):
+    """Returns the file suffixes of the views a scene renders, a single empty suffix without multiview"""
+    if scene is None:
+        scene = bpy.context.scene
+
+    if not scene.render.use_multiview:
+        return ['']
+    return [view.file_suffix for view in scene.render.views if view.use]
+
+
+def getviewlayers(scene=None):
+    """Returns the view layers a scene renders"""
+    if scene is None:
+        scene = bpy.context.scene
+    return [view_layer for view_layer in scene.view_layers if view_layer.use]
 
 
 def removeoptixbin(directory):
-    """Removes all remnants of the OptiX binaries."""
-    os.chdir(directory)
-    if os.path.exists("DNOISE_OptiXBinaries.zip"):
-        os.remove("DNOISE_OptiXBinaries.zip")
-    if os.path.isdir("OptiXDenoiser"):
+    """Removes all remnants of the OptiX binaries, including a partial download"""
+    zip_path = os.path.join(directory, "DNOISE_OptiXBinaries.zip")
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    download.removeparts(zip_path)
+    if os.path.isdir(os.path.join(directory, "OptiXDenoiser")):
         shutil.rmtree(os.path.join(directory, "OptiXDenoiser"))
 
 
+def getcache():
+    """Returns the denoise cache configured in the add-on preferences, or None if caching is disabled"""
+    global CACHE
+    preferences = getpreferences()
+
+    if not preferences.use_cache:
+        return None
+
+    if preferences.cache_dir:
+        cache_dir = bpy.path.abspath(preferences.cache_dir)
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'dnoise-cache')
+
+    if CACHE is None or CACHE.directory != cache_dir:
+        CACHE = cache.DenoiseCache(cache_dir, 0)
+
+    CACHE.max_size = preferences.cache_size * 1048576
+    return CACHE
+
+
 #
 # FILE PATH FUNCTIONS
 #
@@ -127,6 +255,25 @@ def exapandlocal(path):
 # INTERNAL IMAGE MANAGEMENT
 #
 
+def getpixels(image):
+    """Returns the pixels of a Blender image as a flat float32 array"""
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    # bulk pixel access is only available on Blender 2.83 and newer
+    try:
+        image.pixels.foreach_get(pixels)
+    except AttributeError:
+        pixels[:] = image.pixels[:]
+    return pixels
+
+
+def setpixels(image, pixels):
+    """Sets the pixels of a Blender image from a flat float32 array"""
+    try:
+        image.pixels.foreach_set(pixels)
+    except AttributeError:
+        image.pixels[:] = pixels.tolist()
+
+
 def setactiveimage(imagekey, space=None):
     """Decides whether to run setactiveimage_context or setactiveimage_nocontext based on space data"""
     if space is not None:
@@ -152,8 +299,7 @@ def setactiveimage_nocontext(imagekey):
 def setcolorspace(imagekey, fileformat):
     """Sets the colorspace settings of the specified Blender image"""
     if imageexists(imagekey):
-        linearformats = ['OPEN_EXR', 'OPEN_EXR_MULTILAYER', 'HDR']
-        if fileformat in linearformats:
+        if fileformat in LINEAR_FORMATS:
             bpy.data.images[imagekey].use_view_as_render = True
             # try-except to prevent custom OCIOs from throwing errors
             try:
@@ -192,19 +338,21 @@ def getextension(file_format, extension_dict):
 
 
 def enablepasses():
-    """Enables the passes required by D-NOISE for extra pass denoising"""
-    bpy.context.scene.view_layers[0].use_pass_diffuse_color = True
-    bpy.context.scene.view_layers[0].use_pass_subsurface_color = True
-    bpy.context.scene.view_layers[0].use_pass_emit = True
-    bpy.context.scene.view_layers[0].use_pass_normal = True
+    """Enables the passes required by D-NOISE for extra pass denoising on every view layer"""
+    for view_layer in bpy.context.scene.view_layers:
+        view_layer.use_pass_diffuse_color = True
+        view_layer.use_pass_subsurface_color = True
+        view_layer.use_pass_emit = True
+        view_layer.use_pass_normal = True
 
 
 def disablepasses():
-    """Disables the passes required by D-NOISE for extra pass denoising"""
-    bpy.context.scene.view_layers[0].use_pass_diffuse_color = False
-    bpy.context.scene.view_layers[0].use_pass_subsurface_color = False
-    bpy.context.scene.view_layers[0].use_pass_emit = False
-    bpy.context.scene.view_layers[0].use_pass_normal = False
+    """Disables the passes required by D-NOISE for extra pass denoising on every view layer"""
+    for view_layer in bpy.context.scene.view_layers:
+        view_layer.use_pass_diffuse_color = False
+        view_layer.use_pass_subsurface_color = False
+        view_layer.use_pass_emit = False
+        view_layer.use_pass_normal = False
 
 #
 # Force Update Function
@@ -20,35 +20,266 @@ with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses
 
 import bpy
 import os
-from mathutils import Vector
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from . import fmutils
+from .dnoise import backends, denoiser, layers, normals, roi, scheduler, tiles, timing, worker
+
+# directory of the script files
+SCRIPT_DIR = os.path.dirname(__file__)
+
+# directory the D-NOISE compositor nodes write the passes of each view layer to
+PASSES_DIR = os.path.join(SCRIPT_DIR, 'passes')
+
+# pool of long-lived worker processes that run the OptiX denoiser
+WORKERS = None
+
+# the GPUs preference the worker pool was made for
+WORKERS_DEVICES = None
+
+# queue that runs background denoise jobs one at a time
+JOB_QUEUE = None
+
+# seconds to wait for the running background job to finish its current frames when the add-on stops
+STOP_TIMEOUT = 10
+
+# Blender file formats of the extensions denoised images are written with
+FILE_FORMATS = {'.bmp': 'BMP',
+                '.png': 'PNG',
+                '.jpg': 'JPEG',
+                '.tga': 'TARGA',
+                '.exr': 'OPEN_EXR',
+                '.hdr': 'HDR',
+                '.tif': 'TIFF'}
+
+# Blender file formats that animation frames can be pasted back together in as precisely as they were rendered,
+# which excludes lossy JPEG and the layers of multilayer EXR
+PASTE_FORMATS = {'BMP', 'PNG', 'TARGA', 'OPEN_EXR', 'HDR', 'TIFF'}
 
 #
 # Denoise Functions
 #
 
 
-def denoise(directory, source_name):
-    """Runs full denoise or beauty denoise depending on available information"""
-    if bpy.context.scene.EnableExtraPasses:
-        normal_name = getnormal(directory)
-        albedo_name = getalbedo(directory)
-        fulldenoise(directory, source_name,  normal_name, albedo_name, gethdr(), getblend())
-    else:
-        beautydenoise(directory, source_name, gethdr(),getblend())
+def denoise(source_path, output_path, blend=None, timer=None, box=None):
+    """Runs full denoise or beauty denoise depending on available information, inside the box if given"""
+    if blend is None:
+        blend = getblend()
+    if timer is None:
+        timer = timing.Job('denoise').frame(source_path)
+
+    scene = bpy.context.scene
+    scratch_dir = fmutils.makescratch()
+    try:
+        if scene.EnableExtraPasses:
+            with timer.stage('passes'):
+                layer_passes = takepasses(scratch_dir)
+            # the render result shows the first view, and every view layer is denoised along with it
+            batch = getbatch(scene, [(fmutils.getviews(scene)[0], source_path, output_path)], layer_passes)
+        else:
+            batch = [(source_path, output_path, None, None)]
+
+        if box is None:
+            with timer.stage('denoise'):
+                batchdenoise(batch, gethdr(), blend, memory=getrendermemory(scene))
+        else:
+            with timer.stage('save'):
+                cropped_batch, pastes = cropbatch(batch, box, scratch_dir)
+            with timer.stage('denoise'):
+                batchdenoise(cropped_batch, gethdr(), blend,
+                             memory=denoiser.getmemory(box[2] - box[0], box[3] - box[1]))
+            with timer.stage('load'):
+                pastebatch(pastes, box)
+    finally:
+        with timer.stage('cleanup'):
+            fmutils.removescratch(scratch_dir)
+
+
+def beautydenoise(source_path, output_path, hdr, blend, priority=worker.INTERACTIVE, backend=None, memory=0):
+    """Runs the chosen denoiser backend with information for a beauty pass"""
+    if backend is None:
+        backend = getbackend()
+    backend.denoise(source_path, output_path, hdr=hdr, blend=blend, priority=priority, memory=memory)
+
+
+def batchdenoise(batch, hdr, blend, priority=worker.INTERACTIVE, backend=None, memory=0):
+    """Runs the chosen denoiser backend on a batch of (source, output, normal, albedo) images"""
+    # memory is the device memory the batch's largest image needs, OptiX sends the whole batch to one worker
+    if backend is None:
+        backend = getbackend()
+    for output_dir in set(os.path.dirname(output_path) for source_path, output_path, normal, albedo in batch):
+        os.makedirs(output_dir, exist_ok=True)
+    backend.denoisebatch(batch, hdr, blend, priority, memory)
+
+
+def getbatch(scene, frame_paths, layer_passes):
+    """Returns the images to denoise for each (view, source, output) of the current frame and for its view layers"""
+    layers_dir = os.path.join(os.path.dirname(scene.render.frame_path(frame=scene.frame_current)),
+                              layers.LAYERS_DIR_NAME)
+    layer_names = [bpy.path.clean_name(view_layer.name) for view_layer in fmutils.getviewlayers(scene)]
+    return layers.getbatch(frame_paths, layer_passes, layer_names, scene.frame_current, layers_dir)
+
+
+def tileddenoise(pixels, hdr, blend, scratch_dir, tile_size, jobs=1):
+    """Denoises (height, width, 4) pixels in overlapping tiles, up to jobs tiles at a time, and returns the stitched pixels"""
+    height, width = pixels.shape[:2]
+    stitched = np.zeros_like(pixels)
+    backend = getbackend(jobs)
+    pending = []
+
+    def denoisetile(tile_path, memory):
+        backend.denoise(tile_path, tile_path, hdr=hdr, blend=blend, priority=worker.INTERACTIVE, memory=memory)
+        return tile_path
+
+    def stitchtile(box, future):
+        tile_path = future.result()
+        tile_pixels, tile_width, tile_height = fmutils.readpixels(tile_path)
+        tiles.addtile(stitched, tile_pixels.reshape(tile_height, tile_width, 4), box)
+        os.remove(tile_path)
+
+    # tiles are written and read back on this thread, since only the denoiser calls are safe to run off it,
+    # and at most two tiles per job exist at any time
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for index, box in enumerate(tiles.splittiles(width, height, tile_size)):
+            tile_path = os.path.join(scratch_dir, 'tile{0}.exr'.format(index))
+            tile = tiles.croptile(pixels, box)
+            fmutils.writepixels(tile_path, tile.ravel(), tile.shape[1], tile.shape[0])
+            memory = denoiser.getmemory(tile.shape[1], tile.shape[0])
+            pending.append((box, executor.submit(denoisetile, tile_path, memory)))
+            if len(pending) >= 2 * jobs:
+                stitchtile(*pending.pop(0))
+
+        while pending:
+            stitchtile(*pending.pop(0))
+
+    return stitched
+
+
+def cropbatch(batch, box, scratch_dir):
+    """Crops a batch of (source, output, normal, albedo) images to a box, returning the crops and their pastes"""
+    cropped_batch = []
+    pastes = []
+    for index, (source_path, output_path, normal_path, albedo_path) in enumerate(batch):
+        crop_paths = []
+        for name, path in (('source', source_path), ('normal', normal_path), ('albedo', albedo_path)):
+            if path is None:
+                crop_paths.append(None)
+                continue
+            pixels, width, height = fmutils.readpixels(path)
+            region = tiles.croptile(pixels.reshape(height, width, 4), box)
+            crop_path = os.path.join(scratch_dir, 'roi{0}_{1}.exr'.format(index, name))
+            fmutils.writepixels(crop_path, region.ravel(), region.shape[1], region.shape[0])
+            crop_paths.append(crop_path)
+
+        denoised_path = os.path.join(scratch_dir, 'roi{0}_denoised.exr'.format(index))
+        cropped_batch.append((crop_paths[0], denoised_path, crop_paths[1], crop_paths[2]))
+        pastes.append((denoised_path, source_path, output_path))
+    return cropped_batch, pastes
+
+
+def pastebatch(pastes, box):
+    """Pastes the denoised crops of cropbatch back into their sources and saves them to their outputs"""
+    for denoised_path, source_path, output_path in pastes:
+        # a crop the denoiser failed on leaves its output as it was, as a failed denoise of the whole image would
+        if not os.path.exists(denoised_path):
+            continue
+        pixels, width, height = fmutils.readpixels(source_path)
+        region, region_width, region_height = fmutils.readpixels(denoised_path)
+        pixels = pixels.reshape(height, width, 4)
+        roi.pastebox(pixels, region.reshape(region_height, region_width, 4), box)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        fmutils.writepixels(output_path, pixels.ravel(), width, height,
+                            FILE_FORMATS[os.path.splitext(output_path)[1].lower()])
+
+
+def takepasses(directory, scene=None):
+    """Moves the current frame's passes into a directory and returns them with screen space normals"""
+    if scene is None:
+        scene = bpy.context.scene
+
+    # the passes are taken by frame number, so they are cleaned up with the directory once they are used
+    layer_names = [bpy.path.clean_name(view_layer.name) for view_layer in fmutils.getviewlayers(scene)]
+    layer_passes = layers.takelayerpasses(PASSES_DIR, directory, layer_names, scene.frame_current,
+                                          fmutils.getviews(scene))
+
+    rotation = getcamerarotation(scene)
+    for passes in layer_passes.values():
+        if 'Normal' in passes:
+            convertnormals(*os.path.split(passes['Normal']), rotation)
+
+    return layer_passes
+
+
+#
+# Worker Functions
+#
+
+
+def getworkers(count=1):
+    """Returns the OptiX denoiser worker pool, growing it to at least the given number of workers"""
+    global WORKERS, WORKERS_DEVICES
+
+    # a pool made for other GPUs is replaced once none of its workers is busy
+    devices_text = fmutils.getpreferences().devices
+    if WORKERS is not None and WORKERS_DEVICES != devices_text and WORKERS.isidle():
+        WORKERS.stop()
+        WORKERS = None
+
+    if WORKERS is None:
+        # Blender 2.91 and newer point sys.executable at the bundled Python
+        python = getattr(bpy.app, 'binary_path_python', sys.executable)
+        WORKERS = denoiser.makepool(python=python, devices=getdevices())
+        WORKERS_DEVICES = devices_text
+
+    WORKERS.grow(count)
+    return WORKERS
+
+
+def getbackend(count=1):
+    """Returns the denoiser backend chosen in the add-on preferences, with room for the given number of images at a time"""
+    # the preference is read here on the main thread, so background jobs are handed the backend instead
+    if fmutils.getpreferences().backend == 'CPU':
+        if backends.isavailable('cpu'):
+            # the CPU filter keeps nothing running between images, so a new one costs nothing
+            return backends.CPUBackend(max(1, (os.cpu_count() or 1) // count))
+        # the CPU filter would fail on every OpenEXR pass, tile and crop, so OptiX runs while the panels say why
+        print(">> D-NOISE ERROR: the CPU denoiser needs {0}, denoising with OptiX instead".format(
+            backends.CPU_REQUIREMENTS))
+    return backends.OptixBackend(getworkers(count))
+
+
+def getdevices():
+    """Returns the GPUs the OptiX denoiser runs on from the add-on preferences, empty for the default GPU"""
+    try:
+        return denoiser.parsedevices(fmutils.getpreferences().devices)
+    except ValueError as error:
+        print(">> D-NOISE ERROR: {0}".format(error))
+        return []
+
 
+def getjobqueue():
+    """Returns the queue that runs background denoise jobs, starting it if needed"""
+    global JOB_QUEUE
 
-def beautydenoise(directory, source_name, hdr, blend):
-    """Runs OptiX standalone denoiser with information for a beauty pass"""
-    os.chdir(directory)
-    os.system('.\OptiXDenoiser\Denoiser.exe -i "{0}" -o "{0}" -hdr {1} -b {2}'.format(source_name, hdr, blend))
+    if JOB_QUEUE is None:
+        JOB_QUEUE = scheduler.JobQueue()
 
+    return JOB_QUEUE
 
-def fulldenoise(directory, source_name,  normal_name, albedo_name, hdr, blend):
-    """Runs OptiX standalone denoiser with information for a full denoising pass"""
-    os.chdir(directory)
-    convertnormals(directory, normal_name)
-    os.system('.\OptiXDenoiser\Denoiser.exe  -i "{0}" -o "{0}" -n "{1}" -a "{2}" -hdr {3} -b {4}'.format(source_name, normal_name, albedo_name, hdr, blend))
+
+def stopworkers():
+    """Cancels the queued denoise jobs and stops the OptiX denoiser workers if they are running"""
+    global WORKERS, WORKERS_DEVICES, JOB_QUEUE
+
+    if JOB_QUEUE is not None:
+        JOB_QUEUE.stop(STOP_TIMEOUT)
+        JOB_QUEUE = None
+
+    if WORKERS is not None:
+        WORKERS.stop()
+        WORKERS = None
+        WORKERS_DEVICES = None
 
 #
 # Node Functions
@@ -56,52 +287,65 @@ def fulldenoise(directory, source_name,  normal_name, albedo_name, hdr, blend):
 
 
 def addnodes(output_dir):
-    """Adds the D-NOISE extra pass node set to the compositor node tree"""
+    """Adds the D-NOISE extra pass node set for every rendered view layer to the compositor node tree"""
     bpy.context.scene.use_nodes = True
     tree = bpy.context.scene.node_tree
+    links = tree.links
+    view_layers = fmutils.getviewlayers()
 
-    # create new render layer node
-    render_layer = tree.nodes.new(type='CompositorNodeRLayers')
-    render_layer.label = '[D-NOISE] Render Layers'
-    render_layer.layer = 'View Layer'
-
-    render_layer.location = 0, 0
-
-    # create first mix RGB node
-    mix_emit_diffcol = tree.nodes.new('CompositorNodeMixRGB')
-    mix_emit_diffcol.label = '[D-NOISE] Add'
-    mix_emit_diffcol.blend_type = 'ADD'
-    mix_emit_diffcol.location = 280, -120
-    mix_emit_diffcol.hide = True
-
-    # create first mix RGB node
-    mix_last_subcol = tree.nodes.new('CompositorNodeMixRGB')
-    mix_last_subcol.label = '[D-NOISE] Add'
-    mix_last_subcol.blend_type = 'ADD'
-    mix_last_subcol.location = 400, -120
-    mix_last_subcol.hide = True
-
-    # create file output node
+    # create file output node, writing each view of a multiview render to its own file
     file_output = tree.nodes.new('CompositorNodeOutputFile')
     file_output.label = '[D-NOISE] File Output'
     file_output.base_path = output_dir
     file_output.file_slots.clear()
-    file_output.file_slots.new('Normal')
-    file_output.file_slots.new('Albedo')
     file_output.show_options = False
     file_output.format.file_format = 'OPEN_EXR'
     file_output.format.color_depth = '32'
+    file_output.format.views_format = 'INDIVIDUAL'
     file_output.location = 520, -100
     file_output.hide = True
 
-    # link nodes
-    links = tree.links
-    links.new(render_layer.outputs['Normal'], file_output.inputs['Normal'])
-    links.new(render_layer.outputs['Emit'], mix_emit_diffcol.inputs[1])
-    links.new(render_layer.outputs['DiffCol'], mix_emit_diffcol.inputs[2])
-    links.new(mix_emit_diffcol.outputs['Image'], mix_last_subcol.inputs[1])
-    links.new(render_layer.outputs['SubsurfaceCol'], mix_last_subcol.inputs[2])
-    links.new(mix_last_subcol.outputs['Image'], file_output.inputs['Albedo'])
+    for index, view_layer in enumerate(view_layers):
+        offset = -300 * index
+        layer = bpy.path.clean_name(view_layer.name)
+
+        # create new render layer node
+        render_layer = tree.nodes.new(type='CompositorNodeRLayers')
+        render_layer.label = '[D-NOISE] Render Layers'
+        render_layer.layer = view_layer.name
+
+        render_layer.location = 0, offset
+
+        # create first mix RGB node
+        mix_emit_diffcol = tree.nodes.new('CompositorNodeMixRGB')
+        mix_emit_diffcol.label = '[D-NOISE] Add'
+        mix_emit_diffcol.blend_type = 'ADD'
+        mix_emit_diffcol.location = 280, offset - 120
+        mix_emit_diffcol.hide = True
+
+        # create first mix RGB node
+        mix_last_subcol = tree.nodes.new('CompositorNodeMixRGB')
+        mix_last_subcol.label = '[D-NOISE] Add'
+        mix_last_subcol.blend_type = 'ADD'
+        mix_last_subcol.location = 400, offset - 120
+        mix_last_subcol.hide = True
+
+        # create this layer's file output slots
+        normal_input = file_output.file_slots.new(layers.getslotpath(layer, 'Normal'))
+        albedo_input = file_output.file_slots.new(layers.getslotpath(layer, 'Albedo'))
+
+        # link nodes
+        links.new(render_layer.outputs['Normal'], normal_input)
+        links.new(render_layer.outputs['Emit'], mix_emit_diffcol.inputs[1])
+        links.new(render_layer.outputs['DiffCol'], mix_emit_diffcol.inputs[2])
+        links.new(mix_emit_diffcol.outputs['Image'], mix_last_subcol.inputs[1])
+        links.new(render_layer.outputs['SubsurfaceCol'], mix_last_subcol.inputs[2])
+        links.new(mix_last_subcol.outputs['Image'], albedo_input)
+
+        # with several layers the composite no longer matches any one layer's passes, so each layer's own
+        # beauty is written out to be denoised with them
+        if len(view_layers) > 1:
+            links.new(render_layer.outputs['Image'], file_output.file_slots.new(layers.getslotpath(layer, 'Image')))
 
 
 def cleannodes():
@@ -118,32 +362,6 @@ def cleannodes():
 #
 
 
-def getnormal(directory):
-    """Returns the file name of the last file with the string 'Normal' in a given directory"""
-    os.chdir(directory)
-    files = os.listdir(directory)
-    normal_filename = None
-
-    for file in files:
-        if "Normal" in file:
-            normal_filename = file
-
-    return normal_filename
-
-
-def getalbedo(directory):
-    """Returns the file name of the last file with the string 'Albedo' in a given directory"""
-    os.chdir(directory)
-    files = os.listdir(directory)
-    albedo_filename = None
-
-    for file in files:
-        if "Albedo" in file:
-            albedo_filename = file
-
-    return albedo_filename
-
-
 def gethdr():
     """Returns whether or not HDR training data is enabled"""
     return 1 if bpy.context.scene.EnableHDRData else 0
@@ -153,31 +371,78 @@ def getblend():
     """Returns the float presented by the D-NOISE blend property"""
     return bpy.context.scene.DNOISEBlend
 
+
+def getroi(images, width, height, scene=None):
+    """Returns the box of an image's views worth denoising on its own, or None to denoise the whole image"""
+    if not fmutils.getpreferences().use_roi:
+        return None
+
+    border = None
+    if scene is not None:
+        render = scene.render
+        # a render cropped to its border has nothing outside it left to skip
+        if render.use_border and not render.use_crop_to_border:
+            border = (render.border_min_x, render.border_min_y, render.border_max_x, render.border_max_y)
+        # an opaque film has alpha everywhere, so its pixels need not be searched
+        if not render.film_transparent:
+            images = ()
+
+    return roi.getroi(width, height, border, images)
+
+
+def getframeroi(scene, frame_paths):
+    """Returns the box of an animation frame worth denoising on its own, or None to denoise it whole"""
+    # frames that could not be pasted back together as precisely as they were rendered are denoised whole
+    image_settings = scene.render.image_settings
+    if image_settings.file_format not in PASTE_FORMATS:
+        return None
+    if image_settings.color_depth == '16' and image_settings.file_format not in fmutils.LINEAR_FORMATS:
+        return None
+
+    render = scene.render
+    width = render.resolution_x * render.resolution_percentage // 100
+    height = render.resolution_y * render.resolution_percentage // 100
+    # the written views are only read back if their alpha is going to be searched
+    images = []
+    if render.film_transparent and fmutils.getpreferences().use_roi:
+        for view, path in frame_paths:
+            pixels, image_width, image_height = fmutils.readpixels(path)
+            images.append(pixels.reshape(image_height, image_width, 4))
+    return getroi(images, width, height, scene)
+
+
+def getrendermemory(scene=None):
+    """Returns the estimated device memory the denoiser needs for a render of the scene"""
+    if scene is None:
+        scene = bpy.context.scene
+    render = scene.render
+    return denoiser.getmemory(render.resolution_x * render.resolution_percentage // 100,
+                              render.resolution_y * render.resolution_percentage // 100)
+
 #
 # NORMAL FUNCTIONS
 #
 
 
-def convertnormals(directory, filename):
+def convertnormals(directory, filename, rotation):
     """Carries out the process of converting a world space normal image to a screen space normal image"""
     fmutils.load(directory, filename, 'Normal')
-    bpy.data.images['Normal'].pixels = toscreenspace(bpy.data.images['Normal'])
+    fmutils.setpixels(bpy.data.images['Normal'], toscreenspace(bpy.data.images['Normal'], rotation))
     bpy.data.images['Normal'].save()
     bpy.data.images.remove(bpy.data.images['Normal'])
 
 
-def toscreenspace(image):
-    """Converts the pixel data of a world space normal image to screen space normal pixels"""
-    pixels = list(image.pixels)
-    camera = bpy.context.scene.camera
-    camera_rotation = camera.rotation_euler.to_quaternion()
+def getcamerarotation(scene):
+    """Returns the matrix rotating world space into the space of the scene camera as it is on the current frame"""
+    # the world matrix includes the camera's parents and constraints, which its own rotation does not
+    camera = scene.camera.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    camera_rotation = camera.matrix_world.to_quaternion()
     camera_rotation.invert()
+    return np.array(camera_rotation.to_matrix(), dtype=np.float32)
 
-    for i in range(0, len(pixels), 4):
-        normal = Vector((pixels[i + 0], pixels[i + 1], pixels[i + 2]))
-        screen_space_normal = camera_rotation @ normal
-        pixels[i + 0] = screen_space_normal[0]
-        pixels[i + 1] = screen_space_normal[1]
-        pixels[i + 2] = screen_space_normal[2]
 
-    return pixels
\ No newline at end of file
+def toscreenspace(image, rotation):
+    """Converts the pixel data of a world space normal image to screen space normal pixels"""
+    pixels = fmutils.getpixels(image)
+    normals.rotatenormals(pixels.reshape(-1, 4), rotation)
+    return pixels
@@ -0,0 +1,425 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# A stand-in for the parts of Blender's bpy module the add-on uses, so the add-on can be registered, drawn and driven
+# outside Blender by the tests and the bench. It keeps its state in memory and only touches files where Blender
+# would, when images are loaded and saved, which it does with imageio. Image pixels are kept top row first, where
+# Blender keeps them bottom row first, which the add-on never depends on.
+
+import importlib
+import os
+import re
+import sys
+import types
+import numpy as np
+from dnoise import backends
+
+# folder of the add-on, the parent of the tests folder
+ADDON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#
+# Properties
+#
+
+
+class Property:
+    """A property defined with bpy.props, holding a value per object that starts at its default"""
+
+    def __init__(self, default=None, update=None, **options):
+        self.default = default
+        self.update = update
+        self.options = options
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance.__dict__.setdefault('properties', {}).get(self, self.default)
+
+    def __set__(self, instance, value):
+        instance.__dict__.setdefault('properties', {})[self] = value
+        if self.update is not None:
+            self.update(instance, None)
+
+
+def BoolProperty(default=False, **options):
+    return Property(default, **options)
+
+
+def IntProperty(default=0, **options):
+    return Property(default, **options)
+
+
+def FloatProperty(default=0.0, **options):
+    return Property(default, **options)
+
+
+def StringProperty(default='', **options):
+    return Property(default, **options)
+
+
+def EnumProperty(items=(), default=None, **options):
+    return Property(items[0][0] if default is None and items else default, items=items, **options)
+
+#
+# Types
+#
+
+
+class Layout:
+    """A UI layout that records what is drawn into it"""
+
+    def __init__(self):
+        self.items = []
+
+    def __getattr__(self, name):
+        # rows, columns and the like draw into the same record
+        def draw(*args, **kwargs):
+            self.items.append((name, args, kwargs))
+            return self
+        return draw
+
+
+class Struct:
+    """A Blender type that properties can be added to, by annotation when registered or later on the class"""
+
+    layout = None
+
+
+class Operator(Struct):
+    pass
+
+
+class Panel(Struct):
+    pass
+
+
+class AddonPreferences(Struct):
+    pass
+
+
+class Anything:
+    """An object whose every attribute, item and call gives another, for the parts of Blender only written to"""
+
+    def __getattr__(self, name):
+        return Anything()
+
+    def __getitem__(self, key):
+        return Anything()
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+    def __iter__(self):
+        return iter(())
+
+
+class Rotation:
+    """A rotation of the camera, standing in for both the mathutils Matrix and Quaternion"""
+
+    def __init__(self, matrix):
+        self.matrix = np.array(matrix, dtype=np.float32)
+
+    def to_quaternion(self):
+        return Rotation(self.matrix)
+
+    def invert(self):
+        self.matrix = self.matrix.T
+
+    def to_matrix(self):
+        return self.matrix
+
+
+class Camera:
+    """A camera that is evaluated as it is"""
+
+    def __init__(self, rotation=np.eye(3)):
+        self.matrix_world = Rotation(rotation)
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+
+class RenderSettings:
+    """The render settings of a scene, writing frames to filepath followed by the frame number"""
+
+    def __init__(self):
+        self.filepath = ''
+        self.resolution_x = 1920
+        self.resolution_y = 1080
+        self.resolution_percentage = 100
+        self.use_border = False
+        self.use_crop_to_border = False
+        self.border_min_x = self.border_min_y = 0.0
+        self.border_max_x = self.border_max_y = 1.0
+        self.film_transparent = False
+        self.use_multiview = False
+        self.views = []
+        self.image_settings = types.SimpleNamespace(file_format='PNG', color_depth='8', compression=15,
+                                                    exr_codec='ZIP', views_format='INDIVIDUAL')
+
+    def frame_path(self, frame=None, view=''):
+        return "{0}{1:04d}{2}{3}".format(self.filepath, frame, view, EXTENSIONS[self.image_settings.file_format])
+
+
+class Scene(Struct):
+    """A scene with the settings the add-on reads"""
+
+    def __init__(self):
+        self.frame_current = 1
+        self.frame_start = 1
+        self.frame_end = 1
+        self.frame_step = 1
+        self.view_layers = [types.SimpleNamespace(name='View Layer', use=True)]
+        self.camera = Camera()
+        self.use_nodes = False
+        self.node_tree = Anything()
+        self.render = RenderSettings()
+
+
+class Header:
+    """A header whose draw functions can be appended to"""
+
+    draw_functions = []
+
+    @classmethod
+    def append(cls, draw_function):
+        cls.draw_functions.append(draw_function)
+
+    @classmethod
+    def remove(cls, draw_function):
+        cls.draw_functions.remove(draw_function)
+
+
+class IMAGE_HT_header(Header):
+    draw_functions = []
+
+#
+# Images
+#
+
+# extensions of the file formats images are saved in, and the formats of the extensions images are loaded from
+EXTENSIONS = {'BMP': '.bmp', 'PNG': '.png', 'JPEG': '.jpg', 'TARGA': '.tga', 'OPEN_EXR': '.exr', 'HDR': '.hdr',
+              'TIFF': '.tif'}
+FORMATS = {extension: file_format for file_format, extension in EXTENSIONS.items()}
+
+
+class Pixels:
+    """The flat float pixels of an image, with the bulk access of Blender 2.83 and newer"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __setitem__(self, index, values):
+        self.values[index] = values
+
+    def foreach_get(self, values):
+        values[:] = self.values
+
+    def foreach_set(self, values):
+        self.values[:] = values
+
+
+class Image:
+    """An image held in memory, saved to and loaded from files as Blender would"""
+
+    def __init__(self, name, width, height, float_buffer=False, source='GENERATED', filepath=''):
+        self.name = name
+        self.source = source
+        self.filepath = self.filepath_raw = filepath
+        self.file_format = FORMATS.get(os.path.splitext(filepath)[1].lower(), 'PNG')
+        self.is_float = float_buffer
+        self.is_dirty = False
+        self.use_view_as_render = False
+        self.colorspace_settings = types.SimpleNamespace(name='sRGB')
+        self.scale(width, height)
+
+    def scale(self, width, height):
+        self.size = (width, height)
+        self.pixels = Pixels(np.zeros(width * height * 4, dtype=np.float32))
+
+    def update(self):
+        pass
+
+    def save(self):
+        # images are saved with their own bit depth, as Blender saves them without render settings
+        writefile(self.filepath_raw or self.filepath, self, np.float32 if self.is_float else np.uint8)
+
+    def save_render(self, filepath):
+        image_settings = sys.modules['bpy'].context.scene.render.image_settings
+        if image_settings.file_format in ('OPEN_EXR', 'HDR'):
+            dtype = np.float16 if image_settings.color_depth == '16' else np.float32
+        else:
+            dtype = np.uint16 if image_settings.color_depth == '16' else np.uint8
+        writefile(filepath, self, dtype)
+
+
+class Images:
+    """The images of a blend file, looked up by name"""
+
+    def __init__(self):
+        self.images = []
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __getitem__(self, name):
+        image = self.get(name)
+        if image is None:
+            raise KeyError(name)
+        return image
+
+    def get(self, name, default=None):
+        return next((image for image in self.images if image.name == name), default)
+
+    def new(self, name, width, height, alpha=False, float_buffer=False):
+        self.images.append(Image(self.uniquename(name), width, height, float_buffer))
+        return self.images[-1]
+
+    def load(self, filepath):
+        pixels, dtype = backends.readimage(filepath)
+        height, width = pixels.shape[:2]
+        image = Image(self.uniquename(os.path.basename(filepath)), width, height,
+                      not np.issubdtype(dtype, np.integer), 'FILE', filepath)
+        image.pixels.foreach_set(pixels.ravel())
+        self.images.append(image)
+        return image
+
+    def remove(self, image):
+        self.images.remove(image)
+
+    def uniquename(self, name):
+        # a name already taken gets a number, as in Blender
+        unique_name = name
+        number = 0
+        while unique_name in self:
+            number += 1
+            unique_name = "{0}.{1:03d}".format(name, number)
+        return unique_name
+
+
+def writefile(filepath, image, dtype):
+    """Saves the pixels of an image to a file in the given data type"""
+    width, height = image.size
+    backends.writeimage(filepath, image.pixels.values.reshape(height, width, 4), dtype)
+
+#
+# Utilities
+#
+
+
+def register_class(cls):
+    """Turns the property annotations of a class into properties, and adds add-on preferences, as Blender does"""
+    for name, annotation in getattr(cls, '__annotations__', {}).items():
+        if isinstance(annotation, Property):
+            setattr(cls, name, annotation)
+    if issubclass(cls, AddonPreferences):
+        sys.modules['bpy'].context.preferences.addons[cls.bl_idname] = types.SimpleNamespace(preferences=cls())
+
+
+def unregister_class(cls):
+    pass
+
+
+class Previews(dict):
+    """A collection of icons, which Blender only reads from disk when they are first drawn"""
+
+    def load(self, name, path, path_type):
+        self[name] = types.SimpleNamespace(icon_id=len(self) + 1, path=path)
+        return self[name]
+
+
+def abspath(path):
+    """Returns a path with the // of a path relative to the blend file removed, the blend file being unsaved"""
+    return path[2:] if path.startswith('//') else path
+
+
+def clean_name(name):
+    return re.sub(r'[^\w.-]', '_', name)
+
+#
+# Module
+#
+
+
+def install():
+    """Puts a new stand-in bpy module in sys.modules and returns it"""
+    bpy = types.ModuleType('bpy')
+
+    bpy.props = types.ModuleType('bpy.props')
+    for prop in (BoolProperty, IntProperty, FloatProperty, StringProperty, EnumProperty):
+        setattr(bpy.props, prop.__name__, prop)
+
+    bpy.types = types.ModuleType('bpy.types')
+    for cls in (Operator, Panel, AddonPreferences, Scene, IMAGE_HT_header):
+        # the classes get new properties, so each bpy gets its own
+        setattr(bpy.types, cls.__name__, type(cls.__name__, (cls,), {}))
+    bpy.types.IMAGE_HT_header.draw_functions = []
+
+    bpy.utils = types.ModuleType('bpy.utils')
+    bpy.utils.register_class = register_class
+    bpy.utils.unregister_class = unregister_class
+    bpy.utils.previews = types.ModuleType('bpy.utils.previews')
+    bpy.utils.previews.new = Previews
+    bpy.utils.previews.remove = Previews.clear
+
+    bpy.app = types.ModuleType('bpy.app')
+    bpy.app.handlers = types.ModuleType('bpy.app.handlers')
+    for name in ('load_post', 'render_init', 'render_complete', 'render_cancel', 'render_write'):
+        setattr(bpy.app.handlers, name, [])
+    bpy.app.handlers.persistent = lambda handler: handler
+    bpy.app.timers = types.ModuleType('bpy.app.timers')
+    bpy.app.timers.functions = []
+    bpy.app.timers.register = lambda function, first_interval=0: bpy.app.timers.functions.append(function)
+    bpy.app.timers.is_registered = lambda function: function in bpy.app.timers.functions
+
+    bpy.path = types.ModuleType('bpy.path')
+    bpy.path.abspath = abspath
+    bpy.path.clean_name = clean_name
+
+    bpy.data = types.SimpleNamespace(images=Images(), window_managers={'WinMan': types.SimpleNamespace(windows=[])})
+    bpy.context = types.SimpleNamespace(scene=bpy.types.Scene(), space_data=types.SimpleNamespace(image=None),
+                                        preferences=types.SimpleNamespace(addons={}),
+                                        evaluated_depsgraph_get=lambda: None)
+
+    for module in (bpy, bpy.props, bpy.types, bpy.utils, bpy.utils.previews, bpy.app, bpy.app.handlers,
+                   bpy.app.timers, bpy.path):
+        sys.modules[module.__name__] = module
+    return bpy
+
+
+def importaddon():
+    """Imports the add-on as the package it is installed as, installing a stand-in bpy first if there is none"""
+    if 'bpy' not in sys.modules:
+        install()
+    if os.path.dirname(ADDON_DIR) not in sys.path:
+        sys.path.insert(0, os.path.dirname(ADDON_DIR))
+    return importlib.import_module(os.path.basename(ADDON_DIR))
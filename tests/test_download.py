@@ -0,0 +1,174 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+
+# Downloads run against a server on this machine that answers range requests like the OptiX download host,
+# and can be told to cut a response short or to fail requests, as a flaky connection would.
+
+import hashlib
+import http.server
+import os
+import re
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from dnoise import download
+
+# bytes read at a time during the tests, small so the file splits into several ranges of several chunks
+CHUNK_SIZE = 4096
+
+# the file served, which splits into ranges that do not end on a chunk boundary
+DATA = os.urandom(18 * CHUNK_SIZE)
+
+# the range request download.getsize makes, which the faults leave alone
+SIZE_RANGE = 'bytes=0-0'
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA, answering range requests with the bytes asked for, cut short or failed as the server says"""
+
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        content_range = self.headers.get('Range')
+        if content_range is not None:
+            match = re.match(r'bytes=(\d+)-(\d+)$', content_range)
+            start, end = int(match.group(1)), int(match.group(2))
+        self.server.ranges.append((start, end))
+
+        if content_range != SIZE_RANGE and self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_error(503)
+            return
+
+        body = DATA[start:end + 1]
+        self.send_response(206 if content_range is not None else 200)
+        if content_range is not None:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, len(DATA)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # a cut connection sends half of the body it promised, then closes
+        if content_range != SIZE_RANGE and self.server.cuts > 0:
+            self.server.cuts -= 1
+            self.wfile.write(body[:len(body) // 2])
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.ranges = []
+        self.server.failures = 0
+        self.server.cuts = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/Denoiser.zip'.format(self.server.server_address[1])
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'Denoiser.zip')
+        self.sha256 = hashlib.sha256(DATA).hexdigest()
+        patch = mock.patch.object(download, 'CHUNK_SIZE', CHUNK_SIZE)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.directory.cleanup()
+
+    def listparts(self):
+        return [filename for filename in os.listdir(self.directory.name) if '.part-' in filename]
+
+    def readfile(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        progress = download.Progress()
+        download.download(self.url, self.path, progress, self.sha256)
+        self.assertEqual(self.readfile(), DATA)
+        self.assertEqual(self.listparts(), [])
+        self.assertEqual(progress.percent(), 100)
+        self.assertEqual(len(self.server.ranges), 1 + download.CONNECTIONS)
+
+    def test_resume_after_cut_connection(self):
+        self.server.cuts = 1
+        download.download(self.url, self.path, download.Progress(), self.sha256)
+        self.assertEqual(self.readfile(), DATA)
+        self.assertEqual(self.server.cuts, 0)
+
+        # the range that was cut short is asked for again from where it stopped, not from its start
+        ranges = download.splitranges(len(DATA), download.CONNECTIONS)
+        resumed = [(start, end) for start, end in self.server.ranges[1:] if (start, end) not in ranges]
+        self.assertEqual(len(resumed), 1)
+        self.assertIn(resumed[0][1], [end for start, end in ranges])
+
+    def test_resume_from_earlier_parts(self):
+        start, end = download.splitranges(len(DATA), download.CONNECTIONS)[0]
+        with open(download.getpartpath(self.path, start, end), 'wb') as f:
+            f.write(DATA[start:start + CHUNK_SIZE])
+
+        progress = download.Progress()
+        download.download(self.url, self.path, progress, self.sha256)
+        self.assertEqual(self.readfile(), DATA)
+        self.assertIn((start + CHUNK_SIZE, end), self.server.ranges)
+        self.assertNotIn((start, end), self.server.ranges)
+
+    def test_retry_transient_failure(self):
+        self.server.failures = download.RETRIES
+        download.download(self.url, self.path, download.Progress(), self.sha256, connections=1)
+        self.assertEqual(self.readfile(), DATA)
+        self.assertEqual(len(self.server.ranges), 2 + download.RETRIES)
+
+    def test_give_up_after_retries(self):
+        self.server.failures = download.RETRIES + 1
+        with self.assertRaises(OSError):
+            download.download(self.url, self.path, download.Progress(), self.sha256, connections=1)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(ValueError):
+            download.download(self.url, self.path, download.Progress(), hashlib.sha256(b'other').hexdigest())
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_cancel(self):
+        # the download is cancelled as soon as its first chunk arrives, keeping the parts for the next one
+        progress = download.Progress(lambda progress: progress.cancel() if progress.done else None)
+        with self.assertRaises(InterruptedError):
+            download.download(self.url, self.path, progress, self.sha256)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertNotEqual(self.listparts(), [])
+        self.assertLess(progress.done, len(DATA))
+
+        progress = download.Progress()
+        progress.reset()
+        download.download(self.url, self.path, progress, self.sha256)
+        self.assertEqual(self.readfile(), DATA)
+        self.assertEqual(self.listparts(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Registering the add-on and drawing its UI run on Blender's main thread, many times a second while the UI is in use,
+# so they must not wait on the disk, which on a network drive or a sleeping disk can take seconds. Each is run with
+# the file system functions of os and open wrapped to count the calls made on this thread.
+
+import builtins
+import io
+import os
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from unittest import mock
+import fakebpy
+from dnoise import cache
+
+# functions of os that touch the file system, which os.path, shutil and tempfile call in turn
+FILESYSTEM_FUNCTIONS = ('access', 'chmod', 'link', 'listdir', 'lstat', 'makedirs', 'mkdir', 'open', 'remove',
+                        'rename', 'replace', 'rmdir', 'scandir', 'stat', 'unlink', 'utime', 'walk')
+
+
+class FilesystemCounter:
+    """Records the file system calls made on the entering thread while entered"""
+
+    def __init__(self):
+        self.calls = []
+        self.patches = []
+
+    def wrap(self, name, function):
+        def counted(*args, **kwargs):
+            if threading.get_ident() == self.thread:
+                self.calls.append((name, args[:1]))
+            return function(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self.thread = threading.get_ident()
+        self.patches = [mock.patch.object(os, name, self.wrap(name, getattr(os, name)))
+                        for name in FILESYSTEM_FUNCTIONS]
+        self.patches.append(mock.patch.object(builtins, 'open', self.wrap('open', builtins.open)))
+        self.patches.append(mock.patch.object(io, 'open', self.wrap('io.open', io.open)))
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patch in reversed(self.patches):
+            patch.stop()
+
+
+class FilesystemTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.addon = fakebpy.importaddon()
+        cls.bpy = sys.modules['bpy']
+
+    def setUp(self):
+        # the install check and the cleanup of the add-on folder are left to the background thread, which is not run
+        with mock.patch.object(self.addon, 'startupchores'), FilesystemCounter() as counter:
+            self.addon.register()
+        self.register_calls = counter.calls
+
+    def tearDown(self):
+        with mock.patch.object(self.addon.fmutils, 'deepclean'), mock.patch.object(self.addon.fmutils, 'removescratch'):
+            self.addon.unregister()
+
+    def assertNoFilesystemCalls(self, draw):
+        with FilesystemCounter() as counter:
+            draw()
+        self.assertEqual(counter.calls, [])
+
+    def test_register(self):
+        self.assertEqual(self.register_calls, [])
+
+    def test_panel(self):
+        panel = self.addon.DNOISEPanel()
+        panel.layout = fakebpy.Layout()
+        self.assertNoFilesystemCalls(lambda: panel.draw_header(self.bpy.context))
+        self.assertNoFilesystemCalls(lambda: panel.draw(self.bpy.context))
+
+    def test_image_header(self):
+        header = types.SimpleNamespace(layout=fakebpy.Layout())
+        space = self.bpy.context.space_data
+        images = [None] + [types.SimpleNamespace(name=name, source=source)
+                           for name, source in (('Render Result', 'VIEWER'), ('D-NOISE Export', 'GENERATED'),
+                                                ('frame', 'FILE'), ('frame', 'SEQUENCE'))]
+        for animation_text in (None, "D-NOISE-ing Animation..."):
+            for image in images:
+                with mock.patch.object(self.addon, 'ANIMATION_TEXT', animation_text), \
+                        mock.patch.object(space, 'image', image):
+                    self.assertNoFilesystemCalls(lambda: self.addon.appendto_image_ht_header(header,
+                                                                                               self.bpy.context))
+
+    def test_preferences(self):
+        preferences = self.bpy.context.preferences.addons[self.addon.__name__].preferences
+        preferences.layout = fakebpy.Layout()
+        preferences.use_cache = True
+        preferences.use_tiling = True
+        preferences.devices = '0'
+        with tempfile.TemporaryDirectory() as cache_dir:
+            denoise_cache = cache.DenoiseCache(cache_dir, 0)
+            for backend in ('OPTIX', 'CPU'):
+                for installed in (None, False, True):
+                    for state in ('idle', 'downloading'):
+                        preferences.backend = backend
+                        with mock.patch.object(self.addon.fmutils, 'CACHE', denoise_cache), \
+                                mock.patch.object(self.addon.urlutils, 'INSTALLED', installed), \
+                                mock.patch.object(self.addon.urlutils.PROGRESS, 'state', state):
+                            self.assertNoFilesystemCalls(lambda: preferences.draw(self.bpy.context))
+
+
+if __name__ == '__main__':
+    unittest.main()
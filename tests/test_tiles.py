@@ -0,0 +1,88 @@
+"""
+Copyright (C) 2018 Grant Wilk
+
+This file is part of D-NOISE: AI-Acclerated Denoiser.
+
+D-NOISE: AI-Acclerated Denoiser is free software: you can redistribute
+it and/or modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+D-NOISE: AI-Acclerated Denoiser is distributed in the hope that it will
+be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with D-NOISE: AI-Acclerated Denoiser.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+# Tiling must not change an image beyond what the denoiser does to it. A box filter stands in for the denoiser,
+# since like it each output pixel depends on its neighbours, which a tile's edge cuts off.
+
+import unittest
+import numpy as np
+from dnoise import tiles
+
+# most a tiled denoise may differ from an untiled one, in the 0 to 1 range of an LDR image
+TILE_TOLERANCE = 0.004
+
+
+def boxfilter(pixels, radius=2):
+    """Returns a (height, width, channels) image averaged over square windows, a stand-in for the denoiser"""
+    size = 2 * radius + 1
+    padded = np.pad(pixels, ((radius, radius), (radius, radius), (0, 0)), mode='edge').astype(np.float64)
+    sums = np.cumsum(np.cumsum(np.pad(padded, ((1, 0), (1, 0), (0, 0))), axis=0), axis=1)
+    window = sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]
+    return (window / size ** 2).astype(np.float32)
+
+
+def stitch(pixels, tile_size, denoise=lambda tile: tile):
+    """Returns an image split into tiles of the given size, each passed through denoise, and stitched back together"""
+    height, width = pixels.shape[:2]
+    stitched = np.zeros_like(pixels)
+    for box in tiles.splittiles(width, height, tile_size):
+        tiles.addtile(stitched, denoise(tiles.croptile(pixels, box)), box)
+    return stitched
+
+
+class TilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_tiles_cover_image(self):
+        for width, height, tile_size in ((300, 200, 128), (257, 129, 128), (128, 128, 128), (1000, 37, 200)):
+            covered = np.zeros((height, width), dtype=int)
+            for x0, y0, x1, y1 in tiles.splittiles(width, height, tile_size):
+                covered[y0:y1, x0:x1] += 1
+            self.assertTrue((covered >= 1).all(), (width, height, tile_size))
+
+    def test_weights_add_up_to_one(self):
+        width, height = 333, 222
+        total = np.zeros((height, width, 1), dtype=np.float32)
+        for box in tiles.splittiles(width, height, 128):
+            x0, y0, x1, y1 = box
+            total[y0:y1, x0:x1] += tiles.featherweights(box, width, height)
+        np.testing.assert_allclose(total, 1, atol=1e-6)
+
+    def test_unmodified_tiles_stitch_to_input(self):
+        for width, height, tile_size in ((300, 200, 128), (257, 129, 128), (512, 512, 128), (64, 64, 128)):
+            pixels = self.rng.random((height, width, 4), dtype=np.float32)
+            np.testing.assert_allclose(stitch(pixels, tile_size), pixels, atol=1e-6)
+
+    def test_tiled_denoise_matches_untiled(self):
+        for width, height, tile_size in ((300, 200, 128), (512, 384, 128), (640, 480, 200)):
+            pixels = self.rng.random((height, width, 4), dtype=np.float32)
+            difference = np.abs(stitch(pixels, tile_size, boxfilter) - boxfilter(pixels)).max()
+            self.assertLessEqual(difference, TILE_TOLERANCE, (width, height, tile_size))
+
+    def test_tile_size_fits_budget(self):
+        for budget in (64 * 1048576, 2048 * 1048576):
+            padded_size = tiles.gettilesize(budget) + 2 * tiles.TILE_OVERLAP
+            self.assertLessEqual(padded_size ** 2 * tiles.DENOISER_BYTES_PER_PIXEL, budget)
+
+
+if __name__ == '__main__':
+    unittest.main()